@@ -88,7 +88,7 @@ def create_reduction_tree(oresult, parent):
 #                'instrument': ins.name,
 #                'observing_mode': oblock.observing_mode,
 #              }
-#    ptask.request = str(request)
+#    ptask.request = request
     for child in oresult.children:
         create_reduction_tree(child, ptask)
     return ptask
@@ -133,7 +133,7 @@ root_a_task = create_reduction_task(oblock, otask)
 root_a_task.waiting = True
 root_a_task.obstree_node_id = otask.id
 request = {'pset': 'default', 'instrument': ins.name}
-root_a_task.request = str(request)
+root_a_task.request = request
 session.add(root_a_task)
 
 # One mosaic
@@ -151,7 +151,7 @@ root_p_task.parent = root_a_task
 root_p_task.waiting = True
 root_p_task.obstree_node = otaskj
 request = {'pset': 'default', 'instrument': ins.name}
-root_p_task.request = str(request)
+root_p_task.request = request
 session.add(root_p_task)
 session.add(otaskj)
 
@@ -191,7 +191,7 @@ for j in range(3):
     ptask.state = 1 # Complete
     ptask.obstree_node = otaskp
     request = {'pset': 'default', 'instrument': ins.name}
-    ptask.request = str(request)
+    ptask.request = request
     ptask.parent = root_p_task
     ptask.waiting = False
     session.add(ptask)
@@ -88,7 +88,7 @@ def create_reduction_tree(oresult, parent):
 #                'instrument': ins.name,
 #                'observing_mode': oblock.observing_mode,
 #              }
-#    ptask.request = str(request)
+#    ptask.request = request
     for child in oresult.children:
         create_reduction_tree(child, ptask)
     return ptask
@@ -143,7 +143,7 @@ ptask = create_reduction_task(oblock, ores)
 ptask.waiting = False
 ptask.obstree_node_id = ores.id
 request = {'pset': 'default', 'instrument': ins.name}
-ptask.request = str(request)
+ptask.request = request
 session.add(ptask)
 
 # OB started
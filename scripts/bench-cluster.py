@@ -0,0 +1,146 @@
+#!/usr/bin/python
+
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Measure the throughput of a whole cluster, running in one process.
+
+A server and several hosts are wired with the loopback transport.
+The tasks run a recipe that returns at once, so the time measured 
+is spent dispatching the tasks, running the slots and 
+inserting the results.
+'''
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import argparse
+
+parser = argparse.ArgumentParser(description='Cluster benchmark')
+parser.add_argument('-t', '--tasks', type=int, default=200,
+                    help='Number of tasks run')
+parser.add_argument('-f', '--frames', type=int, default=1,
+                    help='Number of frames per task')
+parser.add_argument('-n', '--hosts', type=int, default=2,
+                    help='Number of hosts')
+parser.add_argument('-s', '--slots', type=int, default=2,
+                    help='Number of slots of each host')
+parser.add_argument('-d', '--dispatchers', type=int, default=2,
+                    help='Number of threads preparing and dispatching tasks')
+parser.add_argument('-b', '--batch', type=int, default=4,
+                    help='Maximum number of tasks taken by a dispatcher at once')
+parser.add_argument('-D', '--delay', type=float, default=0.05,
+                    help='Seconds a host waits to send results in a batch')
+parser.add_argument('-p', '--pull', action='store_true',
+                    help='The hosts fetch their tasks')
+args = parser.parse_args()
+
+# pontifex.model creates its directories in the working directory
+basedir = tempfile.mkdtemp(prefix='pontifex-cluster-')
+os.chdir(basedir)
+
+from pontifex.model import Session, datadir
+from pontifex.model import Users, Instrument, InstrumentConfiguration
+from pontifex.model import ObservingMode, Pipeline, PipelineMap, ProcessingSet
+from pontifex.model import ObservingRun, ObservingBlock, ObservationResult, Frame
+from pontifex.model import DataProcessingTask, COMPLETED, FINISHED
+from pontifex.cluster import LocalCluster, create_database
+
+class BenchRecipe(object):
+    __requires__ = []
+    __provides__ = []
+    logger = logging.getLogger('bench.recipe')
+
+    def __call__(self, obsres):
+        return {'products': []}
+
+def seed(session):
+    user = Users(name='bench', status=1, usertype=1)
+    ins = Instrument(name='BENCH')
+    session.add(InstrumentConfiguration(instrument=ins, parameters={},
+                                        description='Bench', active=True))
+    session.add(ProcessingSet(instrument=ins, name='default'))
+    mode = ObservingMode(name='Bench', key='bench', instrument=ins)
+    pipe = Pipeline(name='default', version=1, instrument=ins)
+    session.add(PipelineMap(pipeline=pipe, obsmodes=mode,
+                            recipe_fqn='__main__.BenchRecipe'))
+    obsrun = ObservingRun(pi=user, instrument=ins)
+    session.add(obsrun)
+    session.commit()
+    return user, obsrun, mode
+
+def create_tasks(session, user, obsrun, mode):
+    data = os.urandom(1 << 10)
+    tasks = []
+    for i in range(args.tasks):
+        ores = ObservationResult(mode_id=mode.Id, label='pointing', state=2)
+        ob = ObservingBlock(object='bench', obsrun=obsrun, observer_id=user.id,
+                            observation_result=ores, observing_mode=mode)
+        session.add(ob)
+        for j in range(args.frames):
+            name = 'b%05d.fits' % (i * args.frames + j)
+            with open(os.path.join(datadir, name), 'wb') as fd:
+                fd.write(data)
+            session.add(Frame(name=name, object='bench', exposure=0.0,
+                              imgtype='BIAS', racoor=0.0, deccoor=0.0,
+                              observation_result=ores))
+        # ready, the watchdog is notified on commit
+        task = DataProcessingTask(obsresult_node=ores, state=COMPLETED,
+                                  waiting=False, method='processPointing',
+                                  request={'pset': 'default',
+                                           'instrument': 'BENCH'})
+        session.add(task)
+        tasks.append(task)
+    return tasks
+
+def main():
+    create_database(basedir)
+    session = Session()
+    user, obsrun, mode = seed(session)
+
+    cluster = LocalCluster(args.hosts, args.slots, capabilities=['BENCH'],
+                           dispatchers=args.dispatchers, pull=args.pull,
+                           host_options={'delay': args.delay},
+                           batch=args.batch)
+    cluster.start()
+    try:
+        tasks = create_tasks(session, user, obsrun, mode)
+        start = time.time()
+        session.commit()
+        states = cluster.wait([task.id for task in tasks], timeout=600)
+        elapsed = time.time() - start
+    finally:
+        cluster.stop()
+
+    finished = sum(1 for state in states.values() if state == FINISHED)
+    print 'hosts=%d slots=%d dispatchers=%d batch=%d delay=%.3f pull=%s' % (
+                    args.hosts, args.slots, args.dispatchers, args.batch, 
+                    args.delay, args.pull)
+    print '%d of %d tasks finished in %.3f s, %.1f tasks/s' % (finished,
+                    len(states), elapsed, len(states) / elapsed)
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        shutil.rmtree(basedir)
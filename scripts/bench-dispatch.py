@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Measure the dispatch rate of the server for several dispatcher pool sizes.
+
+The tasks are prepared by the real consumers (database queries,
+directories, frame copies and task control) and sent to fake hosts
+that take a fixed time to accept each task.
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import argparse
+from Queue import Queue
+
+parser = argparse.ArgumentParser(description='Dispatcher pool benchmark')
+parser.add_argument('-t', '--tasks', type=int, default=200,
+                    help='Number of tasks dispatched in each run')
+parser.add_argument('-f', '--frames', type=int, default=10,
+                    help='Number of frames per task')
+parser.add_argument('-s', '--size', type=int, default=1 << 20,
+                    help='Size of each frame in bytes')
+parser.add_argument('-l', '--latency', type=float, default=0.005,
+                    help='Time taken by a host to accept a task, in seconds')
+parser.add_argument('-b', '--batch', type=int, default=1,
+                    help='Maximum number of tasks taken by a dispatcher at once')
+parser.add_argument('-p', '--pools', default='1,2,4,8',
+                    help='Comma separated list of pool sizes')
+args = parser.parse_args()
+
+# pontifex.model creates its directories in the working directory
+basedir = tempfile.mkdtemp(prefix='pontifex-bench-')
+os.chdir(basedir)
+
+from sqlalchemy import create_engine
+
+import pontifex.model as model
+from pontifex.model import Session, datadir
+from pontifex.model import Users, Instrument, InstrumentConfiguration
+from pontifex.model import ObservingMode, Pipeline, PipelineMap, ProcessingSet
+from pontifex.model import ObservingRun, ObservingBlock, ObservationResult, Frame
+from pontifex.model import DataProcessingTask, ENQUEUED, PROCESSING
+from pontifex.server import PontifexServer
+
+class BenchRecipe(object):
+    __requires__ = []
+    __provides__ = []
+
+class BenchServer(PontifexServer):
+    '''A server whose host accepts each call after a fixed latency.'''
+    def __init__(self, latency, batch):
+        super(BenchServer, self).__init__(batch=batch)
+        self.latency = latency
+        self.dispatched = Queue()
+
+    def send_to_clients(self, session, prepared):
+        for task, _, _, _ in prepared:
+            task.state = PROCESSING
+            task.host = 'bench'
+        session.commit()
+        # all the tasks go to the same host, in one call
+        time.sleep(self.latency)
+        for task, _, _, _ in prepared:
+            self.dispatched.put(task.id)
+        return []
+
+def seed(session):
+    user = Users(name='bench', status=1, usertype=1)
+    ins = Instrument(name='BENCH')
+    session.add(InstrumentConfiguration(instrument=ins, parameters={},
+                                        description='Bench', active=True))
+    session.add(ProcessingSet(instrument=ins, name='default'))
+    mode = ObservingMode(name='Bench', key='bench', instrument=ins)
+    pipe = Pipeline(name='default', version=1, instrument=ins)
+    session.add(PipelineMap(pipeline=pipe, obsmodes=mode,
+                            recipe_fqn='__main__.BenchRecipe'))
+    obsrun = ObservingRun(pi=user, instrument=ins)
+    session.add(obsrun)
+    session.commit()
+    return user, obsrun, mode
+
+def create_tasks(session, user, obsrun, mode, first):
+    data = os.urandom(args.size)
+    taskids = []
+    for i in range(args.tasks):
+        ores = ObservationResult(mode_id=mode.Id, label='pointing', state=2)
+        ob = ObservingBlock(object='bench', obsrun=obsrun, observer_id=user.id,
+                            observation_result=ores, observing_mode=mode)
+        session.add(ob)
+        for j in range(args.frames):
+            name = 'b%05d.fits' % (first + i * args.frames + j)
+            with open(os.path.join(datadir, name), 'wb') as fd:
+                fd.write(data)
+            session.add(Frame(name=name, object='bench', exposure=0.0,
+                              imgtype='BIAS', racoor=0.0, deccoor=0.0,
+                              observation_result=ores))
+        task = DataProcessingTask(obsresult_node=ores, state=ENQUEUED,
+                                  waiting=False, method='processPointing',
+                                  request={'pset': 'default',
+                                           'instrument': 'BENCH'})
+        session.add(task)
+        session.flush()
+        taskids.append(task.id)
+    session.commit()
+    return taskids
+
+def run(nworkers, taskids):
+    im = BenchServer(args.latency, args.batch)
+    consumers = [threading.Thread(target=im.consumer, name='consumer-%d' % i)
+                    for i in range(nworkers)]
+
+    for taskid in taskids:
+        im.queue.put((0, taskid))
+
+    start = time.time()
+    for consumer in consumers:
+        consumer.start()
+    for _ in taskids:
+        im.dispatched.get()
+    elapsed = time.time() - start
+
+    im.quit()
+    for consumer in consumers:
+        consumer.join()
+    return elapsed
+
+def main():
+    engine = create_engine('sqlite:///%s' % os.path.join(basedir, 'bench.sqlite'))
+    model.init_model(engine)
+    model.metadata.create_all(engine)
+
+    session = Session()
+    user, obsrun, mode = seed(session)
+
+    print 'tasks=%d frames=%d size=%d latency=%.3fs batch=%d' % (args.tasks, 
+                    args.frames, args.size, args.latency, args.batch)
+    print '%8s %10s %10s %8s' % ('workers', 'time (s)', 'tasks/s', 'speedup')
+    reference = None
+    first = 0
+    for nworkers in [int(v) for v in args.pools.split(',')]:
+        taskids = create_tasks(session, user, obsrun, mode, first)
+        first += args.tasks * args.frames
+        elapsed = run(nworkers, taskids)
+        if reference is None:
+            reference = elapsed
+        print '%8d %10.3f %10.1f %8.2f' % (nworkers, elapsed,
+                                           len(taskids) / elapsed,
+                                           reference / elapsed)
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        shutil.rmtree(basedir)
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Compare the latency and CPU cost of XML-RPC and the binary transport.
+
+A host accepting tasks is served in this process with each transport, 
+and tasks with observing results of several sizes are passed
+to it, as the server does.
+'''
+
+import os
+import time
+import threading
+import argparse
+
+from pontifex.txrServer import txrServer
+from pontifex.transport import BinaryServer, make_proxy, pack, unpack
+
+parser = argparse.ArgumentParser(description='Transport benchmark')
+parser.add_argument('-n', '--calls', type=int, default=500,
+                    help='Number of tasks passed with each transport and size')
+parser.add_argument('-s', '--sizes', default='10,1000,10000',
+                    help='Comma separated list of the number of frames '
+                    'in the observing result')
+args = parser.parse_args()
+
+
+class BenchResult(object):
+    def __init__(self, nframes):
+        self.instrument = 'BENCH'
+        self.mode = 'bench'
+        self.frames = [('r%08d.fits' % i, 'OBJECT', 10.0) for i in range(nframes)]
+
+class BenchHost(object):
+    def pass_info(self, taskid, bspec, bpob):
+        unpack(bspec)
+        unpack(bpob)
+        return True
+
+def serve(server):
+    server.register_function(BenchHost().pass_info)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def measure(proxy, nframes):
+    spec = {'recipe': 'emir.recipes.BiasRecipe', 'version': 1,
+            'parameters': {'bias': 'master_bias.fits', 'iterations': 3}}
+    ob = BenchResult(nframes)
+    before = os.times()
+    start = time.time()
+    for taskid in range(args.calls):
+        proxy.pass_info(taskid, pack(proxy, spec), pack(proxy, ob))
+    elapsed = time.time() - start
+    after = os.times()
+    cpu = (after[0] - before[0]) + (after[1] - before[1])
+    return elapsed / args.calls, cpu / args.calls
+
+servers = [serve(txrServer(('127.0.0.1', 0), allow_none=True, logRequests=False)),
+           serve(BinaryServer(('127.0.0.1', 0)))]
+proxies = [('xmlrpc', make_proxy('http://127.0.0.1:%d' % servers[0].server_address[1])),
+           ('binary', make_proxy('bin://127.0.0.1:%d' % servers[1].server_address[1]))]
+
+# client and host run in this process, 
+# the CPU time is the cost of both ends
+print '%8s %8s %14s %14s' % ('frames', 'transport', 'latency (us)', 'cpu (us)')
+for nframes in [int(size) for size in args.sizes.split(',')]:
+    for name, proxy in proxies:
+        latency, cpu = measure(proxy, nframes)
+        print '%8d %8s %14.1f %14.1f' % (nframes, name, latency * 1e6, cpu * 1e6)
+
+for name, proxy in proxies:
+    proxy.close()
+for server in servers:
+    server.shutdown()
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Check the plans of the hot queries on a big database.
+
+A sqlite database is seeded with frames, tasks, products and
+context values, and the plans of the queries run for each task
+are printed. The exit status is 1 if any of them scans a whole
+table or sorts its rows.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+parser = argparse.ArgumentParser(description='Query plan check')
+parser.add_argument('-f', '--frames', type=int, default=1000000,
+                    help='Number of frames')
+parser.add_argument('-t', '--tasks', type=int, default=100000,
+                    help='Number of tasks')
+parser.add_argument('-p', '--products', type=int, default=100000,
+                    help='Number of products')
+parser.add_argument('-c', '--contexts', type=int, default=10000,
+                    help='Number of context values')
+args = parser.parse_args()
+
+# pontifex.model creates its directories in the working directory
+basedir = tempfile.mkdtemp(prefix='pontifex-plans-')
+os.chdir(basedir)
+
+from sqlalchemy import create_engine
+
+import pontifex.model as model
+from pontifex.model import Session, Frame, ContextValue
+from pontifex.model import DataProcessingTask, DataProduct
+from pontifex.model.dataproc import data_product_context
+from pontifex.model.plans import hot_queries, explain, check_plans
+
+_CHUNK = 10000
+
+def insert(engine, table, count, row):
+    '''Insert count rows, row(i) returns the values of the i-th.'''
+    for first in range(0, count, _CHUNK):
+        rows = [row(i) for i in range(first, min(first + _CHUNK, count))]
+        engine.execute(table.insert(), rows)
+
+def seed(engine):
+    # ten frames by observation result
+    insert(engine, Frame.__table__, args.frames, lambda i: 
+           {'name': 'r%08d.fits' % i, 'object': 'bias', 'exposure': 0.0,
+            'imgtype': 'BIAS', 'racoor': 0.0, 'deccoor': 0.0,
+            'obsresult_id': i // 10 + 1})
+    # most tasks are finished
+    insert(engine, DataProcessingTask.__table__, args.tasks, lambda i: 
+           {'state': 4 if i % 100 else 1, 'waiting': False,
+            'obsresult_node_id': i + 1, 'pset_name': 'default',
+            'instrument_id': ('EMIR', 'MEGARA', 'OTHER')[i % 3]})
+    insert(engine, DataProduct.__table__, args.products, lambda i: 
+           {'datatype': 'emir.dataproducts.Master%d' % (i % 20),
+            'reference': 'p%08d.fits' % i, 'pset_name': 'default',
+            'instrument_id': ('EMIR', 'MEGARA')[i % 2]})
+    insert(engine, ContextValue.__table__, args.contexts, lambda i: 
+           {'description_id': i % 50 + 1, 'value': 'v%d' % i})
+    # most products have a context value
+    insert(engine, data_product_context, args.products, lambda i:
+           {'data_product_id': i + 1, 'context_id': i % args.contexts + 1})
+    engine.execute('ANALYZE')
+
+def main():
+    # without foreign keys, the rows are inserted alone
+    engine = create_engine('sqlite:///%s' % os.path.join(basedir, 'plans.sqlite'))
+    model.init_model(engine)
+    model.metadata.create_all(engine)
+
+    start = time.time()
+    seed(engine)
+    print 'seeded %d frames, %d tasks, %d products and %d context values in %.1f s' % (
+                args.frames, args.tasks, args.products, args.contexts, 
+                time.time() - start)
+
+    session = Session()
+    for name, query in hot_queries(session):
+        start = time.time()
+        session.execute(getattr(query, 'statement', query)).fetchall()
+        elapsed = time.time() - start
+        print '%s (%.2f ms):' % (name, elapsed * 1000)
+        for detail in explain(session, query):
+            print '    %s' % detail
+
+    degraded = check_plans(session)
+    for name, _ in degraded:
+        print 'degraded plan: %s' % name
+    return 1 if degraded else 0
+
+if __name__ == '__main__':
+    try:
+        status = main()
+    finally:
+        shutil.rmtree(basedir)
+    sys.exit(status)
@@ -67,10 +67,10 @@ user.status = 1
 user.usertype = 1
 session.add(user)
 
-channel = Channel(name='default')
+channel = Channel(name='default', priority=0)
 session.add(channel)
 
-channel = Channel(name='fast')
+channel = Channel(name='fast', priority=10)
 session.add(channel)
 
 fridaconf = {'name': 'FRIDA'}
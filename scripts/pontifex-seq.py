@@ -66,7 +66,7 @@ def create_reduction_tree(oresult, parent):
 #                'instrument': ins.name,
 #                'observing_mode': oblock.observing_mode,
 #              }
-#    ptask.request = str(request)
+#    ptask.request = request
     for child in oresult.children:
         create_reduction_tree(child, ptask)
     return ptask
@@ -0,0 +1,110 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Lookup of the calibrations required by the recipes.
+
+A product matches a requirement if it has the instrument, datatype
+and processing set required, and all its context values are in
+the context of the observation. The newest of them is chosen.
+
+The match is found in one query, using the index of the products
+by instrument, datatype and processing set, and the primary key of
+their context values. The answers are kept until a product of the
+same instrument, datatype and processing set is committed in this
+process.
+'''
+
+import logging
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from pontifex.model import maker, DataProduct
+from pontifex.model.dataproc import matching_products
+
+_logger = logging.getLogger("pontifex.calibration")
+
+class CalibrationIndex(object):
+    '''The newest product matching a requirement, memoized.'''
+    def __init__(self):
+        super(CalibrationIndex, self).__init__()
+        # (instrument, datatype, pset) -> {context ids: product id or None}
+        self.cache = {}
+        # changed each time the answers for a key are forgotten
+        self.generation = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, session, instrument, datatype, pset, context):
+        '''The newest product matching, or None.
+
+        context is a list of ContextValue.
+        '''
+        key = (instrument, datatype, pset)
+        signature = frozenset(value.id for value in context)
+        with self.lock:
+            matches = self.cache.get(key, {})
+            cached = signature in matches
+            if cached:
+                self.hits += 1
+                productid = matches[signature]
+            generation = self.generation.get(key, 0)
+        if not cached:
+            stmt = matching_products(instrument, datatype, pset, sorted(signature))
+            productid = session.execute(stmt.limit(1)).scalar()
+            with self.lock:
+                self.misses += 1
+                # unless a product has been committed meanwhile
+                if self.generation.get(key, 0) == generation:
+                    self.cache.setdefault(key, {})[signature] = productid
+        if productid is None:
+            return None
+        return session.query(DataProduct).get(productid)
+
+    def invalidate(self, keys):
+        '''Forget the answers for (instrument, datatype, pset) keys.'''
+        with self.lock:
+            for key in keys:
+                self.cache.pop(key, None)
+                self.generation[key] = self.generation.get(key, 0) + 1
+
+calibrations = CalibrationIndex()
+
+# The products inserted in a flush are collected in the session
+# and the answers for their types forgotten once committed
+
+@event.listens_for(DataProduct, 'after_insert')
+def _collect_product(mapper, connection, target):
+    key = (target.instrument_id, target.datatype, target.pset_name)
+    object_session(target).info.setdefault('new_products', set()).add(key)
+
+@event.listens_for(maker, 'after_commit')
+def _forget_products(session):
+    keys = session.info.pop('new_products', None)
+    if keys:
+        _logger.debug('new calibrations of %s', sorted(keys))
+        calibrations.invalidate(keys)
+
+@event.listens_for(maker, 'after_rollback')
+def _discard_products(session):
+    session.info.pop('new_products', None)
@@ -0,0 +1,160 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''A server and its hosts running in one process.
+
+The server and the hosts talk through the loopback transport,
+with the same calls they make through the network, so whole
+runs can be tested and measured without sockets, configuration
+files or signal handlers.
+
+The model must be bound to a database before creating the cluster,
+see create_database. Each thread has a fixed name and they are
+started and joined in a fixed order.
+'''
+
+import os
+import time
+import logging
+import threading
+
+from sqlalchemy import create_engine
+
+import pontifex.model as model
+from pontifex.model import Session, DataProcessingTask, FINISHED, ERROR
+from pontifex.transport import LoopbackServer
+from pontifex.server import PontifexServer
+from pontifex.host import PontifexHost
+
+_logger = logging.getLogger("pontifex.cluster")
+
+# functions of the server called by the hosts and the clients
+SERVER_FUNCTIONS = ['register', 'unregister', 'fetch_task', 'receiver',
+                    'receiver_many', 'heartbeat', 'notify_ready',
+                    'upload_begin', 'upload_chunk', 'upload_end', 'download',
+                    'transfers', 'version', 'run', 'pset_create']
+
+# functions of the hosts called by the server
+HOST_FUNCTIONS = ['pass_info', 'pass_info_many', 'version']
+
+def create_database(basedir):
+    '''Bind the model to a new sqlite database in basedir.'''
+    path = os.path.join(os.path.abspath(basedir), 'pontifex.sqlite')
+    engine = create_engine('sqlite:///%s' % path, echo=False)
+    engine.execute('pragma foreign_keys=on')
+    model.init_model(engine)
+    model.metadata.create_all(engine)
+    return engine
+
+class LoopbackHost(PontifexHost):
+    '''A host registered with the loopback transport.'''
+    def register(self):
+        if self.pull:
+            super(LoopbackHost, self).register()
+        else:
+            self.rserver.register(self.cid, self.host, self.port,
+                                  self.capabilities, self.slots, 'loop')
+
+class LocalCluster(object):
+    '''A server and nhosts hosts with slots slots each.
+
+    The hosts run the tasks of the instruments in capabilities,
+    host_options are passed to PontifexHost. The other keyword 
+    arguments are passed to the server.
+    '''
+    def __init__(self, nhosts=2, slots=1, capabilities=None, dispatchers=1,
+                 pull=False, heartbeat=10, sweep=60, host_options=None, **kwds):
+        super(LocalCluster, self).__init__()
+        self.dispatchers = dispatchers
+        self.heartbeat = heartbeat
+        self.sweep = sweep
+        self.threads = []
+
+        self.server = PontifexServer(**kwds)
+        self.endpoints = [LoopbackServer(('server', 1))]
+        for name in SERVER_FUNCTIONS:
+            self.endpoints[0].register_function(getattr(self.server, name), name)
+
+        self.hosts = []
+        for i in range(nhosts):
+            address = ('host%d' % i, i + 1)
+            endpoint = LoopbackServer(address)
+            host = LoopbackHost('loop://server:1', address[0], address[1],
+                                slots, pull=pull, capabilities=capabilities,
+                                **(host_options or {}))
+            for name in HOST_FUNCTIONS:
+                endpoint.register_function(getattr(host, name), name)
+            self.endpoints.append(endpoint)
+            self.hosts.append(host)
+
+    def _start(self, name, target, *args):
+        thread = threading.Thread(target=target, args=args, name=name)
+        thread.start()
+        self.threads.append(thread)
+
+    def start(self):
+        '''Start the threads of the server and the hosts.'''
+        self._start('watchdog', self.server.watchdog, self.sweep)
+        self._start('inserter', self.server.inserter)
+        self._start('reaper', self.server.reaper)
+        for i in range(self.dispatchers):
+            self._start('consumer-%d' % i, self.server.consumer)
+        for host in self.hosts:
+            self._start('%s-worker' % host.host, host.worker)
+            self._start('%s-heartbeat' % host.host, host.heartbeat,
+                        self.heartbeat)
+            if host.pull:
+                self._start('%s-puller' % host.host, host.puller)
+
+    def run(self, obsid, pset='default', channel='default'):
+        '''Create the tasks of an observing block, return the root task id.'''
+        return self.server.run(obsid, pset, channel)
+
+    def wait(self, taskids, timeout=60):
+        '''Wait up to timeout seconds for the tasks to end.
+
+        Returns a dictionary of the states of the tasks.
+        '''
+        session = Session()
+        deadline = time.time() + timeout
+        while True:
+            states = dict(session.query(DataProcessingTask.id,
+                                        DataProcessingTask.state).filter(
+                                DataProcessingTask.id.in_(taskids)))
+            # a new transaction in the next query
+            session.commit()
+            pending = [taskid for taskid, state in states.items()
+                       if state not in (FINISHED, ERROR)]
+            if not pending or time.time() > deadline:
+                return states
+            time.sleep(0.01)
+
+    def stop(self):
+        '''Stop the hosts and the server and join their threads.'''
+        for host in self.hosts:
+            host.quit()
+        self.server.quit()
+        for thread in self.threads:
+            thread.join()
+        for endpoint in self.endpoints:
+            endpoint.shutdown()
+            endpoint.server_close()
+        _logger.info('cluster stopped')
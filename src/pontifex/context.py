@@ -0,0 +1,77 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Execution context of a task.
+
+The working directory is global to the process, so tasks
+prepared or run concurrently in threads must not change it.
+The directories of each task are passed as explicit paths and
+the recipes, that expect to find their inputs in the working
+directory, are run in processes of their own.
+'''
+
+import os
+import multiprocessing
+
+class TaskContext(object):
+    '''Directories of a task.'''
+    def __init__(self, taskdir, taskid):
+        super(TaskContext, self).__init__()
+        self.taskid = taskid
+        self.basedir = os.path.join(os.path.abspath(taskdir), str(taskid))
+        self.workdir = os.path.join(self.basedir, 'work')
+        self.resultsdir = os.path.join(self.basedir, 'results')
+
+    def create(self):
+        '''Create the directories, if they don't exist.'''
+        for dirname in [self.basedir, self.workdir, self.resultsdir]:
+            if not os.path.isdir(dirname):
+                os.mkdir(dirname)
+
+    def work(self, name):
+        '''Path of a file in the work directory.'''
+        return os.path.join(self.workdir, name)
+
+    def results(self, name):
+        '''Path of a file in the results directory.'''
+        return os.path.join(self.resultsdir, name)
+
+def call_in_directory(workdir, fun, *args):
+    '''Call fun(*args) with workdir as working directory.
+
+    This changes the working directory of the process, so it
+    must only be called in processes running one task at a time.
+    '''
+    csd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        return fun(*args)
+    finally:
+        os.chdir(csd)
+
+def call_in_child(workdir, fun, *args):
+    '''Call fun(*args) in a child process with workdir as working directory.'''
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(call_in_directory, (workdir, fun) + args)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,156 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Transfer of the inputs of the tasks to hosts without shared storage.
+
+The hosts that don't mount the data directories of the server
+download the frames and products staged for their tasks from the
+content store of the server. They are sent in chunks, compressed
+with zlib at the level requested by each host, so each link can
+trade CPU for bandwidth. Chunks that don't shrink are sent as they are.
+
+The hosts keep the downloaded files in their own content store,
+a cache shared by all their slots, and stage them from there.
+'''
+
+import os
+import re
+import time
+import zlib
+import logging
+import tempfile
+import threading
+import xmlrpclib
+
+from pontifex.store import ContentStore, file_digest
+
+_logger = logging.getLogger("pontifex.download")
+
+CHUNK = 1 << 20
+
+_DIGEST = re.compile('^[0-9a-f]{40}$')
+
+class TransferStats(object):
+    '''Bytes transferred through a link.
+
+    seconds is the time spent in the transfers, as seen
+    by the side counting them.
+    '''
+    def __init__(self):
+        super(TransferStats, self).__init__()
+        self.files = 0
+        # bytes of the files and bytes sent
+        self.raw = 0
+        self.sent = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, raw, sent, seconds, files=0):
+        with self.lock:
+            self.files += files
+            self.raw += raw
+            self.sent += sent
+            self.seconds += seconds
+
+    def report(self):
+        '''A dictionary with the counters, the ratio and the rate in bytes/s.'''
+        with self.lock:
+            ratio = float(self.sent) / self.raw if self.raw else 1.0
+            rate = self.sent / self.seconds if self.seconds else 0.0
+            return {'files': self.files, 'raw': self.raw, 'sent': self.sent,
+                    'seconds': self.seconds, 'ratio': ratio, 'rate': rate}
+
+def read_chunk(store, digest, offset, size, level=0):
+    '''Read a chunk of a stored file, compressed with level.
+
+    Returns the level used, 0 if the chunk is not compressed,
+    the data and the size of the chunk before compressing it.
+    '''
+    if not _DIGEST.match(digest):
+        raise ValueError('invalid digest %r' % digest)
+    with open(store.path(digest), 'rb') as fd:
+        fd.seek(offset)
+        data = fd.read(size)
+    if level > 0 and data:
+        packed = zlib.compress(data, level)
+        if len(packed) < len(data):
+            return level, packed, len(data)
+    return 0, data, len(data)
+
+class InputCache(object):
+    '''Inputs of tasks downloaded from the server.
+
+    proxy is a proxy of the server, level the compression
+    level requested, 0 for none.
+    '''
+    def __init__(self, cachedir, proxy, hostid, level=1, chunk=CHUNK):
+        super(InputCache, self).__init__()
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.store = ContentStore(cachedir)
+        self.proxy = proxy
+        self.hostid = hostid
+        self.level = level
+        self.chunk = chunk
+        self.stats = TransferStats()
+
+    def _download(self, digest):
+        start = time.time()
+        raw = sent = 0
+        fd, tmpname = tempfile.mkstemp(dir=self.store.basedir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    level, data = self.proxy.download(self.hostid, digest, raw,
+                                                      self.chunk, self.level)
+                    if isinstance(data, xmlrpclib.Binary):
+                        data = data.data
+                    sent += len(data)
+                    if level > 0:
+                        data = zlib.decompress(data)
+                    if not data:
+                        break
+                    out.write(data)
+                    raw += len(data)
+            if file_digest(tmpname) != digest:
+                raise IOError('download of %s is corrupted' % digest)
+            # several slots may download the same file,
+            # it is renamed in the store
+            self.store.add(tmpname, digest)
+        finally:
+            os.unlink(tmpname)
+        self.stats.add(raw, sent, time.time() - start, 1)
+        return raw, sent
+
+    def stage(self, inputs, dstdir):
+        '''Stage a list of (name, digest, size) in directory dstdir.
+
+        The files not in the cache are downloaded first.
+        Returns the bytes of the files downloaded and the bytes received.
+        '''
+        raw = sent = 0
+        for name, digest, _ in inputs:
+            if digest not in self.store:
+                r, s = self._download(digest)
+                raw += r
+                sent += s
+            self.store.stage(digest, dstdir, name)
+        return raw, sent
@@ -0,0 +1,281 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Event loop XML-RPC server.
+
+One thread serves all the connections with asyncore, so many
+clients can stay connected without a thread each. The calls
+are run in a bounded pool of threads, as they may access
+the database. Long polls are registered with register_deferred
+and wait in the loop, without taking a thread.
+'''
+
+import os
+import time
+import heapq
+import socket
+import asyncore
+import asynchat
+import logging
+import threading
+import xmlrpclib
+from Queue import Queue
+from collections import deque
+
+_logger = logging.getLogger("pontifex.eventserver")
+
+class Executor(object):
+    '''A bounded pool of threads running calls.'''
+    def __init__(self, workers=8):
+        super(Executor, self).__init__()
+        self.queue = Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name='executor-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, fun, args, callback):
+        '''Call fun(*args) in a thread, then callback(ok, result or error).'''
+        self.queue.put((fun, args, callback))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            fun, args, callback = item
+            try:
+                result = fun(*args)
+            except Exception as error:
+                callback(False, error)
+            else:
+                callback(True, result)
+
+    def shutdown(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+class _Waker(asyncore.file_dispatcher):
+    '''Run functions in the loop, called from other threads.'''
+    def __init__(self, map):
+        rfd, self.wfd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, rfd, map)
+        os.close(rfd)
+        self.pending = deque()
+
+    def call(self, fun, *args):
+        self.pending.append((fun, args))
+        os.write(self.wfd, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while self.pending:
+            fun, args = self.pending.popleft()
+            fun(*args)
+
+class _Channel(asynchat.async_chat):
+    '''A connection with an XML-RPC client, over HTTP/1.1.'''
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, server.map)
+        self.server = server
+        self.incoming = []
+        self.headers = None
+        # one request at a time, the client waits for the response
+        self.busy = False
+        self.set_terminator('\r\n\r\n')
+
+    def readable(self):
+        return not self.busy and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self.incoming)
+        self.incoming = []
+        if self.headers is None:
+            self.headers = data.split('\r\n')
+            length = 0
+            for line in self.headers[1:]:
+                key, _, value = line.partition(':')
+                if key.strip().lower() == 'content-length':
+                    length = int(value)
+            if length > 0:
+                self.set_terminator(length)
+                return
+            data = ''
+        self._request(data)
+
+    def _request(self, body):
+        headers, self.headers = self.headers, None
+        self.set_terminator('\r\n\r\n')
+        request = headers[0].split()
+        if len(request) != 3 or request[0] != 'POST':
+            self.push('HTTP/1.0 501 Not Implemented\r\nContent-Length: 0\r\n\r\n')
+            self.close_when_done()
+            return
+        connection = ''
+        for line in headers[1:]:
+            key, _, value = line.partition(':')
+            if key.strip().lower() == 'connection':
+                connection = value.strip().lower()
+        if request[2] == 'HTTP/1.1':
+            keepalive = connection != 'close'
+        else:
+            keepalive = connection == 'keep-alive'
+        self.busy = True
+        self.server.dispatch(self, body, keepalive)
+
+    def respond(self, body, keepalive):
+        self.busy = False
+        if not self.connected:
+            return
+        header = ['HTTP/1.1 200 OK', 'Content-Type: text/xml',
+                  'Content-Length: %d' % len(body)]
+        if not keepalive:
+            header.append('Connection: close')
+        self.push('\r\n'.join(header) + '\r\n\r\n' + body)
+        if not keepalive:
+            self.close_when_done()
+
+    def handle_error(self):
+        _logger.exception('error in connection')
+        self.close()
+
+class EventServer(asyncore.dispatcher):
+    '''Serve registered functions through XML-RPC from an event loop.
+
+    The functions registered with register_function are called
+    in a pool of workers threads. Those registered with
+    register_deferred are called in the loop, with a function
+    to call with the result as first argument. They must not block,
+    and may return (timeout, expire), a function to call
+    after timeout seconds if there is no result yet.
+    '''
+    def __init__(self, addr, workers=8, allow_none=False):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(addr)
+        self.listen(128)
+        self.server_address = self.socket.getsockname()
+        self.allow_none = allow_none
+        self.funcs = {}
+        self.deferred = {}
+        self.executor = Executor(workers)
+        self.waker = _Waker(self.map)
+        self.timers = []
+        self.running = False
+
+    def register_function(self, function, name=None):
+        if name is None:
+            name = function.__name__
+        self.funcs[name] = function
+
+    def register_deferred(self, function, name):
+        self.deferred[name] = function
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _Channel(self, pair[0])
+
+    def _marshal(self, ok, value):
+        if ok:
+            try:
+                return xmlrpclib.dumps((value,), methodresponse=True,
+                                       allow_none=self.allow_none)
+            except Exception as error:
+                value = error
+        if not isinstance(value, xmlrpclib.Fault):
+            value = xmlrpclib.Fault(1, '%s:%s' % (value.__class__.__name__, value))
+        return xmlrpclib.dumps(value, allow_none=self.allow_none)
+
+    def dispatch(self, channel, body, keepalive):
+        '''Call the function requested by a client.'''
+        replied = []
+        def reply(ok, value):
+            # only the first reply is sent
+            if replied:
+                return
+            replied.append(True)
+            # marshalled in this thread, not in the loop
+            body = self._marshal(ok, value)
+            self.waker.call(channel.respond, body, keepalive)
+
+        try:
+            params, method = xmlrpclib.loads(body)
+        except Exception as error:
+            reply(False, error)
+            return
+
+        if method in self.deferred:
+            try:
+                timer = self.deferred[method](lambda value: reply(True, value), *params)
+            except Exception as error:
+                reply(False, error)
+                return
+            if timer is not None:
+                timeout, expire = timer
+                heapq.heappush(self.timers, (time.time() + timeout, expire))
+        elif method in self.funcs:
+            self.executor.submit(self.funcs[method], params, reply)
+        else:
+            reply(False, Exception('method "%s" is not supported' % method))
+
+    def _run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, expire = heapq.heappop(self.timers)
+            try:
+                expire()
+            except Exception:
+                _logger.exception('error in timer')
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            timeout = 1.0
+            if self.timers:
+                timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+            asyncore.loop(timeout=timeout, use_poll=True, map=self.map, count=1)
+            self._run_timers()
+        # expire the waiting calls and close the connections
+        for _, expire in self.timers:
+            expire()
+        self.timers = []
+        asyncore.close_all(self.map)
+        os.close(self.waker.wfd)
+        self.executor.shutdown()
+
+    def shutdown(self):
+        '''Stop serve_forever, from other thread.'''
+        def stop():
+            self.running = False
+        self.waker.call(stop)
@@ -20,16 +20,27 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 
 
+import sys
+import time
 import logging
+import threading
 from Queue import Queue
-import xmlrpclib
+from collections import OrderedDict
 import os.path
 import uuid
+import signal
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
 import cPickle as pickle
 
 import yaml
 
 from numina.core import import_object
+
+from pontifex.context import TaskContext, call_in_directory, call_in_child
+from pontifex.transport import make_proxy, unpack
+from pontifex.upload import Uploader, product_name
+from pontifex.download import InputCache
 from numina.core import obsres_from_dict
 #from numina.recipes.requirements import Names
 
@@ -45,8 +56,6 @@ def main_internal(cls, obsres,
     runinfo, 
     workdir=None):
 
-    csd = os.getcwd()
-
     if workdir is not None:
         workdir = os.path.abspath(workdir)
 
@@ -58,18 +67,14 @@ def main_internal(cls, obsres,
                     requirements=requirements,
                     runinfo=runinfo)
 
-    os.chdir(workdir)
-    try:
-        result = recipe(obsres)
-    finally:
-        os.chdir(csd)
+    if workdir is None:
+        return recipe(obsres)
 
-    return result
+    # the working directory of this process is not changed
+    return call_in_child(workdir, recipe, obsres)
 
 def run_recipe_from_file_(taskid, taskdir, config, obsres, names):
-    basedir = os.path.join(taskdir, str(taskid))
-    workdir = os.path.join(basedir, 'work')
-    resultsdir = os.path.join(basedir, 'results')
+    ctx = TaskContext(taskdir, taskid)
 
     task_control = config
     
@@ -91,8 +96,8 @@ def run_recipe_from_file_(taskid, taskdir, config, obsres, names):
     _logger.debug('creating runinfo')
             
     runinfo = {}
-    runinfo['workdir'] = workdir
-    runinfo['resultsdir'] = resultsdir
+    runinfo['workdir'] = ctx.workdir
+    runinfo['resultsdir'] = ctx.resultsdir
     runinfo['entrypoint'] = RecipeClass
     
     # Set custom logger
@@ -102,39 +107,387 @@ def run_recipe_from_file_(taskid, taskdir, config, obsres, names):
     processing_log = 'processing.log'
 
     _logger.debug('creating custom logger "%s"', processing_log)
-    os.chdir(resultsdir)
-    fh = logging.FileHandler(processing_log)
+    fh = logging.FileHandler(ctx.results(processing_log))
     fh.setLevel(logging.DEBUG)
     fh.setFormatter(_recipe_formatter)
     _recipe_logger.addHandler(fh)
     
     result = main_internal(RecipeClass, obsres, ins_pars, names, 
-                                runinfo, workdir=workdir)
+                                runinfo, workdir=ctx.workdir)
 
     _recipe_logger.removeHandler(fh)
 
     return result
 
+class RecipeCache(object):
+    '''Imported recipe classes and their instances.
+
+    Instances are kept by recipe, version and parameters, and
+    the least recently used are evicted when there are more than size.
+    When the version of a recipe changes, its module is imported again.
+    '''
+    def __init__(self, size=32):
+        super(RecipeCache, self).__init__()
+        self.size = size
+        self.classes = {}
+        self.instances = OrderedDict()
+
+    def _class(self, fqn, version):
+        cached = self.classes.get(fqn)
+        if cached is not None:
+            if cached[0] == version:
+                return cached[1]
+            _logger.info('recipe %s changed to version %s', fqn, version)
+            for key in [key for key in self.instances if key[0] == fqn]:
+                del self.instances[key]
+            modname = fqn.rsplit('.', 1)[0]
+            if modname in sys.modules:
+                reload(sys.modules[modname])
+        cls = import_object(fqn)
+        self.classes[fqn] = (version, cls)
+        return cls
+
+    def get(self, fqn, version, parameters):
+        '''An instance of recipe fqn, configured with parameters.'''
+        key = (fqn, version, repr(sorted(parameters.items())))
+        recipe = self.instances.pop(key, None)
+        if recipe is None:
+            _logger.debug('creating recipe %s', fqn)
+            recipe = self._class(fqn, version)()
+            if parameters:
+                recipe.configure(requirements=parameters)
+            if len(self.instances) >= self.size:
+                self.instances.popitem(last=False)
+        self.instances[key] = recipe
+        return recipe
+
+# recipes of a slot process, each slot has its own
+_recipes = RecipeCache()
+
+# inputs downloaded by a slot process, if the host downloads them
+_inputs = None
+
+# the slot process tells the host which task it runs, it is 
+# written at once, so the message is not lost if the slot dies
+_started = None
+
+def _init_slot(started, master=None, hostid=None, cachedir=None, level=1):
+    global _inputs, _started
+    # the host process handles the signals
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _started = started
+    if master is not None:
+        _inputs = InputCache(cachedir, make_proxy(master, 1), hostid, level)
+
+def _product_files(result):
+    '''Names of the files of the products in a result.'''
+    names = []
+    for pr in result.get('products', []):
+        try:
+            prod = yaml.load(pr, Loader=yaml.Loader)
+            names.append(product_name(prod.filename))
+        except Exception as error:
+            _logger.warning('product without file: %s', error)
+    return names
+
+def _error(error):
+    return {'error': {'type': error.__class__.__name__, 
+                      'message': str(error)}}
+
+def _run_recipe(taskid, spec, obsres, taskdir):
+    _logger.info('processing taskid=%d', taskid)
+    ctx = TaskContext(taskdir, taskid)
+    _logger.debug('Basedir: %s', ctx.basedir)
+    _logger.debug('Workdir: %s', ctx.workdir)
+    _logger.debug('Resultsdir: %s', ctx.resultsdir)                
+
+    if _inputs is not None and spec.get('inputs'):
+        start = time.time()
+        ctx.create()
+        try:
+            raw, sent = _inputs.stage(spec['inputs'], ctx.workdir)
+        except Exception as error:
+            _logger.warning('cannot download the inputs of taskid=%d: %s', 
+                            taskid, error)
+            return _error(error)
+        elapsed = time.time() - start
+        if raw:
+            rate = sent / max(elapsed, 1e-6) / 1e6
+            _logger.info('taskid=%d downloaded %d bytes, received %d (%.0f%%) '
+                         'in %.2f s, %.1f MB/s', taskid, raw, sent, 
+                         100.0 * sent / raw, elapsed, rate)
+
+    try:
+        recipe = _recipes.get(spec['recipe'], spec['version'], spec['parameters'])
+    except Exception as error:
+        _logger.warning('cannot create recipe %s: %s', spec['recipe'], error)
+        return _error(error)
+
+    _recipe_logger = recipe.logger
+    _recipe_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    processing_log = 'processing.log'
+
+    _logger.debug('creating custom logger "%s"', processing_log)
+    fh = logging.FileHandler(ctx.results(processing_log))
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(_recipe_formatter)
+    _recipe_logger.addHandler(fh)
+    
+    # each slot is a process running one task at a time, 
+    # so the recipe can run in the work directory
+    try:
+        result = call_in_directory(ctx.workdir, recipe, obsres)
+    except Exception as error:
+        _logger.warning('error in taskid=%d: %s', taskid, error)
+        result = _error(error)
+    finally:
+        _recipe_logger.removeHandler(fh)
+        fh.close()
+
+    if isinstance(result, dict) and 'error' not in result:
+        result['files'] = _product_files(result)
+
+    _logger.info('finished')
+    return result
+
+def run_recipe(taskid, spec, obsres, taskdir):
+    '''Run a recipe in its task directory, in a slot process.
+
+    spec has the name of the recipe, its version and its parameters.
+    The pool doesn't pass errors to the host in Python 2.7, so 
+    they are returned as results with an error, as are the 
+    results that can't be returned from the slot.
+    '''
+    if _started is not None:
+        _started.put((taskid, os.getpid()))
+    try:
+        result = _run_recipe(taskid, spec, obsres, taskdir)
+        # the pool pickles the result to return it
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception as error:
+        _logger.warning('error in taskid=%d: %s', taskid, error)
+        result = _error(error)
+    return result
+
+class ResultBuffer(object):
+    '''Results of finished tasks, sent to the server in batches.
+
+    The buffered results are passed to flush when there are
+    size of them, or when the first of them has waited delay seconds.
+    '''
+    def __init__(self, flush, size=16, delay=0.5):
+        super(ResultBuffer, self).__init__()
+        self.flush = flush
+        self.size = size
+        self.delay = delay
+        self.results = []
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='results')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, taskid, result):
+        with self.cond:
+            self.results.append((taskid, result))
+            if len(self.results) == 1 or len(self.results) >= self.size:
+                self.cond.notify()
+
+    def close(self):
+        '''Send the buffered results and stop.'''
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.results and not self.closed:
+                    self.cond.wait()
+                deadline = time.time() + self.delay
+                while len(self.results) < self.size and not self.closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                results, self.results = self.results, []
+                closed = self.closed
+            if results:
+                _logger.info('sending back to server %d results', len(results))
+                try:
+                    self.flush(results)
+                except Exception as error:
+                    _logger.warning('cannot send results of %s: %s', 
+                                    [taskid for taskid, _ in results], error)
+            if closed:
+                return
+
 class PontifexHost(object):
-    def __init__(self, master, host, port):
+    '''A host running recipes.
+
+    The host listens in port with XML-RPC and, if binport is given,
+    with the binary transport in binport, that is used by the server
+    to send the tasks. master is the url of the server, with
+    the scheme http or bin.
+
+    The results are sent back in batches of up to batch results,
+    waiting no more than delay seconds to fill a batch.
+    The host keeps its lease in the server sending heartbeats
+    with the ids of the tasks it is running.
+
+    If pull is True, the host fetches its tasks from the 
+    server when it has free slots, instead of waiting for them.
+    If upload is True, the products are uploaded to the server,
+    for hosts that don't share its filesystem. If download is True, 
+    the inputs of the tasks are downloaded from the server, compressed
+    with level compress, and kept in cachedir. capabilities are the 
+    instruments whose tasks the host runs.
+    '''
+    def __init__(self, master, host, port, slots=None, binport=None, 
+                 batch=16, delay=0.5, pull=False, upload=False,
+                 download=False, compress=1, cachedir='cache', 
+                 capabilities=None):
         super(PontifexHost, self).__init__()
         uid = uuid.uuid5(uuid.NAMESPACE_URL, 'http://%s:%d' % (host, port))
         self.cid = uid.hex
         self.host = host
         self.port = port
-        self.rserver = xmlrpclib.ServerProxy(master)
-        self.rserver.register(self.cid, host, port, ['EMIR', 'MEGARA'])
+        if slots is None:
+            slots = multiprocessing.cpu_count()
+        self.slots = slots
+        self.taskdir = os.path.abspath('task')
+        # the tasks started by each slot process, by pid
+        self.started = SimpleQueue()
+        self.slot_of = {}
+        initargs = (self.started, )
+        if download:
+            if not os.path.isdir(self.taskdir):
+                os.mkdir(self.taskdir)
+            initargs += (master, self.cid, os.path.abspath(cachedir), compress)
+        # recipes run in a pool of processes, one per slot
+        self.pool = multiprocessing.Pool(slots, initializer=_init_slot, 
+                                         initargs=initargs)
+        self.binport = binport
+        self.pull = pull
+        if capabilities is None:
+            capabilities = ['EMIR', 'MEGARA']
+        self.capabilities = capabilities
+        self.rserver = make_proxy(master)
+        # tasks received and whose result has not been sent
+        self.running = set()
+        # tasks received and not finished, they take the slots
+        self.executing = set()
+        # executing tasks leased to other hosts
+        self.dropped = set()
+        self.lock = threading.Condition()
+        self.halt = threading.Event()
+        self.register()
+
+        self.results = ResultBuffer(self._flush, batch, delay)
+        self.uploader = None
+        if upload:
+            self.uploader = Uploader(self.rserver, self.cid)
 
         self.doned = False
         self.queue = Queue()
 
-        _logger.info('ready')
+        _logger.info('ready with %d slots', slots)
+
+    def register(self):
+        if self.pull:
+            self.rserver.register(self.cid, self.host, self.port, 
+                                  self.capabilities, self.slots, 'pull')
+        elif self.binport is None:
+            self.rserver.register(self.cid, self.host, self.port, 
+                                  self.capabilities, self.slots)
+        else:
+            self.rserver.register(self.cid, self.host, self.binport, 
+                                  self.capabilities, self.slots, 'bin')
+
+    def puller(self, timeout=30):
+        '''Fetch tasks from the server when there are free slots.'''
+        while not self.halt.is_set():
+            with self.lock:
+                while len(self.executing) >= self.slots and not self.halt.is_set():
+                    self.lock.wait(1)
+                free = self.slots - len(self.executing)
+            if self.halt.is_set():
+                break
+            try:
+                tasks = self.rserver.fetch_task(self.cid, self.capabilities, 
+                                                free, timeout)
+            except Exception as error:
+                _logger.warning('cannot fetch tasks: %s', error)
+                self.halt.wait(1)
+                continue
+            if tasks is False:
+                _logger.warning('not registered, registering again')
+                self.register()
+                continue
+            for taskid, bspec, bpob in tasks:
+                self.pass_info(taskid, bspec, bpob)
+        _logger.info('ending puller thread')
 
     def quit(self):
         _logger.info('ending')
+        self.halt.set()
         self.rserver.unregister(self.cid)
         self.queue.put(None)
 
+    def reap(self):
+        '''Return an error for the tasks of the slot processes that died.
+
+        The pool replaces a slot process that dies, but the 
+        result of its task never arrives.
+        '''
+        while not self.started.empty():
+            taskid, pid = self.started.get()
+            with self.lock:
+                if taskid in self.executing:
+                    self.slot_of[taskid] = pid
+        alive = set(process.pid for process in self.pool._pool 
+                        if process.is_alive())
+        with self.lock:
+            dead = [(taskid, pid) for taskid, pid in self.slot_of.items() 
+                        if pid not in alive]
+        for taskid, pid in dead:
+            _logger.warning('slot process %d died running taskid=%d', pid, taskid)
+            self._finished(taskid)(_error(OSError(
+                        'slot process %d died running the task' % pid)))
+
+    def heartbeat(self, interval):
+        '''Send the running tasks to the server every interval seconds.
+
+        The tasks of the slot processes that died are not running.
+        '''
+        while not self.halt.wait(interval):
+            self.reap()
+            with self.lock:
+                running = list(self.running)
+            try:
+                response = self.rserver.heartbeat(self.cid, running)
+                if response is False:
+                    _logger.warning('lease expired, registering again')
+                    self.register()
+                    response = self.rserver.heartbeat(self.cid, running)
+                if isinstance(response, list):
+                    self.drop(response)
+            except Exception as error:
+                _logger.warning('cannot send heartbeat: %s', error)
+        _logger.info('ending heartbeat thread')
+
+    def drop(self, taskids):
+        '''Forget tasks leased to other hosts, their results are not sent.'''
+        _logger.warning('dropping tasks %s, they belong to other hosts', taskids)
+        with self.lock:
+            for taskid in taskids:
+                if taskid in self.executing:
+                    self.dropped.add(taskid)
+                self.running.discard(taskid)
+
     def version(self):
         return '1.0'
 
@@ -143,59 +496,100 @@ class PontifexHost(object):
         _logger.debug('type of ObservingResult is %r', type(bpob))
         #nnames = Names(**names)
         nnames = {}
-        ob = pickle.loads(bpob.data)
+        ob = unpack(bpob)
         _logger.debug('type of ObservingResult now is %r', type(ob))
         self.queue.put((taskid, config, ob, nnames))
 
-    def pass_info(self, taskid, bprecipe, bpob):
+    def pass_info(self, taskid, bspec, bpob):
         _logger.info('received taskid=%d', taskid)
         _logger.debug('type of ObservingResult is %r', type(bpob))
-        recipe = pickle.loads(bprecipe.data)
-        ob = pickle.loads(bpob.data)
+        spec = unpack(bspec)
+        ob = unpack(bpob)
         _logger.debug('type of ObservingResult now is %r', type(ob))
-        self.queue.put((taskid, recipe, ob))
+        with self.lock:
+            self.running.add(taskid)
+            self.executing.add(taskid)
+            self.dropped.discard(taskid)
+        self.queue.put((taskid, spec, ob))
+
+    def pass_info_many(self, tasks):
+        '''Receive a list of (taskid, recipe spec, observing result).'''
+        for taskid, bspec, bpob in tasks:
+            self.pass_info(taskid, bspec, bpob)
+
+    def _flush(self, results):
+        try:
+            self.rserver.receiver_many(self.cid, results)
+        finally:
+            # if the results are lost, the leases of 
+            # the tasks expire and they are sent again
+            with self.lock:
+                for taskid, _ in results:
+                    self.running.discard(taskid)
+
+    def _uploaded(self, taskid, result):
+        def callback(digests):
+            if digests is None:
+                result.clear()
+                result['error'] = {'type': 'IOError', 
+                                   'message': 'cannot upload the products'}
+            else:
+                result['files'] = digests
+            self.results.add(taskid, result)
+        return callback
+
+    def _finished(self, taskid):
+        def callback(result):
+            with self.lock:
+                if taskid not in self.executing:
+                    # already reported, its slot died
+                    return
+                self.executing.discard(taskid)
+                self.slot_of.pop(taskid, None)
+                # a free slot, for the puller
+                self.lock.notify()
+                if taskid in self.dropped:
+                    self.dropped.discard(taskid)
+                    _logger.info('finished dropped taskid=%d', taskid)
+                    return
+            _logger.info('finished taskid=%d', taskid)
+            files = None
+            if isinstance(result, dict):
+                files = result.pop('files', None)
+            if files and self.uploader is not None:
+                # the slot runs the next task meanwhile
+                ctx = TaskContext(self.taskdir, taskid)
+                self.uploader.put([(name, ctx.work(name)) for name in files], 
+                                  self._uploaded(taskid, result))
+            else:
+                self.results.add(taskid, result)
+        return callback
 
     def worker(self):
-        taskdir = os.path.abspath('task')
+        '''Send the received tasks to the slots.'''
+        taskdir = self.taskdir
         while True:
             token = self.queue.get()            
             if token is not None:
-                taskid, recipe, obsres = token
-                _logger.info('processing taskid=%d', taskid)
-                basedir = os.path.join(taskdir, str(taskid))
-                workdir = os.path.join(basedir, 'work')
-                resultsdir = os.path.join(basedir, 'results')                
-                _logger.debug('Basedir: %s', basedir)
-                _logger.debug('Workdir: %s', workdir)
-                _logger.debug('Resultsdir: %s', resultsdir)                
-
-                _recipe_logger = recipe.logger
-                _recipe_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            
-                processing_log = 'processing.log'
-            
-                _logger.debug('creating custom logger "%s"', processing_log)
-                os.chdir(resultsdir)
-                fh = logging.FileHandler(processing_log)
-                fh.setLevel(logging.DEBUG)
-                fh.setFormatter(_recipe_formatter)
-                _recipe_logger.addHandler(fh)
-                
-                csd = os.getcwd()
-
-                os.chdir(workdir)
-                
-                try:
-                    result = recipe(obsres)
-                finally:
-                    os.chdir(csd)
-    
-                _logger.info('finished')
-                    
+                taskid, spec, obsres = token
+                # the callbacks are called one by one in a thread of the pool
+                self.pool.apply_async(run_recipe, (taskid, spec, obsres, taskdir),
+                                      callback=self._finished(taskid))
                 self.queue.task_done()
-                _logger.info('sending back to server')
-                self.rserver.receiver(self.cid, result, taskid)
-                os.chdir(taskdir)
             else:
                 _logger.info('ending worker thread')
+                self.pool.close()
+                # the pool is not joined before the tasks lost by the 
+                # slots that died are reaped, it would wait for them
+                while True:
+                    self.reap()
+                    with self.lock:
+                        if not self.executing:
+                            break
+                        self.lock.wait(0.5)
+                self.pool.terminate()
+                self.pool.join()
+                if self.uploader is not None:
+                    self.uploader.close()
+                self.results.close()
                 return
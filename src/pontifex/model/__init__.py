@@ -21,7 +21,7 @@ import os
 import os.path
 import math
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -35,9 +35,37 @@ metadata = DeclarativeBase.metadata
 def init_model(engine):
     Session.configure(bind=engine)
 
+def upgrade_model(engine):
+    '''Add the columns and indexes missing in the tables of an older database.
+
+    The tables themselves are created by metadata.create_all. 
+    New columns must be nullable or have a server default.
+    '''
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, 
+                                    column.type.compile(dialect=engine.dialect))
+            if column.server_default is not None:
+                ddl += " DEFAULT '%s'" % column.server_default.arg
+                if not column.nullable:
+                    ddl += ' NOT NULL'
+            engine.execute(ddl)
+        indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+
 _datadir = 'data'
 _taskdir = 'task'
 _productsdir = 'products'
+_storedir = 'store'
 
 if not os.path.exists(_datadir):
     os.makedirs(_datadir)
@@ -48,13 +76,21 @@ if not os.path.exists(_taskdir):
 if not os.path.exists(_productsdir):
     os.makedirs(_productsdir)
 
+if not os.path.exists(_storedir):
+    os.makedirs(_storedir)
+
 datadir = os.path.abspath(_datadir)
 taskdir = os.path.abspath(_taskdir)
 productsdir = os.path.abspath(_productsdir)
+storedir = os.path.abspath(_storedir)
 
 from .sql import ObservingBlock, ObservingRun, Frame, InstrumentConfiguration
 from .sql import Instrument, Users, ObservationResult, Channel, ContextDescription, ContextValue
 from .dataproc import DataProcessingTask
+from .dataproc import CREATED, COMPLETED, ENQUEUED, PROCESSING, FINISHED, ERROR
+from .dataproc import add_ready_listener, remove_ready_listener
+from .dataproc import set_task_state, fill_task_roots, fill_task_depths
+from .dataproc import fill_task_requests
 from .dataproc import ReductionResult, DataProduct, ProcessingSet
 from .sql import FITSKeyword, BoolFITSKeyword, StringFITSKeyword
 from .sql import IntegerFITSKeyword, FloatFITSKeyword
@@ -23,14 +23,23 @@ from datetime import datetime
 
 from sqlalchemy import UniqueConstraint, PrimaryKeyConstraint, CheckConstraint, ForeignKeyConstraint
 from sqlalchemy import Integer, String, DateTime, Boolean, TIMESTAMP
-from sqlalchemy import Table, Column, ForeignKey
+from sqlalchemy import Table, Column, ForeignKey, Index
 from sqlalchemy import PickleType
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import event, select, and_, not_, exists, desc, true, bindparam
+from sqlalchemy import Text, type_coerce, literal, func
+from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy.orm.attributes import get_history
 
-from . import DeclarativeBase
+from . import DeclarativeBase, maker
+from .types import JSONEncoded
+
+# Processing tasks STATES
+CREATED, COMPLETED, ENQUEUED, PROCESSING, FINISHED, ERROR = range(6)
 
 class DataProcessingTask(DeclarativeBase):
     __tablename__ = 'dp_task'
+    # ready tasks, by instrument, swept by the watchdog
+    __table_args__ = (Index('ix_dp_task_ready', 'state', 'waiting', 'instrument_id'), )
     id = Column(Integer, primary_key=True)
     host = Column(String(45))
     state = Column(Integer, default=0)
@@ -38,18 +47,266 @@ class DataProcessingTask(DeclarativeBase):
     start_time = Column(DateTime)
     completion_time = Column(DateTime)
     obsresult_node_id = Column(Integer, ForeignKey('observation_result.id'), nullable=False)
-    parent_id = Column(Integer, ForeignKey('dp_task.id'))
+    parent_id = Column(Integer, ForeignKey('dp_task.id'), index=True)
+    channel_id = Column(Integer, ForeignKey('channel.id'))
     label = Column(String(45))
     waiting = Column(Boolean)
     awaited = Column(Boolean)
     method = Column(String(45))
-    request = Column(String(45))
-    result = Column(String(45))
+    request = Column(JSONEncoded)
+    result = Column(JSONEncoded)
+    # copied from the request, to select tasks in SQL
+    pset_name = Column(String(50), index=True)
+    instrument_id = Column(String(10), index=True)
+    # set when the task is created, the root of a tree is its own root
+    root_id = Column(Integer, ForeignKey('dp_task.id'), index=True)
+    # levels between the task and its root, set when the task is created
+    depth = Column(Integer)
+    observing_block_id = Column(Integer, ForeignKey('observing_block.id'))
 
     obsresult_node = relationship("ObservationResult", backref='tasks')
+    channel = relationship("Channel")
+    observing_block = relationship("ObservingBlock")
 
-    children = relationship("DataProcessingTask",
+    children = relationship("DataProcessingTask", foreign_keys=[parent_id],
                 backref=backref('parent', remote_side=[id]))
+    # the root references itself, it is set after inserting it
+    root = relationship("DataProcessingTask", foreign_keys=[root_id],
+                remote_side=[id], post_update=True)
+
+@event.listens_for(DataProcessingTask.request, 'set')
+def _extract_request(target, value, oldvalue, initiator):
+    if value is not None:
+        target.pset_name = value.get('pset')
+        target.instrument_id = value.get('instrument')
+
+# The root, the depth, the observing block and the instrument of a task are 
+# copied in the task when it is created, instead of climbing its tree each time
+
+@event.listens_for(maker, 'before_flush')
+def _set_root(session, context, instances):
+    for target in session.new:
+        if not isinstance(target, DataProcessingTask):
+            continue
+        if target.root is not None and target.depth is not None:
+            continue
+        root, depth = target, 0
+        while root.parent is not None:
+            root = root.parent
+            depth += 1
+        if target.depth is None:
+            target.depth = depth
+        if target.root is not None:
+            continue
+        target.root = root
+        if target.observing_block is None and root.obsresult_node is not None:
+            target.observing_block = root.obsresult_node.observing_block
+        if target.instrument_id is None and target.observing_block is not None:
+            target.instrument_id = target.observing_block.obsrun.instrument_id
+
+def fill_task_roots(session):
+    '''Set the root, observing block and instrument of the tasks without them.
+
+    The roots are found with a recursive query. Returns the 
+    number of tasks updated.
+    '''
+    table = DataProcessingTask.__table__
+    if session.execute(select([table.c.id]).where(
+                            table.c.root_id == None).limit(1)).first() is None:
+        return 0
+
+    child = table.alias('child')
+    tree = select([table.c.id, table.c.id.label('root')]).where(
+                table.c.parent_id == None).cte('tree', recursive=True)
+    tree = tree.union_all(select([child.c.id, tree.c.root]).where(
+                child.c.parent_id == tree.c.id))
+    rows = session.execute(select([tree.c.id, tree.c.root]).where(
+                tree.c.id.in_(select([table.c.id]).where(
+                    table.c.root_id == None)))).fetchall()
+    if not rows:
+        return 0
+    stmt = table.update().where(table.c.id == bindparam('taskid')).values(
+                root_id=bindparam('rootid'))
+    session.execute(stmt, [{'taskid': taskid, 'rootid': rootid} 
+                                for taskid, rootid in rows])
+
+    # the observing block of the root, and its instrument
+    root = table.alias('root')
+    block = DeclarativeBase.metadata.tables['observing_block']
+    run = DeclarativeBase.metadata.tables['observing_run']
+    ids = [taskid for taskid, _ in rows]
+    for i in range(0, len(ids), _BATCH):
+        part = ids[i:i + _BATCH]
+        session.execute(table.update().where(and_(table.c.id.in_(part),
+                            table.c.observing_block_id == None)).values(
+                    observing_block_id=select([block.c.id]).where(and_(
+                        root.c.id == table.c.root_id,
+                        block.c.observation_result_root_id == root.c.obsresult_node_id)
+                        ).as_scalar()))
+        session.execute(table.update().where(and_(table.c.id.in_(part),
+                            table.c.instrument_id == None)).values(
+                    instrument_id=select([run.c.instrument_id]).where(and_(
+                        block.c.id == table.c.observing_block_id,
+                        run.c.id == block.c.obsrun_id)).as_scalar()))
+    return len(rows)
+
+def unfinished_children(parents):
+    '''Select the number of unfinished children of each parent in parents.'''
+    table = DataProcessingTask.__table__
+    return select([table.c.parent_id, func.count()]).where(and_(
+                table.c.parent_id.in_(parents), 
+                table.c.state != FINISHED)).group_by(table.c.parent_id)
+
+def fill_task_depths(session):
+    '''Set the depth of the tasks without it.
+
+    The depths are found with a recursive query. Returns the 
+    number of tasks updated.
+    '''
+    table = DataProcessingTask.__table__
+    if session.execute(select([table.c.id]).where(
+                            table.c.depth == None).limit(1)).first() is None:
+        return 0
+
+    child = table.alias('child')
+    tree = select([table.c.id, literal(0).label('depth')]).where(
+                table.c.parent_id == None).cte('tree', recursive=True)
+    tree = tree.union_all(select([child.c.id, tree.c.depth + 1]).where(
+                child.c.parent_id == tree.c.id))
+    rows = session.execute(select([tree.c.id, tree.c.depth]).where(
+                tree.c.id.in_(select([table.c.id]).where(
+                    table.c.depth == None)))).fetchall()
+    if not rows:
+        return 0
+    stmt = table.update().where(table.c.id == bindparam('taskid')).values(
+                depth=bindparam('taskdepth'))
+    session.execute(stmt, [{'taskid': taskid, 'taskdepth': depth} 
+                                for taskid, depth in rows])
+    return len(rows)
+
+def fill_task_requests(session):
+    '''Set the processing set and instrument of the tasks from their requests.
+
+    The tasks stored before these columns existed don't have them.
+    Requests that can't be read are skipped. Returns the number
+    of tasks updated.
+    '''
+    table = DataProcessingTask.__table__
+    # read as text, a bad request doesn't stop the others
+    rows = session.execute(select([table.c.id, table.c.instrument_id, 
+                                   type_coerce(table.c.request, Text)]).where(
+                and_(table.c.pset_name == None, table.c.request != None))).fetchall()
+    decoder = JSONEncoded()
+    values = []
+    for taskid, instrument, text in rows:
+        try:
+            request = decoder.process_result_value(text, session.bind.dialect)
+        except (ValueError, SyntaxError):
+            continue
+        if not isinstance(request, dict) or request.get('pset') is None:
+            continue
+        values.append({'taskid': taskid, 'pset': request['pset'],
+                       'instrument': instrument or request.get('instrument')})
+    if values:
+        stmt = table.update().where(table.c.id == bindparam('taskid')).values(
+                    pset_name=bindparam('pset'), instrument_id=bindparam('instrument'))
+        session.execute(stmt, values)
+    return len(values)
+
+# Notification of ready tasks
+# A task is ready when it is COMPLETED and it is not waiting for its children.
+# The ids of the tasks that become ready in a flush are collected in the 
+# session and passed to the listeners once the transaction is committed
+
+_ready_listeners = []
+
+def add_ready_listener(fn):
+    '''Call fn with a list of task ids each time some tasks become ready.'''
+    _ready_listeners.append(fn)
+
+def remove_ready_listener(fn):
+    _ready_listeners.remove(fn)
+
+def _became_ready(target):
+    if target.state != COMPLETED or target.waiting is not False:
+        return False
+    return get_history(target, 'state').has_changes() or \
+        get_history(target, 'waiting').has_changes()
+
+@event.listens_for(DataProcessingTask, 'after_insert')
+@event.listens_for(DataProcessingTask, 'after_update')
+def _collect_ready(mapper, connection, target):
+    if _ready_listeners and _became_ready(target):
+        session = object_session(target)
+        session.info.setdefault('ready_tasks', []).append(target.id)
+
+@event.listens_for(maker, 'after_commit')
+def _notify_ready(session):
+    ready = session.info.pop('ready_tasks', None)
+    if ready:
+        for fn in _ready_listeners:
+            fn(ready)
+
+@event.listens_for(maker, 'after_rollback')
+def _discard_ready(session):
+    session.info.pop('ready_tasks', None)
+
+# Bulk state transitions
+# Backends supporting UPDATE ... RETURNING change the state and return 
+# the ids in one statement. In others, like sqlite, the ids are selected
+# and each row is updated only if it still matches the selection, as 
+# another connection may have changed it since it was selected
+
+_BATCH = 500
+
+def set_task_state(session, state, old=None, ids=None, values=None, **criteria):
+    '''Change the state of the selected tasks, return the ids of the changed tasks.
+
+    The tasks are selected by their current state old, their ids and 
+    the column values in criteria. The columns in values are set
+    too. The changes are done in bulk, the objects already 
+    loaded in the session are not updated.
+    '''
+    table = DataProcessingTask.__table__
+    where = []
+    if old is not None:
+        where.append(table.c.state == old)
+    for key, value in criteria.items():
+        where.append(table.c[key] == value)
+
+    newvalues = dict(values or {})
+    newvalues['state'] = state
+
+    if ids is None:
+        batches = [None]
+    else:
+        ids = list(ids)
+        batches = [ids[i:i + _BATCH] for i in range(0, len(ids), _BATCH)]
+
+    returning = session.bind.dialect.implicit_returning
+    changed = []
+    for batch in batches:
+        cond = list(where)
+        if batch is not None:
+            cond.append(table.c.id.in_(batch))
+        if returning:
+            stmt = table.update().where(and_(*cond)).values(**newvalues)
+            rows = session.execute(stmt.returning(table.c.id)).fetchall()
+            changed.extend(row[0] for row in rows)
+        else:
+            rows = session.execute(select([table.c.id]).where(and_(*cond))).fetchall()
+            stmt = table.update().where(and_(table.c.id == bindparam('taskid'), 
+                                             *where)).values(**newvalues)
+            for row in rows:
+                # the row count tells if the row still matched
+                if session.execute(stmt, {'taskid': row[0]}).rowcount:
+                    changed.append(row[0])
+
+    if state == COMPLETED and changed and _ready_listeners:
+        # tasks returned to COMPLETED may be ready again
+        session.info.setdefault('ready_tasks', []).extend(changed)
+
+    return changed
 
 # sqlite trigger to update task.state when observing_tree.state changes
 
@@ -63,7 +320,7 @@ class ReductionResult(DeclarativeBase):
     id = Column(Integer, primary_key=True)
     state = Column(Integer)
     # TODO: these two fields aren't necessary
-    other = Column(String(45))
+    other = Column(JSONEncoded)
     obsresult_node_id = Column(Integer, ForeignKey('observation_result.id'))
     task_id = Column(Integer, ForeignKey('dp_task.id'))
     
@@ -77,7 +334,10 @@ data_product_context = Table(
 
 class DataProduct(DeclarativeBase):
     __tablename__ = 'dp_product'
-    __table_args__ = (ForeignKeyConstraint(['instrument_id', 'pset_name'], ['dp_set.instrument_id', 'dp_set.name']), )
+    # the lookup of calibrations returns the newest first, the 
+    # entries of an index are sorted by id after its columns
+    __table_args__ = (ForeignKeyConstraint(['instrument_id', 'pset_name'], ['dp_set.instrument_id', 'dp_set.name']), 
+                      Index('ix_dp_product_lookup', 'instrument_id', 'datatype', 'pset_name'), )
     id = Column(Integer, primary_key=True)
     
     datatype = Column(String(45))
@@ -85,10 +345,29 @@ class DataProduct(DeclarativeBase):
     result_id = Column(Integer, ForeignKey('dp_reduction_result.id'))
     instrument_id = Column(String(10), ForeignKey('instrument.name'), nullable=False)
     pset_name = Column(String(50), nullable=False)
+    # SHA-1 of the content, in the content store
+    digest = Column(String(40), index=True)
 
     result = relationship(ReductionResult, backref='data_product')
     context = relationship('ContextValue', secondary='data_product_context', backref='data_product')
 
+def matching_products(instrument, datatype, pset, context):
+    '''Select the ids of the products matching a requirement, newest first.
+
+    A product matches if all its context values have their ids in context.
+    '''
+    table = DataProduct.__table__
+    assoc = data_product_context
+    # a context value of the product not in the context
+    foreign = select([assoc.c.context_id]).where(and_(
+                assoc.c.data_product_id == table.c.id,
+                not_(assoc.c.context_id.in_(context)) if context else true()))
+    return select([table.c.id]).where(and_(
+                table.c.instrument_id == instrument,
+                table.c.datatype == datatype,
+                table.c.pset_name == pset,
+                not_(exists(foreign)))).order_by(desc(table.c.id))
+
 class ProcessingSet(DeclarativeBase):
     __tablename__ = 'dp_set'
     __table_args__ = (UniqueConstraint('instrument_id', 'name'), )
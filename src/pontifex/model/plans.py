@@ -0,0 +1,76 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Query plans of the queries run for each task.
+
+The plans are those of sqlite, given by EXPLAIN QUERY PLAN.
+A plan that scans a whole table, or sorts the rows in a
+temporary tree, is reported as degraded.
+'''
+
+from sqlalchemy import desc
+
+from .dataproc import DataProcessingTask, DataProduct, COMPLETED
+from .dataproc import matching_products, unfinished_children
+from .sql import Frame, ContextValue
+
+def hot_queries(session):
+    '''The queries of the scheduler and the inserter, by name.
+
+    They are ORM queries or select statements.
+    '''
+    return [
+        ('ready tasks', session.query(DataProcessingTask).filter_by(
+                    state=COMPLETED, waiting=False).filter(
+                    DataProcessingTask.instrument_id.in_(['EMIR', 'MEGARA']))),
+        ('unfinished siblings', unfinished_children([1, 2])),
+        ('frames of a result', session.query(Frame).filter_by(obsresult_id=1)),
+        ('calibrations', session.query(DataProduct).filter_by(
+                    instrument_id='EMIR', datatype='emir.dataproducts.MasterBias',
+                    pset_name='default').order_by(desc(DataProduct.id))),
+        ('context values', session.query(ContextValue).filter_by(
+                    description_id=1, value='J')),
+        ('matching calibration', matching_products('EMIR', 
+                    'emir.dataproducts.MasterBias', 'default', [1, 2]).limit(1)),
+        ]
+
+def explain(session, query):
+    '''The details of the sqlite plan of a query.'''
+    statement = getattr(query, 'statement', query)
+    statement = statement.compile(dialect=session.bind.dialect,
+                                  compile_kwargs={'literal_binds': True})
+    rows = session.execute('EXPLAIN QUERY PLAN %s' % statement).fetchall()
+    # the detail is the last column
+    return [row[-1] for row in rows]
+
+def _degraded(detail):
+    return detail.startswith('SCAN') or detail.startswith('USE TEMP B-TREE')
+
+def check_plans(session):
+    '''Return the (name, plan) of the hot queries with degraded plans.'''
+    if session.bind.dialect.name != 'sqlite':
+        raise NotImplementedError('only sqlite plans are checked')
+    degraded = []
+    for name, query in hot_queries(session):
+        plan = explain(session, query)
+        if any(_degraded(detail) for detail in plan):
+            degraded.append((name, plan))
+    return degraded
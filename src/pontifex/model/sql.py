@@ -23,7 +23,7 @@ from datetime import datetime
 
 from sqlalchemy import UniqueConstraint, ForeignKeyConstraint, PrimaryKeyConstraint, CheckConstraint, desc
 from sqlalchemy import Integer, String, DateTime, Float, Boolean, TIMESTAMP
-from sqlalchemy import Table, Column, ForeignKey
+from sqlalchemy import Table, Column, ForeignKey, Index
 from sqlalchemy import PickleType, Enum
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.orm.collections import attribute_mapped_collection
@@ -42,7 +42,9 @@ class Users(DeclarativeBase):
 class Channel(DeclarativeBase):
     __tablename__ = 'channel'
     id = Column(Integer, primary_key=True)
-    name = Column(String(255), nullable=False)
+    name = Column(String(255), nullable=False, unique=True)
+    # tasks in channels with higher priority are dispatched first
+    priority = Column(Integer, nullable=False, default=0, server_default='0')
 
 class Instrument(DeclarativeBase):
     __tablename__ = 'instrument'
@@ -87,6 +89,20 @@ class ObservingMode(DeclarativeBase):
 
     instrument = relationship("Instrument", backref='observing_modes')
 
+    @property
+    def module(self):
+        '''Recipe of the observing mode, the newest in the pipeline map.'''
+        if self.recipes:
+            return self.recipes[-1].recipe_fqn
+        return None
+
+    @property
+    def recipe_version(self):
+        '''Version of the pipeline of the recipe.'''
+        if self.recipes:
+            return self.recipes[-1].pipeline.version
+        return None
+
 class Pipeline(DeclarativeBase):
     __tablename__ = 'pipeline' 
     __table_args__ = (UniqueConstraint('instrument_id', 'name', 'version'),)
@@ -104,7 +120,9 @@ class PipelineMap(DeclarativeBase):
     recipe_fqn = Column(String(255))
     
     pipeline = relationship("Pipeline", backref='recipes')
-    obsmodes = relationship("ObservingMode", backref='recipes')
+    # the recipes of a mode, the newest last
+    obsmodes = relationship("ObservingMode", 
+                    backref=backref('recipes', order_by='PipelineMap.Id'))
 
 class Recipe(DeclarativeBase):
     __tablename__ = 'recipe'                                   
@@ -203,6 +221,8 @@ class ObservationResult(DeclarativeBase):
 
 class Frame(DeclarativeBase):
     __tablename__ = 'frame'
+    # frames of an observation result
+    __table_args__ = (Index('ix_frame_obsresult', 'obsresult_id'), )
     id = Column(Integer, primary_key=True)
     name = Column(String(10), unique=True, nullable=False)
     object = Column(String(100), nullable=False)
@@ -212,6 +232,8 @@ class Frame(DeclarativeBase):
     deccoor = Column(Float, nullable=False)
     stamp = Column(DateTime, default=datetime.utcnow, nullable=False)
     obsresult_id = Column(Integer,  ForeignKey("observation_result.id"), nullable=False)
+    # SHA-1 of the content, in the content store
+    digest = Column(String(40), index=True)
 
 class ContextDescription(DeclarativeBase):
     __tablename__ = 'context_description'
@@ -234,6 +256,8 @@ observing_tree_context = Table(
 
 class ContextValue(DeclarativeBase):
     __tablename__ = 'context_value'
+    # values looked up when the products are inserted
+    __table_args__ = (Index('ix_context_value_lookup', 'description_id', 'value'), )
 
     id = Column(Integer, primary_key=True)
     description_id = Column(Integer, ForeignKey("context_description.id"), nullable=False)
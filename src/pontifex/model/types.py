@@ -0,0 +1,54 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Column types of the model.'''
+
+import ast
+
+try:
+    # faster, if available
+    import simplejson as json
+except ImportError:
+    import json
+
+from sqlalchemy.types import TypeDecorator, Text
+
+class JSONEncoded(TypeDecorator):
+    '''A structure stored as JSON text.
+
+    Objects without a JSON form are stored as their string.
+    Values written by older versions, with str(), are read
+    with ast.literal_eval.
+    '''
+    impl = Text
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return json.dumps(value, separators=(',', ':'), default=str)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return ast.literal_eval(value)
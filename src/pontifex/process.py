@@ -20,40 +20,41 @@
 import logging
 import json
 import os.path
-import shutil
 
-from sqlalchemy import desc
 from numina.recipes import DataFrame
 from numina.pipeline import get_recipe
 import yaml
 
-from model import taskdir, datadir, productsdir, DataProduct, RecipeConfiguration
+from model import taskdir, datadir, productsdir, storedir, DataProduct, RecipeConfiguration
+from pontifex.context import TaskContext
+from pontifex.store import ContentStore
+from pontifex.calibration import calibrations
 
 
 _logger = logging.getLogger("pontifex.proc")
 
-def processPointing(session, **kwds):
-    _logger.info('process called with kwds %s', kwds)
-    _logger.info('creating root directory')
-
-    basedir = str(kwds['id'])
-    os.chdir(taskdir)
-    _logger.info('root directory is %s', basedir)
+_store = ContentStore(storedir)
 
-    basedir = os.path.abspath(basedir)
-    workdir = os.path.join(basedir, 'work')
-    resultsdir = os.path.join(basedir, 'results')
+def processPointing(session, store=None, **kwds):
+    '''Prepare the work directory of a task.
 
-    os.mkdir(basedir)
-    os.mkdir(workdir)
-    os.mkdir(resultsdir)
+    The frames and products are staged from store, by 
+    default a store with the default stager.
+    '''
+    if store is None:
+        store = _store
+    _logger.info('process called with kwds %s', kwds)
+    _logger.info('creating root directory')
 
-    os.chdir(basedir)
+    ctx = TaskContext(taskdir, kwds['id'])
+    _logger.info('root directory is %s', ctx.basedir)
+    ctx.create()
+    workdir = ctx.workdir
 
     _logger.info('create config files, put them in root dir')
 
-    filename_json = os.path.join(resultsdir, 'task-control.json')
-    filename_yaml = os.path.join(resultsdir, 'task-control.yaml')
+    filename_json = ctx.results('task-control.json')
+    filename_yaml = ctx.results('task-control.yaml')
     
     _logger.info('instrument=%(instrument)s mode=%(mode)s', kwds)
     try:
@@ -85,26 +86,18 @@ def processPointing(session, **kwds):
             # query here
             longname = '%s.%s' % (req.value.__module__, req.value.__name__)
             _logger.info('query for %s', longname)
-            # FIXME: this query should be updated
-            dps = session.query(DataProduct).filter_by(instrument_id=kwds['instrument'], 
-                                                       datatype=longname, 
-                                                       pset_name=pset).order_by(desc(DataProduct.id))
-
-            _logger.info('checking context')
-            for cdp in dps:
-                if all((c in kwds['context']) for c in cdp.context):
-                    _logger.info('found requirement with acceptable context: %s', cdp.reference)
-                    break
-            else:
-                cdp = None
+            cdp = calibrations.lookup(session, kwds['instrument'], longname, 
+                                      pset, kwds['context'])
+            if cdp is not None:
+                _logger.info('found requirement with acceptable context: %s', cdp.reference)
 
             if cdp is None:
                 _logger.warning("can't find %s", longname)
                 raise ValueError("can't find %s" % longname)
             else:
                 parameters[req.name] = cdp.reference
-                _logger.debug('copy %s', cdp.reference)
-                shutil.copy(os.path.join(productsdir, cdp.reference), workdir)
+                _logger.debug('stage %s', cdp.reference)
+                store.stage_product(cdp, productsdir, workdir)
         elif req.name in stored_parameters:
             _logger.info('parameter %s from stored parameters', req.name)
             parameters[req.name] = stored_parameters[req.name]
@@ -115,21 +108,21 @@ def processPointing(session, **kwds):
     for req in recipeClass.__provides__:
         _logger.info('recipe provides %s', req)
     
-    _logger.info('copying the frames')
+    _logger.info('staging the frames')
     images = []
     for frame in kwds['frames']:
-        _logger.debug('copy %s', frame.name)
+        _logger.debug('stage %s', frame.name)
         images.append(frame.name)
-        shutil.copy(os.path.join(datadir, frame.name), workdir)
+        store.stage_frame(frame, datadir, workdir)
 
-    _logger.info('copying the children results')
+    _logger.info('staging the children results')
     children_results = []
     for child in kwds['children']:
         for rresult in child.rresult:
             for dp in rresult.data_product:
-                _logger.debug('copy %s', dp.reference)
+                _logger.debug('stage %s', dp.reference)
                 children_results.append(dp.reference)
-                shutil.copy(os.path.join(productsdir, dp.reference), workdir)
+                store.stage_product(dp, productsdir, workdir)
 
     config = {'observing_result': {'id': kwds['id'], 
         'frames': images,
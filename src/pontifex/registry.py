@@ -0,0 +1,272 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Registry of the hosts connected to the server.'''
+
+import time
+import threading
+from collections import OrderedDict
+
+class ClientHost(object):
+    def __init__(self, hostid, proxy, address, capabilities, slots=1):
+        super(ClientHost, self).__init__()
+        self.hostid = hostid
+        self.proxy = proxy
+        self.address = address
+        self.capabilities = list(capabilities)
+        self.slots = slots
+        self.free = slots
+        self.since = time.time()
+        # end of the lease of the host and of its running tasks
+        self.expires = None
+        self.tasks = {}
+
+    @property
+    def name(self):
+        return '%s:%d' % self.address
+
+    @property
+    def idle(self):
+        return self.free > 0
+
+class HostRegistry(object):
+    '''Registered hosts, with the idle ones indexed by capability.
+
+    A host can run several tasks at the same time, one in
+    each of its slots. Each capability (the name of an instrument) 
+    has an ordered set of the hosts supporting it with free slots, 
+    and a count of those free slots, so claiming and releasing
+    a slot doesn't depend on the number of registered hosts.
+    All the operations are atomic under lock.
+
+    Hosts and the tasks assigned to them hold leases of lease
+    seconds, renewed by the heartbeats of the hosts. 
+    '''
+    def __init__(self, lock=None, lease=30):
+        super(HostRegistry, self).__init__()
+        if lock is None:
+            lock = threading.Lock()
+        self.lock = lock
+        self.lease = lease
+        self.hosts = {}
+        self.idle = {}
+        self.nfree = {}
+        self.nfree_total = 0
+
+    def __contains__(self, hostid):
+        return hostid in self.hosts
+
+    def __getitem__(self, hostid):
+        return self.hosts[hostid]
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def _take(self, host):
+        host.free -= 1
+        self.nfree_total -= 1
+        for cap in host.capabilities:
+            self.nfree[cap] -= 1
+            del self.idle[cap][host.hostid]
+            if host.free > 0:
+                # to the end, the next claim goes to other host
+                self.idle[cap][host.hostid] = host
+
+    def _give(self, host):
+        host.free += 1
+        self.nfree_total += 1
+        for cap in host.capabilities:
+            self.nfree[cap] = self.nfree.get(cap, 0) + 1
+            self.idle.setdefault(cap, OrderedDict())[host.hostid] = host
+
+    def add(self, hostid, proxy, address, capabilities, slots=1):
+        '''Register an idle host, return False if it was already registered.'''
+        with self.lock:
+            if hostid in self.hosts:
+                return False
+            host = ClientHost(hostid, proxy, address, capabilities, slots)
+            host.expires = host.since + self.lease
+            self.hosts[hostid] = host
+            host.free = 0
+            for _ in range(slots):
+                self._give(host)
+            return True
+
+    def remove(self, hostid):
+        '''Unregister a host, return it or None if it was not registered.'''
+        with self.lock:
+            host = self.hosts.pop(hostid, None)
+            if host is not None:
+                while host.free > 0:
+                    self._take(host)
+            return host
+
+    def claim(self, capability, keep=0):
+        '''Take a free slot of a host supporting capability and return the host.
+
+        Consecutive claims go to different hosts when possible.
+        Returns None if there are no more than keep free slots 
+        with that capability.
+        '''
+        with self.lock:
+            if self.nfree.get(capability, 0) <= keep:
+                return None
+            idle = self.idle[capability]
+            host = idle[next(iter(idle))]
+            self._take(host)
+            return host
+
+    def release(self, hostid):
+        '''Free a slot of a host.'''
+        with self.lock:
+            host = self.hosts.get(hostid)
+            if host is not None and host.free < host.slots:
+                self._give(host)
+            return host
+
+    def offer(self, hostid, capabilities, free):
+        '''Set the capabilities and number of free slots of a host.
+
+        Returns the host, or None if it is not registered.
+        '''
+        with self.lock:
+            host = self.hosts.get(hostid)
+            if host is None:
+                return None
+            free = max(0, min(free, host.slots))
+            if set(capabilities) != set(host.capabilities):
+                nfree = host.free
+                while host.free > 0:
+                    self._take(host)
+                host.capabilities = list(capabilities)
+                while host.free < nfree:
+                    self._give(host)
+            while host.free < free:
+                self._give(host)
+            while host.free > free:
+                self._take(host)
+            return host
+
+    def assign(self, hostid, taskid):
+        '''Start the lease of a task sent to a host.'''
+        with self.lock:
+            host = self.hosts.get(hostid)
+            if host is not None:
+                host.tasks[taskid] = time.time() + self.lease
+
+    def finish(self, hostid, taskid):
+        '''End the lease of a task and free its slot.
+
+        Returns False if the task was not leased to the host.
+        '''
+        with self.lock:
+            host = self.hosts.get(hostid)
+            if host is None or host.tasks.pop(taskid, None) is None:
+                return False
+            if host.free < host.slots:
+                self._give(host)
+            return True
+
+    def renew(self, hostid, taskids):
+        '''Renew the leases of a host and its running tasks.
+
+        Returns None if the host is not registered, else the ids
+        in taskids of the tasks not leased to the host.
+        '''
+        with self.lock:
+            host = self.hosts.get(hostid)
+            if host is None:
+                return None
+            host.expires = time.time() + self.lease
+            unknown = []
+            for taskid in taskids:
+                if taskid in host.tasks:
+                    host.tasks[taskid] = host.expires
+                else:
+                    unknown.append(taskid)
+            return unknown
+
+    def adopt(self, hostid, taskids):
+        '''Lease to a host running tasks it was not assigned here.
+
+        They were sent before the host registered again, so they
+        are only adopted during the first lease of the host, and
+        if no other host holds their lease. Returns the ids of
+        the adopted tasks.
+        '''
+        with self.lock:
+            host = self.hosts.get(hostid)
+            if host is None or time.time() > host.since + self.lease:
+                return []
+            adopted = []
+            for taskid in taskids:
+                if any(taskid in other.tasks for other in self.hosts.values()):
+                    continue
+                host.tasks[taskid] = host.expires
+                if host.free > 0:
+                    self._take(host)
+                adopted.append(taskid)
+            return adopted
+
+    def expire(self):
+        '''Remove the hosts and tasks whose lease has expired.
+
+        Returns the removed hosts and the ids of the tasks
+        whose lease has expired, including those of the removed hosts.
+        '''
+        now = time.time()
+        evicted = []
+        taskids = []
+        with self.lock:
+            for host in self.hosts.values():
+                if host.expires < now:
+                    del self.hosts[host.hostid]
+                    while host.free > 0:
+                        self._take(host)
+                    evicted.append(host)
+                    taskids.extend(host.tasks)
+                    host.tasks.clear()
+                    continue
+                for taskid, expires in host.tasks.items():
+                    if expires < now:
+                        del host.tasks[taskid]
+                        taskids.append(taskid)
+                        if host.free < host.slots:
+                            self._give(host)
+        return evicted, taskids
+
+    def leased(self):
+        '''Ids of the tasks with a lease.'''
+        with self.lock:
+            return set(taskid for host in self.hosts.values() 
+                                for taskid in host.tasks)
+
+    def idle_capabilities(self):
+        '''Capabilities of the hosts with free slots.'''
+        with self.lock:
+            return [cap for cap, nfree in self.nfree.items() if nfree > 0]
+
+    def nidle(self, capability=None):
+        '''Number of free slots, in hosts supporting capability if given.'''
+        with self.lock:
+            if capability is None:
+                return self.nfree_total
+            return self.nfree.get(capability, 0)
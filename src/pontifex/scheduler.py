@@ -0,0 +1,162 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Ordering of the ready tasks.'''
+
+from Queue import Queue
+from collections import deque
+
+from sqlalchemy import select, and_, func
+
+from pontifex.model import DataProcessingTask, Channel, COMPLETED, FINISHED
+from pontifex.model.dataproc import unfinished_children
+
+_BATCH = 500
+
+def _unfinished_children(session, parents):
+    '''Number of unfinished children of each parent, by parent id.'''
+    parents = list(parents)
+    counts = {}
+    for i in range(0, len(parents), _BATCH):
+        rows = session.execute(unfinished_children(parents[i:i + _BATCH]))
+        counts.update(rows.fetchall())
+    return counts
+
+def pending_siblings(session, tasks):
+    '''Number of unfinished siblings of each task, by task id.'''
+    counts = _unfinished_children(session, set(task.parent_id for task in tasks 
+                                        if task.parent_id is not None))
+    # the task itself is not finished
+    return dict((task.id, max(counts.get(task.parent_id, 1) - 1, 0)) 
+                    for task in tasks)
+
+def critical_path_order(tasks, pending):
+    '''Order ready tasks by their position in the reduction tree.
+
+    The tasks with more levels between them and the root,
+    that is, in the longest remaining path of the tree, go first.
+    Between tasks of the same depth, those whose parent is 
+    waiting for less unfinished children, given by pending, go 
+    first, as they will unblock their parents sooner.
+    '''
+    def key(task):
+        return (-(task.depth or 0), pending.get(task.id, 0), task.id)
+    return sorted(tasks, key=key)
+
+def ready_tasks(session, instruments, limit):
+    '''Ready tasks of instruments, at most limit of each channel priority.
+
+    The tasks are selected in critical path order by the database, 
+    the unfinished siblings of each task are counted in one 
+    grouped query.
+    '''
+    table = DataProcessingTask.__table__
+    channel = Channel.__table__
+    ready = and_(table.c.state == COMPLETED, table.c.waiting == False,
+                 table.c.instrument_id.in_(instruments))
+    # unfinished children of the parents of the ready tasks
+    parents = select([table.c.parent_id]).where(ready)
+    siblings = select([table.c.parent_id, func.count().label('pending')]).where(
+                and_(table.c.parent_id.in_(parents), table.c.state != FINISHED)
+                ).group_by(table.c.parent_id).alias('siblings')
+    priority = func.coalesce(channel.c.priority, 0)
+    rank = func.row_number().over(partition_by=priority, 
+                order_by=[func.coalesce(table.c.depth, 0).desc(), 
+                          func.coalesce(siblings.c.pending, 1), table.c.id])
+    ranked = select([table.c.id, rank.label('rank')]).select_from(
+                table.outerjoin(channel, channel.c.id == table.c.channel_id
+                    ).outerjoin(siblings, siblings.c.parent_id == table.c.parent_id)
+                ).where(ready).alias('ranked')
+    selected = select([ranked.c.id]).where(ranked.c.rank <= limit)
+    return session.query(DataProcessingTask).filter(
+                DataProcessingTask.id.in_(selected)).all()
+
+def interleave(groups, burst):
+    '''Merge groups of items, ordered by decreasing priority.
+
+    Items are taken from the first non empty group, but
+    after burst consecutive items from a group, one item
+    of a lower priority group is taken, so that the groups 
+    of lower priority are not starved. The lower priority
+    groups take these turns in round robin.
+    '''
+    groups = [deque(group) for group in groups]
+    served = 0
+    turn = 0
+    while True:
+        groups = [group for group in groups if group]
+        if not groups:
+            return
+        if served >= burst and len(groups) > 1:
+            lower = groups[1:]
+            yield lower[turn % len(lower)].popleft()
+            turn += 1
+            served = 0
+        else:
+            yield groups[0].popleft()
+            served += 1
+
+class ChannelQueue(Queue):
+    '''A queue of tasks served by channel priority.
+
+    Items are (priority, taskid) tuples, or None. Higher
+    priorities are served first, but after burst consecutive
+    items of the highest priority, one item of a lower priority
+    is served, taking the lower priorities in round robin. 
+    Items with the same priority are served in FIFO order. 
+    None is always served first.
+    '''
+    def __init__(self, burst=4, maxsize=0):
+        self.burst = burst
+        Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.levels = {}
+        self.stop = deque()
+        self.served = 0
+        self.turn = 0
+        self.count = 0
+
+    def _qsize(self, len=len):
+        return self.count
+
+    def _put(self, item):
+        if item is None:
+            self.stop.append(item)
+        else:
+            self.levels.setdefault(item[0], deque()).append(item)
+        self.count += 1
+
+    def _get(self):
+        self.count -= 1
+        if self.stop:
+            return self.stop.popleft()
+        priorities = sorted((p for p in self.levels if self.levels[p]), reverse=True)
+        if len(priorities) == 1:
+            self.served = 0
+        elif self.served >= self.burst:
+            self.served = 0
+            lower = priorities[1:]
+            level = lower[self.turn % len(lower)]
+            self.turn += 1
+            return self.levels[level].popleft()
+        self.served += 1
+        return self.levels[priorities[0]].popleft()
@@ -21,14 +21,12 @@
 
 import time
 import threading
-import logging
-from Queue import Queue
-from xmlrpclib import ServerProxy
 import xmlrpclib
+import logging
+from Queue import Queue, Empty
+from collections import OrderedDict
 import os.path
 from datetime import datetime
-import shutil
-import cPickle as pickle
 import yaml
 
 from numina.pipeline import init_pipeline_system, import_object
@@ -36,21 +34,34 @@ from numina.recipes.requirements import Names
 from numina.recipes.oblock import obsres_from_dict
 
 import pontifex.process as process
+from pontifex.context import TaskContext
+from pontifex.staging import Stager
+from pontifex.store import ContentStore
+from pontifex.registry import HostRegistry
+from pontifex.transport import make_proxy, pack, Mailbox
+from pontifex.upload import UploadStore, product_name
+from pontifex.download import read_chunk, TransferStats
+from pontifex.vocabulary import vocabulary
+from pontifex.scheduler import ChannelQueue, interleave, critical_path_order
+from pontifex.scheduler import pending_siblings, ready_tasks
 from pontifex.model import Session, productsdir
-from pontifex.model import ObservingBlock, Instrument, ProcessingSet
+from pontifex.model import ObservingBlock, Instrument, ProcessingSet, Channel
 from pontifex.model import ContextDescription, ContextValue
 from pontifex.model import DataProcessingTask, ReductionResult, DataProduct
+from pontifex.model import add_ready_listener, remove_ready_listener
+from pontifex.model import set_task_state, fill_task_roots, fill_task_depths
+from pontifex.model import fill_task_requests
 from numina.recipes.oblock import obsres_from_dict  
 # create logger
 _logger = logging.getLogger("pontifex.server")
 
 # Processing tasks STATES
-CREATED, COMPLETED, ENQUEUED, PROCESSING, FINISHED, ERROR = range(6)
+from pontifex.model import CREATED, COMPLETED, ENQUEUED, PROCESSING, FINISHED, ERROR
 
-from model import taskdir, datadir, productsdir, DataProduct, RecipeConfiguration
+from model import taskdir, datadir, productsdir, storedir, DataProduct, RecipeConfiguration
 
-def process_(session, task, instrument):
-    
+def process_(session, task, instrument, store):
+    '''Prepare the work directory of a task, staging from store.'''
     node = task.obsresult_node
     obsmode = node.observing_mode
       
@@ -65,8 +76,7 @@ def process_(session, task, instrument):
         
     _logger.info('matching parameters')
     
-    request = eval(task.request)
-    pset = request['pset']
+    pset = task.pset_name
 
     psetf = session.query(ProcessingSet).filter_by(instrument=instrument, 
                                                   name=pset).one()
@@ -90,37 +100,28 @@ def process_(session, task, instrument):
 
     _logger.info('creating root directory')
 
-    basedir = str(task.id)
-    os.chdir(taskdir)
-    _logger.info('root directory is %s', basedir)
-
-    basedir = os.path.abspath(basedir)
-    workdir = os.path.join(basedir, 'work')
-    resultsdir = os.path.join(basedir, 'results')
-
-    os.mkdir(basedir)
-    os.mkdir(workdir)
-    os.mkdir(resultsdir)
-
-    os.chdir(basedir)
+    ctx = TaskContext(taskdir, task.id)
+    _logger.info('root directory is %s', ctx.basedir)
+    ctx.create()
+    workdir = ctx.workdir
    
     _logger.info('create config files, put them in root dir')
     
-    _logger.info('copying the frames')
+    _logger.info('staging the frames')
     images = []
     for frame in node.frames:
-        _logger.debug('copy %s', frame.name)
+        _logger.debug('stage %s', frame.name)
         images.append(str(frame.name))
-        shutil.copy(os.path.join(datadir, frame.name), workdir)
+        store.stage_frame(frame, datadir, workdir)
 
-    _logger.info('copying the children results')
+    _logger.info('staging the children results')
     children_results = []
     for child in task.children:
         for rresult in child.rresult:
             for dp in rresult.data_product:
-                _logger.debug('copy %s', dp.reference)
+                _logger.debug('stage %s', dp.reference)
                 children_results.append(dp.reference)
-                shutil.copy(os.path.join(productsdir, dp.reference), workdir)
+                store.stage_product(dp, productsdir, workdir)
 
     config = {'observing_result': {'id': task.id, 
         'frames': images,
@@ -136,7 +137,7 @@ def process_(session, task, instrument):
     # FIXME: dummy value
     names.test = 100
     _logger.info('writing task control')
-    filename_yaml = os.path.join(resultsdir, 'task-control.yaml')
+    filename_yaml = ctx.results('task-control.yaml')
     
     with open(filename_yaml, 'w+') as fp:
         yaml.dump(config, fp)
@@ -145,10 +146,11 @@ def process_(session, task, instrument):
     return config, ob, names
 
 
-def create_reduction_tree(session, otask, rparent, instrument, pset='default'):
+def create_reduction_tree(session, otask, rparent, instrument, pset='default', channel=None):
     '''Climb the tree and create DataProcessingTask in nodes.'''
     rtask = DataProcessingTask()
     rtask.parent = rparent
+    rtask.channel = channel
     rtask.obsresult_node = otask
     rtask.creation_time = datetime.utcnow()
     if otask.state == 2:
@@ -156,8 +158,7 @@ def create_reduction_tree(session, otask, rparent, instrument, pset='default'):
     else:
         rtask.state = CREATED
     rtask.method = 'process%s' % otask.label.capitalize()
-    request = {'pset': pset, 'instrument': instrument}
-    rtask.request = str(request)
+    rtask.request = {'pset': pset, 'instrument': instrument}
 
     if otask.children:
         rtask.waiting = True
@@ -167,26 +168,65 @@ def create_reduction_tree(session, otask, rparent, instrument, pset='default'):
     session.add(rtask)
 
     for child in otask.children:
-        create_reduction_tree(child, rtask, instrument, pset=pset)
+        create_reduction_tree(session, child, rtask, instrument, pset=pset, channel=channel)
     
     return rtask
 
 class PontifexServer(object):
-    def __init__(self):
+    def __init__(self, reservations=None, burst=4, staging=None, batch=4, 
+                 lease=30):
         super(PontifexServer, self).__init__()
 
         self.doned = False
-        self.queue = Queue()
+        self.halt = threading.Event()
+        # (priority, taskid) of the tasks to be sent
+        self.queue = ChannelQueue(burst)
+        self.burst = burst
+        # maximum number of tasks taken by a consumer at once
+        self.batch = batch
+        # idle hosts reserved to the tasks of each channel, by name
+        if reservations is None:
+            reservations = {}
+        self.reservations = reservations
+        # staging strategies of frames and products, by default all 
+        # of them, the first one that works is used
+        self.stager = Stager(staging)
+        # frames and products are staged from the content store
+        self.store = ContentStore(storedir, self.stager)
+        # products uploaded by the hosts
+        self.uploads = UploadStore(self.store)
         self.qback = Queue()
+        # ids of tasks ready to be enqueued, None wakes up the watchdog
+        self.ready = Queue()
         self.clientlock = threading.Lock()
-        self.client_hosts = {}
-        self.nclient_hosts = 0
+        # hosts must send a heartbeat before their lease, in seconds, expires
+        self.lease = lease
+        self.client_hosts = HostRegistry(self.clientlock, lease)
+        # inputs downloaded by each host
+        self.links = {}
 
         self.ins_config = {}
 
         init_pipeline_system()
 
         session = Session()
+        # tasks created before their requests were copied in them
+        filled = fill_task_requests(session)
+        if filled:
+            _logger.info('stored the processing set of %d tasks', filled)
+            session.commit()
+        # tasks created before their roots were stored in them
+        filled = fill_task_roots(session)
+        if filled:
+            _logger.info('stored the root of %d tasks', filled)
+            session.commit()
+        # tasks created before their depths were stored in them
+        filled = fill_task_depths(session)
+        if filled:
+            _logger.info('stored the depth of %d tasks', filled)
+            session.commit()
+        vocabulary.load(session)
+
         for instrument in session.query(Instrument):
             _logger.debug('loading configurations for %s', instrument.name)
             if instrument.valid_configuration:
@@ -197,103 +237,511 @@ class PontifexServer(object):
 
         _logger.info('loaded configuration for %s', self.ins_config.keys())
 
+        self.channels = {}
+        for channel in session.query(Channel):
+            self.channels[channel.id] = (channel.name, channel.priority)
+
+        _logger.info('loaded channels %s', [name for name, _ in self.channels.values()])
+
+        add_ready_listener(self.notify)
+
         _logger.info('ready')
 
     def quit(self):
         _logger.info('ending')
         self.doned = True
+        self.halt.set()
+        remove_ready_listener(self.notify)
+        # wake up the hosts waiting for tasks
+        for client in self.client_hosts.hosts.values():
+            client.proxy.close()
+        self.ready.put(None)
         self.qback.put(None)
         self.queue.put(None)
 
+    def notify(self, taskids):
+        '''Pass the ids of ready tasks to the watchdog.'''
+        for taskid in taskids:
+            self.ready.put(taskid)
+
+    def notify_ready(self, taskids):
+        '''Tasks made ready by other processes.'''
+        self.notify(taskids)
+        return True
+
     def version(self):
         return '1.0'
 
-    def register(self, hostid, host, port, capabilities):
-        with self.clientlock:
-            if hostid not in self.client_hosts:
-                self.nclient_hosts += 1
-                self.client_hosts[hostid]= [ServerProxy('http://%s:%d' % (host, port)), (host, port), capabilities, True]
-                _logger.info('host registered %s %s:%d %s', hostid, host, port, capabilities)
+    def register(self, hostid, host, port, capabilities, slots=1, 
+                 transport='http'):
+        '''Register a host, listening in port with transport http or bin.
+
+        Hosts registered with transport pull fetch their tasks 
+        with fetch_task.
+        '''
+        if transport == 'pull':
+            proxy = Mailbox()
+        else:
+            # no more than one call per slot is made at the same time
+            proxy = make_proxy('%s://%s:%d' % (transport, host, port), slots)
+        if self.client_hosts.add(hostid, proxy, (host, port), capabilities, slots):
+            _logger.info('host registered %s %s://%s:%d %s with %d slots', 
+                         hostid, transport, host, port, capabilities, slots)
+            # a new idle host, look for work
+            self.ready.put(None)
 
     def unregister(self, hostid):
+        _logger.info('unregistering host %s', hostid)
+        client = self.client_hosts.remove(hostid)
+        if client is not None:
+            client.proxy.close()
+            with self.clientlock:
+                stats = self.links.pop(hostid, None)
+            if stats is not None:
+                _logger.info('inputs sent to host %s: %s', hostid, stats.report())
+            if client.tasks:
+                # their results will not be accepted
+                session = Session()
+                self._requeue(session, list(client.tasks))
+                session.commit()
+
+    def _mailbox(self, hostid, capabilities, slots):
+        '''Mailbox of a host pulling tasks, None if it must register again.'''
+        try:
+            client = self.client_hosts[hostid]
+        except KeyError:
+            return None
+        if not isinstance(client.proxy, Mailbox):
+            return None
+        # the tasks not fetched yet take slots
+        free = slots - len(client.proxy)
+        if self.client_hosts.offer(hostid, capabilities, free) is None:
+            return None
+        if free > 0:
+            # look for work for the free slots
+            self.ready.put(None)
+        return client.proxy
+
+    def fetch_task(self, hostid, capabilities, slots, timeout=30):
+        '''Wait up to timeout seconds for tasks for a host.
+
+        The host has slots free slots and can run tasks
+        of the instruments in capabilities. Returns a list of 
+        (taskid, recipe spec, observing result), or False if
+        the host must register again.
+        '''
+        mailbox = self._mailbox(hostid, capabilities, slots)
+        if mailbox is None:
+            return False
+        return mailbox.fetch(slots, timeout)
+
+    def fetch_task_later(self, reply, hostid, capabilities, slots, timeout=30):
+        '''fetch_task for event loops, reply is called with the result.
+
+        Returns the timeout and a function to call when it expires.
+        '''
+        mailbox = self._mailbox(hostid, capabilities, slots)
+        if mailbox is None:
+            reply(False)
+            return None
+        return timeout, mailbox.fetch_later(slots, reply)
+
+    def upload_begin(self, hostid, digest):
+        '''Start or resume the upload of a file, return the offset to send from.
+
+        Returns -1 if the file is already stored.
+        '''
+        return self.uploads.begin(hostid, digest)
+
+    def upload_chunk(self, hostid, digest, offset, data, checksum):
+        '''Receive a chunk of a file, return the offset of the next one.'''
+        if isinstance(data, xmlrpclib.Binary):
+            data = data.data
+        return self.uploads.chunk(hostid, digest, offset, data, checksum)
+
+    def upload_end(self, hostid, digest):
+        '''Store an uploaded file, return False if it is corrupted.'''
+        return self.uploads.end(hostid, digest)
+
+    def download(self, hostid, digest, offset, size, level=0):
+        '''Send a chunk of a stored file to a host, compressed with level.
+
+        Returns the level used, 0 if it is not compressed, and the data.
+        '''
+        start = time.time()
+        level, data, raw = read_chunk(self.store, digest, offset, size, level)
         with self.clientlock:
-            _logger.info('unregistering host %s', hostid)
-            self.nclient_hosts -= 1
-            del self.client_hosts[hostid]
-
-
-    def send_to_client(self, session, task, config, ob, names):
-        for idx in self.client_hosts:
-            server, (host, port), _, idle = self.client_hosts[idx]
-            if idle:
-                task.state = PROCESSING
-                task.host = '%s:%d' % (host, port)
-                _logger.info('sending to host %s', task.host)
+            stats = self.links.setdefault(hostid, TransferStats())
+        stats.add(raw, len(data), time.time() - start, 1 if offset == 0 else 0)
+        return level, xmlrpclib.Binary(data)
+
+    def transfers(self):
+        '''Bytes sent to each host with download.'''
+        with self.clientlock:
+            links = dict(self.links)
+        return dict((hostid, stats.report()) for hostid, stats in links.items())
+
+    def heartbeat(self, hostid, taskids):
+        '''Renew the leases of a host and its running tasks.
+
+        Returns False if the host must register again, else True, 
+        or the ids of the tasks the host must drop, as they 
+        belong to other hosts.
+        '''
+        unknown = self.client_hosts.renew(hostid, taskids)
+        if unknown is None:
+            return False
+        if not unknown:
+            return True
+        # tasks sent before the host registered again are adopted
+        # if they are still processed by the host
+        try:
+            client = self.client_hosts[hostid]
+        except KeyError:
+            return False
+        session = Session()
+        try:
+            owned = [taskid for taskid, in session.query(DataProcessingTask.id).filter(
+                        DataProcessingTask.id.in_(unknown), 
+                        DataProcessingTask.state == PROCESSING,
+                        DataProcessingTask.host == client.name)]
+        finally:
+            session.close()
+        adopted = set(self.client_hosts.adopt(hostid, owned))
+        dropped = [taskid for taskid in unknown if taskid not in adopted]
+        if dropped:
+            _logger.warning('host %s must drop tasks %s', hostid, dropped)
+            return dropped
+        return True
+
+    def _requeue(self, session, taskids):
+        '''Return tasks sent to hosts to the ready tasks.'''
+        requeued = set_task_state(session, COMPLETED, old=PROCESSING, 
+                                  ids=taskids, values={'host': None})
+        if requeued:
+            _logger.warning('requeued tasks %s', requeued)
+        return requeued
+
+    def reaper(self):
+        '''Requeue the tasks of hosts whose lease has expired.'''
+        session = Session()
+        started = time.time()
+        orphans = True
+        while not self.halt.wait(self.lease / 4.0):
+            evicted, taskids = self.client_hosts.expire()
+            for client in evicted:
+                _logger.warning('host %s evicted, its lease expired', client.name)
+                client.proxy.close()
+
+            if orphans and time.time() > started + self.lease:
+                # tasks sent before the server was started, 
+                # and not adopted by their hosts
+                orphans = False
+                leased = self.client_hosts.leased()
+                for task in session.query(DataProcessingTask.id).filter_by(state=PROCESSING):
+                    if task.id not in leased:
+                        taskids.append(task.id)
+
+            if taskids:
+                self._requeue(session, taskids)
                 session.commit()
-                # Passing the observing result
-                # as a pickled binary
-                pob = pickle.dumps(ob)
-                bpob = xmlrpclib.Binary(pob)
-                
-                server.pass_info(task.id, config, bpob, names)
-                with self.clientlock:
-                    self.nclient_hosts -= 1
-                    self.client_hosts[idx][3] = False
-                return idx
+        _logger.info('reaper finished')
+
+    def _channel(self, channel_id):
+        '''Name and priority of a channel.'''
+        return self.channels.get(channel_id, ('default', 0))
+
+    def _reserved_for_others(self, channel_id):
+        '''Number of idle hosts the tasks of a channel must leave free.'''
+        name, _ = self._channel(channel_id)
+        return sum(n for ch, n in self.reservations.items() if ch != name)
+
+    def send_to_client(self, session, task, instrument, config, ob, names):
+        client = self.client_hosts.claim(instrument, 
+                        keep=self._reserved_for_others(task.channel_id))
+        if client is None:
+            return None
+
+        task.state = PROCESSING
+        task.host = client.name
+        self.client_hosts.assign(client.hostid, task.id)
+        _logger.info('sending to host %s', task.host)
+        session.commit()
+        # Passing the observing result
+        # as a pickled binary, with XML-RPC
+        bpob = pack(client.proxy, ob)
         
-        return None
+        client.proxy.pass_info(task.id, config, bpob, names)
+        return client.hostid
     
-    def send_to_client2(self, session, task, recipe, ob):
-        for idx in self.client_hosts:
-            server, (host, port), _, idle = self.client_hosts[idx]
-            if idle:
-                task.state = PROCESSING
-                task.host = '%s:%d' % (host, port)
-                _logger.info('sending to host %s', task.host)
-                session.commit()
-                # Passing the observing result
-                # as a pickled binary
-                precipe = pickle.dumps(recipe)
-                bprecipe = xmlrpclib.Binary(precipe)
-                pob = pickle.dumps(ob)
-                bpob = xmlrpclib.Binary(pob)
-                
-                server.pass_info(task.id, bprecipe, bpob)
-                with self.clientlock:
-                    self.nclient_hosts -= 1
-                    self.client_hosts[idx][3] = False
-                return idx
+    def send_to_client2(self, session, task, instrument, recipe, ob):
+        client = self.client_hosts.claim(instrument, 
+                        keep=self._reserved_for_others(task.channel_id))
+        if client is None:
+            return None
+
+        task.state = PROCESSING
+        task.host = client.name
+        self.client_hosts.assign(client.hostid, task.id)
+        _logger.info('sending to host %s', task.host)
+        session.commit()
+        # Passing the observing result
+        # as a pickled binary, with XML-RPC
+        bprecipe = pack(client.proxy, recipe)
+        bpob = pack(client.proxy, ob)
         
-        return None
+        client.proxy.pass_info(task.id, bprecipe, bpob)
+        return client.hostid
+
+    def send_to_clients(self, session, prepared):
+        '''Send prepared tasks to the hosts.
+
+        prepared is a list of (task, instrument, recipe spec, observing result).
+        The tasks going to the same host are passed in one call.
+        Returns the tasks for which there is no idle host.
+        '''
+        clients = OrderedDict()
+        unsent = []
+        for item in prepared:
+            task, instrument = item[:2]
+            client = self.client_hosts.claim(instrument, 
+                            keep=self._reserved_for_others(task.channel_id))
+            if client is None:
+                unsent.append(task)
+                continue
+            task.state = PROCESSING
+            task.host = client.name
+            self.client_hosts.assign(client.hostid, task.id)
+            clients.setdefault(client.hostid, (client, []))[1].append(item)
+        session.commit()
+
+        for client, items in clients.values():
+            size = sum(size for _, _, spec, _ in items 
+                            for _, _, size in spec['inputs'])
+            _logger.info('sending %d tasks to host %s, %d bytes of inputs', 
+                         len(items), client.name, size)
+            tasks = [(task.id, pack(client.proxy, spec), pack(client.proxy, ob))
+                        for task, _, spec, ob in items]
+            try:
+                if len(tasks) == 1:
+                    client.proxy.pass_info(*tasks[0])
+                else:
+                    client.proxy.pass_info_many(tasks)
+            except Exception as error:
+                _logger.warning('cannot send tasks to host %s, evicting it: %s',
+                                client.name, error)
+                # its tasks, these ones included, are ready again
+                self.unregister(client.hostid)
+        return unsent
+
+    def _enqueue(self, session, tasks):
+        # tasks of higher priority channels go first
+        groups = {}
+        for task in tasks:
+            if task.state != COMPLETED or task.waiting is not False:
+                # already enqueued by someone else
+                continue
+            _, priority = self._channel(task.channel_id)
+            groups.setdefault(priority, []).append(task)
+
+        # inside a channel, tasks in the critical path go first
+        pending = pending_siblings(session, 
+                        [task for group in groups.values() for task in group])
+        ordered = interleave([critical_path_order(groups[p], pending) 
+                                for p in sorted(groups, reverse=True)], 
+                             self.burst)
+
+        # the tasks of each instrument that can be sent to idle hosts
+        budget = {}
+        nidle = self.client_hosts.nidle()
+        selected = []
+        for task in ordered:
+            if nidle <= 0:
+                break
+            instrument = task.instrument_id
+            if instrument not in budget:
+                budget[instrument] = self.client_hosts.nidle(instrument)
+            if budget[instrument] <= self._reserved_for_others(task.channel_id):
+                continue
+            budget[instrument] -= 1
+            nidle -= 1
+            _, priority = self._channel(task.channel_id)
+            selected.append((priority, task.id))
+
+        if not selected:
+            return
+
+        # only the tasks still ready are enqueued
+        enqueued = set(set_task_state(session, ENQUEUED, old=COMPLETED, 
+                                      ids=[taskid for _, taskid in selected],
+                                      waiting=False))
+        session.commit()
+        for priority, taskid in selected:
+            if taskid in enqueued:
+                _logger.info('enqueueing task %d ', taskid)
+                # sending to consumer
+                self.queue.put((priority, taskid))
 
     def watchdog(self, pollfreq):
+        '''Send ready tasks to the consumer.
+
+        Tasks are enqueued as soon as their ids are notified. 
+        The database is swept for ready tasks when a host becomes
+        idle and every pollfreq seconds, to catch tasks made 
+        ready by other processes. The requests of sweeps queued 
+        meanwhile are served by one sweep.
+        '''
         session = Session()
+        # first sweep on startup
+        self.ready.put(None)
         while True:
+            try:
+                tokens = [self.ready.get(timeout=pollfreq)]
+            except Empty:
+                tokens = [None]
+            while True:
+                try:
+                    tokens.append(self.ready.get_nowait())
+                except Empty:
+                    break
             if self.doned:
                 _logger.info('cleaning up pending jobs')
-                for task in session.query(DataProcessingTask).filter_by(state=ENQUEUED):
-                    task.state = COMPLETED
+                set_task_state(session, COMPLETED, old=ENQUEUED)
                 session.commit()
                 _logger.info('watchdog finished')
                 return
-            else:            
-                time.sleep(pollfreq)                
-                for task in session.query(DataProcessingTask).filter_by(state=COMPLETED, waiting=False)[:self.nclient_hosts]:
-                    _logger.info('enqueueing task %d ', task.id)
-                    task.state = ENQUEUED
-    
-                    session.commit()
-                    # sending to consumer
-                    self.queue.put(task.id)
+            elif None not in tokens:
+                # the tasks without an idle host will be found in a sweep
+                tasks = session.query(DataProcessingTask).filter(DataProcessingTask.id.in_(tokens))
+                self._enqueue(session, tasks.all())
+            else:
+                # the sweep finds the notified tasks too, only the tasks 
+                # of instruments with idle hosts can be sent
+                capabilities = self.client_hosts.idle_capabilities()
+                nidle = self.client_hosts.nidle()
+                if capabilities and nidle > 0:
+                    self._enqueue(session, ready_tasks(session, capabilities, nidle))
+
+    def _insert_products(self, session, task, rr, result):
+        '''Create the DataProducts of a result and store their files.'''
+        # products are relative to the work directory of the task
+        ctx = TaskContext(taskdir, task.id)
+        # digests of the uploaded files
+        uploaded = result.get('files') or {}
+        products = []
+        try:
+            for pr in result['products']:
+                # objects of the pipelines, newer versions of yaml 
+                # only load them with the full Loader
+                prod = yaml.load(pr, Loader=yaml.Loader)
+
+                dp = DataProduct()
+                products.append(dp)
+                dp.instrument_id = task.instrument_id
+                dp.datatype = '%s.%s' % (prod.__class__.__module__, prod.__class__.__name__)
+                # FIXME: this is specific for FITS files (classes that subclass Image)
+                dp.reference = prod.filename
+                dp.result = rr
+                dp.pset_name = task.pset_name
+
+                _logger.debug('extracting meta')
+                for key, val in prod.metadata():
+                    _logger.debug('metadata is (%s, %s)', key, val)
+                    # interned, no queries once the value is known
+                    v = vocabulary.value(session, dp.instrument_id, key, val)
+                    if v is None:
+                        _logger.warning('no context description %s for %s', 
+                                        key, dp.instrument_id)
+                        continue
+                    dp.context.append(v)
+
+                # identical products are stored once, the hosts
+                # without a shared filesystem have uploaded them
+                dp.digest = uploaded.get(product_name(prod.filename))
+                if dp.digest is None:
+                    dp.digest = self.store.add(ctx.work(prod.filename))
+                _logger.debug('linking product %s in %s', dp.digest, productsdir)
+                # FIXME: no description
+                self.store.stage(dp.digest, productsdir, 
+                                 os.path.basename(dp.reference))
+                # in 'products'
+                dp.task = task
+                session.add(dp)
+        except:
+            # the products are added to the session with their
+            # context values, they are taken out of both
+            for dp in products:
+                dp.context = []
+            for obj in products + [rr]:
+                if obj in session:
+                    session.expunge(obj)
+            raise
+        return products
+
+    def _insert_result(self, session, taskid, result):
+        '''Update a task with its result.'''
+        _logger.info('received result: %r', result)
+        _logger.info('updating done work, ProcessingTask %d', int(taskid))
+        task = session.query(DataProcessingTask).filter_by(id=taskid).one() 
+
+        task.completion_time = datetime.utcnow()
+        results = {}
+
+        if 'error' not in result:
+            rr = ReductionResult()
+            rr.other = result
+            rr.task_id = task.id
+            rr.obsres_id = task.obsresult_node_id
+            try:
+                self._insert_products(session, task, rr, result)
+            except Exception as error:
+                _logger.warning('cannot insert the products of task %d', task.id)
+                result = {'error': {'type': error.__class__.__name__, 
+                                    'message': str(error)}}
+
+        if 'error' not in result:
+            _logger.info('result is correct')
+            task.state = FINISHED
+
+            # Update parent waiting state
+            _logger.debug('checking parent waiting state')
+            if task.parent is not None:
+                parent = task.parent
+                for child in parent.children:
+                    if child.id == task.id:
+                        # myself, ignoring
+                        continue
+                    if child.state != FINISHED:
+                        break
+                else:
+                    _logger.info('updating parent waiting state')
+                    parent.waiting = False
+
+            results['control'] = ['task-control.json']
+            results['log'] = ['processing.log']
+            results['products'] = result['products']
+            task.result = results
+            session.add(rr)
+        else:
+            _logger.info('result is an error')
+            results['error'] = result['error']
+            _logger.warning('error in task %d', task.id)
+            _logger.warning('error is %s', results['error']['type'])
+            _logger.warning('message is %s', results['error']['message'])
+            task.result = results
+            task.state = ERROR
+
 
     def inserter(self):
+        '''Update the tasks with the results received from the hosts.
+
+        The results received together are committed together.
+        '''
         session = Session()
         # clean up on startup
-        q = session.query(DataProcessingTask).filter_by(state=ENQUEUED)
-        for i in q:
-            _logger.info('fixing job %d', i.id)
-            i.state = COMPLETED
+        fixed = set_task_state(session, COMPLETED, old=ENQUEUED)
         session.commit()
+        _logger.info('fixed %d jobs', len(fixed))
 
         while True:
             token = self.qback.get()
@@ -301,115 +749,23 @@ class PontifexServer(object):
                 _logger.info('inserter finished')
                 return
             else:
-                _, result, taskid = token
-                _logger.info('received result: %r', result)
-                _logger.info('updating done work, ProcessingTask %d', int(taskid))
-                task = session.query(DataProcessingTask).filter_by(id=taskid).one() 
-
-                task.completion_time = datetime.utcnow()
-                request = eval(task.request)
-                results = {}
-
-                if 'error' not in result:
-                    _logger.info('result is correct')
-                    task.state = FINISHED
-                    
-                    #cwd = os.getcwd()
-                    os.chdir(os.path.abspath('results'))
-
-                    # Update parent waiting state
-                    _logger.debug('checking parent waiting state')
-                    if task.parent is not None:
-                        parent = task.parent
-                        for child in parent.children:
-                            if child.id == task.id:
-                                # myself, ignoring
-                                continue
-                            if child.state != FINISHED:
-                                break
-                        else:
-                            _logger.info('updating parent waiting state')
-                            parent.waiting = False
-
-                    # finding parent node
-                    # FIXME: find a better way of doing this:
-                    # Recover the instrument of the task
-                    otask = task
-                    while(otask.parent):
-                        otask = otask.parent
-    
-                    ob = otask.obsresult_node.observing_block
-                    
-                    iname = ob.obsrun.instrument_id
-
-                    results['control'] = ['task-control.json']
-                    results['log'] = ['processing.log']
-                    results['products'] = result['products']
-                    
-                    task.result = str(results)
-                    rr = ReductionResult()
-                    rr.other = str(result)
-                    rr.task_id = task.id
-                    rr.obsres_id = task.obsresult_node_id
-
-                    # processing data products
-                    #for pr in result['products']:
-                    for pr in []:
-                        prod = yaml.load(pr)
-                
-                        dp = DataProduct()
-                        dp.instrument_id = iname
-                        dp.datatype = '%s.%s' % (prod.__class__.__module__, prod.__class__.__name__)
-                        # FIXME: this is specific for FITS files (classes that subclass Image)
-                        dp.reference = prod.filename
-                        dp.result = rr
-                        dp.pset_name = request['pset']
-                        
-                        _logger.debug('extracting meta')
-                        for key, val in prod.metadata():
-                            _logger.debug('metadata is (%s, %s)', key, val)
-                            # FIXME: probably there is a better way of doing this
-                            q = session.query(ContextDescription).filter_by(instrument_id=dp.instrument_id, name=key).first()
-                            v = session.query(ContextValue).filter_by(definition=q, value=val).first()
-
-                            if v is None:
-                                _logger.debug('creating metadata for %s', key)
-                                v = ContextValue()
-                                v.definition[q.together] = q
-                                v.value = val
-                                session.add(v)
-                            
-                            dp.context.append(v)
-
-                        # copy or hardlink the file
-                        _logger.debug('copying product in %s', productsdir)
-                        # FIXME: no description
-                        shutil.copy(prod.filename, productsdir)
-                        # in 'products'
-                        dp.task = task
-                        session.add(dp)
-
-                    session.add(rr)
-                else:
-                    _logger.info('result is an error')
-                    results['error'] = result['error']
-                    _logger.warning('error in task %d', task.id)
-                    _logger.warning('error is %s', results['error']['type'])
-                    _logger.warning('message is %s', results['error']['message'])
-                    task.result = str(results)
-                    task.state = ERROR
-
+                _, results = token
+                _logger.info('updating %d ProcessingTasks', len(results))
+                for taskid, result in results:
+                    self._insert_result(session, int(taskid), result)
                 session.commit()
                 self.qback.task_done()
 
     def consumer_(self):
         session = Session()
         while True:
-            taskid = self.queue.get()
-            if self.doned or taskid is None:
+            token = self.queue.get()
+            if self.doned or token is None:
                 _logger.info('consumer is finished')
                 return
             else:
+                _, taskid = token
+                self.queue.task_done()
                 task = session.query(DataProcessingTask).filter_by(id=taskid).first()
                 task.start_time = datetime.utcnow()
 
@@ -419,22 +775,15 @@ class PontifexServer(object):
                     children = task.children
                     frames = task.obsresult_node.frames
                     mode = task.obsresult_node.observing_mode.key
-                    request = eval(task.request)
+                    request = task.request
                                                             
-                    # finding parent node
-                    # FIXME: find a better way of doing this:
-                    # Recover the instrument of the task
-                    otask = task
-                    while(otask.parent):
-                        otask = otask.parent
-    
-                    ob = otask.obsresult_node.observing_block
-                    
-                    instrument = ob.obsrun.instrument
-                    ins_params = self.ins_config[ob.obsrun.instrument_id]
+                    # in the identity map after the first task
+                    instrument = session.query(Instrument).get(task.instrument_id)
+                    ins_params = self.ins_config[task.instrument_id]
                     # context = task.obsresult_node.context
                     
-                    config, ob, names = process_(session, task=task, instrument=instrument)
+                    config, ob, names = process_(session, task=task, instrument=instrument,
+                                                     store=self.store)
                     
                     #val = fun(session, **kwds)
                 except Exception as ex:
@@ -445,152 +794,204 @@ class PontifexServer(object):
                     session.commit()
                 else:
                     _logger.info('finding host for task=%d', taskid)
-                    cid = self.send_to_client(session, task, config, ob, names)
+                    cid = self.send_to_client(session, task, instrument.name, config, ob, names)
                     if cid is not None:
                         _logger.info('processing taskid %d in host %s', taskid, cid)
                     else:
                         _logger.warning('no host for taskid %d', taskid)
-                        self.queue.task_done()                    
-                        self.qback.put((0, 1, task.id))
+                        # back to the ready tasks, it will be enqueued
+                        # again when a host for its instrument is idle
+                        task.state = COMPLETED
                     session.commit()
                     
-    def consumer(self):
-        session = Session()
-        while True:
-            taskid = self.queue.get()
-            if self.doned or taskid is None:
-                _logger.info('consumer is finished')
-                return
-            else:
-                task = session.query(DataProcessingTask).filter_by(id=taskid).first()
-                task.start_time = datetime.utcnow()
-                try:                                        
-                    # finding parent node
-                    # FIXME: find a better way of doing this:
-                    # Recover the instrument of the task
-                    otask = task
-                    while(otask.parent):
-                        otask = otask.parent
-    
-                    ob = otask.obsresult_node.observing_block
-                    
-                    instrument = ob.obsrun.instrument
-                    # context = task.obsresult_node.context
-                    node = task.obsresult_node
-                    obsmode = node.observing_mode
+    def _prepare(self, session, taskid):
+        '''Prepare the work directory of a task.
+
+        Returns (task, instrument name, recipe spec, observing result)
+        or None if the task can't be prepared. The spec has the
+        recipe name, its version and its parameters.
+        '''
+        task = session.query(DataProcessingTask).filter_by(id=taskid).first()
+        task.start_time = datetime.utcnow()
+        try:
+            # in the identity map after the first task
+            instrument = session.query(Instrument).get(task.instrument_id)
+            # context = task.obsresult_node.context
+            node = task.obsresult_node
+            obsmode = node.observing_mode
       
-                    _logger.info('process called')
-                    _logger.info('obsmode is %s', obsmode.key)
-                    _logger.info('recipe is %s', obsmode.module)
-                    try:
-                        recipeClass = import_object(obsmode.module)
-                    except ImportError:
-                        _logger.warning('cannot find entry point for %s', obsmode.module)
-                        raise ValueError
-        
-                    _logger.info('matching parameters')
+            _logger.info('process called')
+            _logger.info('obsmode is %s', obsmode.key)
+            _logger.info('recipe is %s', obsmode.module)
+            try:
+                recipeClass = import_object(obsmode.module)
+            except ImportError:
+                _logger.warning('cannot find entry point for %s', obsmode.module)
+                raise ValueError
+
+            _logger.info('matching parameters')
     
-                    request = eval(task.request)
-                    pset = request['pset']
+            pset = task.pset_name
 
-                    psetf = session.query(ProcessingSet).filter_by(instrument=instrument, 
-                                                  name=pset).one()
-                    parameters = {}
+            psetf = session.query(ProcessingSet).filter_by(instrument=instrument, 
+                                          name=pset).one()
+            parameters = {}
     
-                    stored_parameters = session.query(RecipeConfiguration).filter_by( 
-                                        module=obsmode.module, 
-                                        processing_set=psetf                                        
-                                        ).first()
+            stored_parameters = session.query(RecipeConfiguration).filter_by( 
+                                module=obsmode.module, 
+                                processing_set=psetf                                        
+                                ).first()
 
-                    if stored_parameters is None:
-                        _logger.info('no stored parameters for this recipe')
-                        stored_parameters = {}
+            if stored_parameters is None:
+                _logger.info('no stored parameters for this recipe')
+            else:
+                parameters = stored_parameters.parameters
 
-                    for req in recipeClass.__requires__:
-                        _logger.info('recipe requires %s', req.name)
-                        _logger.info('default value is %s', req.value)
+            for req in recipeClass.__requires__:
+                _logger.info('recipe requires %s', req.name)
+                _logger.info('default value is %s', req.value)
+    
+            for req in recipeClass.__provides__:
+                _logger.info('recipe provides %s', req)
+    
+            _logger.info('creating root directory')
+
+            # several consumers run concurrently, 
+            # so we don't change the working directory
+            ctx = TaskContext(taskdir, task.id)
+            _logger.info('root directory is %s', ctx.basedir)
+        
+            # the directories exist if the task was enqueued before
+            ctx.create()
+            workdir = ctx.workdir
+           
+            _logger.info('create config files, put them in root dir')
             
-                    for req in recipeClass.__provides__:
-                        _logger.info('recipe provides %s', req)
+            _logger.info('staging the frames')
+            images = []
+            # (name, digest, size) of the staged files, for the 
+            # hosts that download them
+            inputs = []
+            for frame in node.frames:
+                _logger.debug('stage %s', frame.name)
+                images.append((str(frame.name), 'UNKNOWN_TYPE'))
+                staged = self.store.stage_frame(frame, datadir, workdir)
+                inputs.append((str(frame.name), str(frame.digest), 
+                               os.path.getsize(staged)))
+        
+            _logger.info('staging the children results')
+            children_results = []
+            for child in task.children:
+                for rresult in child.rresult:
+                    for dp in rresult.data_product:
+                        _logger.debug('stage %s', dp.reference)
+                        children_results.append(dp.reference)
+                        staged = self.store.stage_product(dp, productsdir, workdir)
+                        inputs.append((str(dp.reference), str(dp.digest), 
+                                       os.path.getsize(staged)))
+        
+            config = {'observing_result': {'id': task.id, 
+                'frames': images,
+                'children': children_results,
+                'instrument': str(instrument.name),
+                'mode': str(obsmode.key),
+                }, 
+                'reduction': {'recipe': str(obsmode.module), 'parameters': parameters, 'processing_set': pset},
+                'instrument': str(instrument.name)
+                }
+            obres_trans = obsres_from_dict(config['observing_result'])
+            # the hosts import and instantiate the recipe
+            spec = {'recipe': str(obsmode.module), 
+                    'version': obsmode.recipe_version,
+                    'parameters': parameters,
+                    'inputs': inputs}
+            _logger.info('writing task control')
+            filename_yaml = ctx.results('task-control.yaml')
             
-                    _logger.info('creating root directory')
-
-                    basedir = str(task.id)
-                    os.chdir(taskdir)
-                    _logger.info('root directory is %s', basedir)
-                
-                    basedir = os.path.abspath(basedir)
-                    workdir = os.path.join(basedir, 'work')
-                    resultsdir = os.path.join(basedir, 'results')
-                
-                    os.mkdir(basedir)
-                    os.mkdir(workdir)
-                    os.mkdir(resultsdir)
-                
-                    os.chdir(basedir)
-                   
-                    _logger.info('create config files, put them in root dir')
-                    
-                    _logger.info('copying the frames')
-                    images = []
-                    for frame in node.frames:
-                        _logger.debug('copy %s', frame.name)
-                        images.append((str(frame.name), 'UNKNOWN_TYPE'))
-                        shutil.copy(os.path.join(datadir, frame.name), workdir)
-                
-                    _logger.info('copying the children results')
-                    children_results = []
-                    for child in task.children:
-                        for rresult in child.rresult:
-                            for dp in rresult.data_product:
-                                _logger.debug('copy %s', dp.reference)
-                                children_results.append(dp.reference)
-                                shutil.copy(os.path.join(productsdir, dp.reference), workdir)
-                
-                    config = {'observing_result': {'id': task.id, 
-                        'frames': images,
-                        'children': children_results,
-                        'instrument': str(instrument.name),
-                        'mode': str(obsmode.key),
-                        }, 
-                        'reduction': {'recipe': str(obsmode.module), 'parameters': parameters, 'processing_set': pset},
-                        'instrument': str(instrument.name)
-                        }
-                    obres_trans = obsres_from_dict(config['observing_result'])
-                    _logger.info('writing task control')
-                    filename_yaml = os.path.join(resultsdir, 'task-control.yaml')
-                    
-                    with open(filename_yaml, 'w+') as fp:
-                        yaml.dump(config, fp)
-                
-                    _logger.info('done')
-                    
-                    #val = fun(session, **kwds)
-                except Exception as ex:
-                    task.completion_time = datetime.utcnow()
-                    task.state = ERROR
-                    _logger.warning('error creating root for task %d', taskid)
-                    _logger.warning('error is %s', ex)
-                    session.commit()
-                else:
-                    recipe = recipeClass()
-                    _logger.info('finding host for task=%d', taskid)
-                    #cid = self.send_to_client(session, task, config, ob, names)
-                    cid = self.send_to_client2(session, task, recipe, obres_trans)
-                    if cid is not None:
-                        _logger.info('processing taskid %d in host %s', taskid, cid)
-                    else:
-                        _logger.warning('no host for taskid %d', taskid)
-                        self.queue.task_done()                    
-                        self.qback.put((0, 1, task.id))
-                    session.commit()
-                    
+            with open(filename_yaml, 'w+') as fp:
+                yaml.dump(config, fp)
+        
+            _logger.info('done')
+            
+            #val = fun(session, **kwds)
+        except Exception as ex:
+            task.completion_time = datetime.utcnow()
+            task.state = ERROR
+            _logger.warning('error creating root for task %d', taskid)
+            _logger.warning('error is %s', ex)
+            session.commit()
+            return None
+
+        return task, instrument.name, spec, obres_trans
+
+    def consumer(self):
+        '''Prepare the enqueued tasks and send them to the hosts.
+
+        Several consumers can run in parallel, each one in its
+        own thread and with its own session. Each consumer takes
+        up to batch tasks that are already enqueued, and the tasks 
+        going to the same host are sent together.
+        '''
+        session = Session()
+        while True:
+            token = self.queue.get()
+            if self.doned or token is None:
+                # wake up the other consumers
+                self.queue.put(None)
+                _logger.info('consumer is finished')
+                return
+
+            tokens = [token]
+            while len(tokens) < self.batch:
+                try:
+                    token = self.queue.get_nowait()
+                except Empty:
+                    break
+                if token is None:
+                    # handled in the next iteration
+                    self.queue.put(None)
+                    break
+                tokens.append(token)
+
+            prepared = []
+            for _, taskid in tokens:
+                item = self._prepare(session, taskid)
+                if item is not None:
+                    prepared.append(item)
+            # the tasks are tracked by their leases once sent,
+            # the hosts may send results of tasks not taken from 
+            # this queue, adopted after a restart
+            for _ in tokens:
+                self.queue.task_done()
+
+            if not prepared:
+                continue
+
+            _logger.info('finding hosts for %d tasks', len(prepared))
+            for task in self.send_to_clients(session, prepared):
+                _logger.warning('no host for taskid %d', task.id)
+                # back to the ready tasks, it will be enqueued
+                # again when a host for its instrument is idle
+                task.state = COMPLETED
+            session.commit()
+
     def receiver(self, cid, result, taskid):
-        self.queue.task_done()
-        self.qback.put((cid, result, taskid))
-        with self.clientlock:
-            self.nclient_hosts += 1
-            self.client_hosts[cid][3] = True
+        self.receiver_many(cid, [(taskid, result)])
+
+    def receiver_many(self, cid, results):
+        '''Receive a list of (taskid, result) from a host.'''
+        accepted = []
+        for taskid, result in results:
+            if self.client_hosts.finish(cid, taskid):
+                accepted.append((taskid, result))
+            else:
+                # the task has been requeued
+                _logger.warning('discarding result of taskid %d, '
+                                'its lease has expired', taskid)
+        if accepted:
+            self.qback.put((cid, accepted))
+        # a host is idle, look for more work
+        self.ready.put(None)
 
     def pset_create(self, name, instrument):
         '''Create a new processing set'''
@@ -614,8 +1015,11 @@ class PontifexServer(object):
             session.add(pset)
             session.commit()
 
-    def run(self, obsid, pset='default'):
-        '''Insert a new processing task tree in the database.'''
+    def run(self, obsid, pset='default', channel='default'):
+        '''Insert a new processing task tree in the database.
+
+        Returns the id of its root task.
+        '''
 
         _logger.info('create a new task tree for obsid %d', obsid)
         session = Session()
@@ -623,11 +1027,17 @@ class PontifexServer(object):
         obsblock = session.query(ObservingBlock).filter_by(id=obsid).first()
         if obsblock is not None:
             _logger.info('observing tasks tree')
+
+            ch = session.query(Channel).filter_by(name=channel).first()
+            if ch is None:
+                _logger.warning('No channel with name %s, using default', channel)
         
             rtask = create_reduction_tree(session, 
                                           obsblock.observation_result, None, 
-                                        obsblock.obsrun.instrument_id, pset)
-            _logger.info('new root processing task is %d', rtask.id)
+                                        obsblock.obsrun.instrument_id, pset, ch)
+            # ready leaves are notified to the watchdog on commit
             session.commit()
+            _logger.info('new root processing task is %d', rtask.id)
+            return rtask.id
         else:
             _logger.warning('No observing block with id %d', obsid)
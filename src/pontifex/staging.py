@@ -0,0 +1,146 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Staging of frames and products in the work directory of tasks.
+
+Files can be staged by:
+ * reflink, a copy on write clone of the file, where the filesystem
+   supports it (btrfs, xfs)
+ * hardlink, in the same filesystem
+ * symlink
+ * copy
+
+Hardlinks and symlinks share the data with the original file, so
+the original is made read-only before linking it. Recipes must
+write their results in new files, not modify their inputs.
+'''
+
+import os
+import stat
+import shutil
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_logger = logging.getLogger("pontifex.staging")
+
+REFLINK, HARDLINK, SYMLINK, COPY = 'reflink', 'hardlink', 'symlink', 'copy'
+
+STRATEGIES = [REFLINK, HARDLINK, SYMLINK, COPY]
+
+# from linux/fs.h
+_FICLONE = 0x40049409
+
+def _make_readonly(src):
+    mode = os.stat(src).st_mode
+    if mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        os.chmod(src, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError('reflink is not supported in this platform')
+    with open(src, 'rb') as fsrc:
+        try:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            os.unlink(dst)
+            raise
+
+def _hardlink(src, dst):
+    _make_readonly(src)
+    os.link(src, dst)
+
+def _symlink(src, dst):
+    _make_readonly(src)
+    os.symlink(os.path.abspath(src), dst)
+
+def _copy(src, dst):
+    shutil.copy(src, dst)
+
+_stagers = {REFLINK: _reflink, HARDLINK: _hardlink,
+            SYMLINK: _symlink, COPY: _copy}
+
+class Stager(object):
+    '''Stage files using the first strategy that works.
+
+    The strategy that works between two filesystems is remembered
+    and tried first for the next files.
+    '''
+    def __init__(self, strategies=None):
+        super(Stager, self).__init__()
+        if strategies is None:
+            strategies = STRATEGIES
+        if not strategies:
+            raise ValueError('no staging strategies')
+        for strategy in strategies:
+            if strategy not in _stagers:
+                raise ValueError('unknown staging strategy %s' % strategy)
+        self.strategies = list(strategies)
+        self.chosen = {}
+        self.lock = threading.Lock()
+
+    def _candidates(self, key):
+        with self.lock:
+            chosen = self.chosen.get(key)
+        if chosen is None:
+            return self.strategies
+        # the others are a fallback, in case of errors like
+        # too many links to a file
+        return [chosen] + [s for s in self.strategies if s != chosen]
+
+    def stage(self, src, dstdir, name=None):
+        '''Stage src in directory dstdir, return the staged path.
+
+        The staged file has the same name as src, unless name is given.
+        '''
+        if name is None:
+            name = os.path.basename(src)
+        dst = os.path.join(dstdir, name)
+        if os.path.lexists(dst):
+            # staged in a previous attempt
+            os.unlink(dst)
+
+        key = (os.stat(src).st_dev, os.stat(dstdir).st_dev)
+        error = None
+        for strategy in self._candidates(key):
+            try:
+                _stagers[strategy](src, dst)
+            except (IOError, OSError) as error:
+                _logger.debug('cannot stage %s by %s: %s', src, strategy, error)
+                continue
+            with self.lock:
+                if key not in self.chosen:
+                    _logger.info('staging by %s from device %d to device %d',
+                                 strategy, key[0], key[1])
+                    self.chosen[key] = strategy
+            return dst
+        raise error
+
+default_stager = Stager()
+
+def stage(src, dstdir, name=None):
+    '''Stage src in directory dstdir with the default stager.'''
+    return default_stager.stage(src, dstdir, name)
@@ -0,0 +1,113 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Content addressed storage of frames and products.
+
+Each file is stored once, under the SHA-1 digest of its content.
+Stored files are read-only, they are shared by linking
+them in the work directories of the tasks.
+'''
+
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+
+from pontifex.staging import Stager, REFLINK, HARDLINK, COPY
+
+_logger = logging.getLogger("pontifex.store")
+
+_CHUNK = 1 << 20
+
+def file_digest(filename):
+    '''SHA-1 digest of the content of a file.'''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fd:
+        while True:
+            data = fd.read(_CHUNK)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+class ContentStore(object):
+    '''Files stored by the digest of their content.'''
+    def __init__(self, basedir, stager=None):
+        super(ContentStore, self).__init__()
+        self.basedir = os.path.abspath(basedir)
+        # files are added without symlinks, the original may change
+        self.adder = Stager([REFLINK, HARDLINK, COPY])
+        if stager is None:
+            stager = Stager()
+        self.stager = stager
+
+    def path(self, digest):
+        '''Path of the stored file with a digest.'''
+        return os.path.join(self.basedir, digest[:2], digest[2:])
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def add(self, filename, digest=None):
+        '''Store the content of a file, return its digest.
+
+        If the content is already stored, it is not stored again.
+        '''
+        if digest is None:
+            digest = file_digest(filename)
+        path = self.path(digest)
+        if os.path.exists(path):
+            _logger.debug('%s already stored as %s', filename, digest)
+            return digest
+
+        dirname = os.path.dirname(path)
+        try:
+            os.mkdir(dirname)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+        # added with a temporary name and renamed,
+        # a stored file is always complete
+        fd, tmpname = tempfile.mkstemp(dir=dirname)
+        os.close(fd)
+        tmp = self.adder.stage(filename, dirname, os.path.basename(tmpname))
+        os.chmod(tmp, 0444)
+        os.rename(tmp, path)
+        _logger.debug('%s stored as %s', filename, digest)
+        return digest
+
+    def stage(self, digest, dstdir, name):
+        '''Stage a stored file in directory dstdir with name.'''
+        return self.stager.stage(self.path(digest), dstdir, name)
+
+    def stage_frame(self, frame, datadir, dstdir):
+        '''Stage a Frame, storing it first if it has no digest.'''
+        if frame.digest is None:
+            frame.digest = self.add(os.path.join(datadir, frame.name))
+        return self.stage(frame.digest, dstdir, frame.name)
+
+    def stage_product(self, product, productsdir, dstdir):
+        '''Stage a DataProduct, storing it first if it has no digest.'''
+        if product.digest is None:
+            product.digest = self.add(os.path.join(productsdir, product.reference))
+        return self.stage(product.digest, dstdir, product.reference)
@@ -0,0 +1,35 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Tests of pontifex.
+
+pontifex.model creates its directories in the working directory
+when it is imported, so the tests run in a temporary one.
+'''
+
+import os
+import atexit
+import shutil
+import tempfile
+
+basedir = tempfile.mkdtemp(prefix='pontifex-test-')
+os.chdir(basedir)
+atexit.register(shutil.rmtree, basedir, True)
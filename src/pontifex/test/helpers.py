@@ -0,0 +1,95 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Databases and tasks shared by the tests.'''
+
+import os
+
+from sqlalchemy import create_engine
+
+import pontifex.model as model
+from pontifex.model import datadir
+from pontifex.model import Users, Instrument, InstrumentConfiguration
+from pontifex.model import ObservingMode, Pipeline, PipelineMap, ProcessingSet
+from pontifex.model import ObservingRun, ObservingBlock, ObservationResult, Frame
+from pontifex.model import DataProcessingTask, COMPLETED
+
+def memory_database():
+    '''An engine of a new in memory database with the tables of the model.'''
+    engine = create_engine('sqlite://')
+    model.metadata.create_all(engine)
+    return engine
+
+def insert_rows(engine, table, count, row):
+    '''Insert in table the count rows returned by row(i).'''
+    engine.execute(table.insert(), [row(i) for i in range(count)])
+
+class Observatory(object):
+    '''An instrument TEST with an observing mode for each recipe.
+
+    recipes is a dictionary of the fully qualified names of the 
+    recipes, by the keys of their modes.
+    '''
+    def __init__(self, session, recipes):
+        super(Observatory, self).__init__()
+        self.user = Users(name='test', status=1, usertype=1)
+        ins = Instrument(name='TEST')
+        session.add(InstrumentConfiguration(instrument=ins, parameters={},
+                                            description='Test', active=True))
+        session.add(ProcessingSet(instrument=ins, name='default'))
+        pipe = Pipeline(name='default', version=1, instrument=ins)
+        self.modes = {}
+        for key, fqn in recipes.items():
+            mode = ObservingMode(name=key.capitalize(), key=key, instrument=ins)
+            session.add(PipelineMap(pipeline=pipe, obsmodes=mode, recipe_fqn=fqn))
+            self.modes[key] = mode
+        self.obsrun = ObservingRun(pi=self.user, instrument=ins)
+        session.add(self.obsrun)
+        session.commit()
+
+    def create_tasks(self, session, key, prefix, count):
+        '''Create count ready tasks of mode key, with a frame each.
+
+        Returns the ids of the tasks.
+        '''
+        mode = self.modes[key]
+        tasks = []
+        for i in range(count):
+            ores = ObservationResult(mode_id=mode.Id, label='pointing', state=2)
+            session.add(ObservingBlock(object='test', obsrun=self.obsrun,
+                                       observer_id=self.user.id,
+                                       observation_result=ores,
+                                       observing_mode=mode))
+            name = '%s%04d.fits' % (prefix, i)
+            with open(os.path.join(datadir, name), 'wb') as fd:
+                fd.write(name)
+            session.add(Frame(name=name, object='test', exposure=0.0,
+                              imgtype='BIAS', racoor=0.0, deccoor=0.0,
+                              observation_result=ores))
+            task = DataProcessingTask(obsresult_node=ores, state=COMPLETED,
+                                      waiting=False, method='processPointing',
+                                      request={'pset': 'default',
+                                               'instrument': 'TEST'})
+            session.add(task)
+            tasks.append(task)
+        # ready, the watchdog is notified on commit
+        session.commit()
+        return [task.id for task in tasks]
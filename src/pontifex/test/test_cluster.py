@@ -0,0 +1,162 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Tasks run through a server and its hosts in one process.'''
+
+import os
+import time
+import signal
+import logging
+import unittest
+
+from pontifex.model import Session, DataProcessingTask, PROCESSING, FINISHED, ERROR
+from pontifex.cluster import LocalCluster, create_database
+from pontifex.test.helpers import Observatory
+
+class TrivialRecipe(object):
+    '''A recipe without products that returns at once.'''
+    __requires__ = []
+    __provides__ = []
+    logger = logging.getLogger('pontifex.test.recipe')
+
+    def __call__(self, obsres):
+        return {'products': []}
+
+class SlowRecipe(TrivialRecipe):
+    '''A recipe that takes a second.'''
+    def __call__(self, obsres):
+        time.sleep(1)
+        return {'products': []}
+
+class CrashingRecipe(TrivialRecipe):
+    '''A recipe that kills the process running it.'''
+    def __call__(self, obsres):
+        os.kill(os.getpid(), signal.SIGKILL)
+
+class LocalClusterTestCase(unittest.TestCase):
+    '''Every task sent to the hosts is finished.'''
+    ntasks = 8
+
+    @classmethod
+    def setUpClass(cls):
+        create_database('.')
+        recipes = dict((key, 'pontifex.test.test_cluster.%sRecipe' % key.capitalize())
+                            for key in ['trivial', 'slow', 'crashing'])
+        cls.observatory = Observatory(Session(), recipes)
+
+    @classmethod
+    def tearDownClass(cls):
+        Session.remove()
+
+    def create_tasks(self, prefix, key='trivial', ntasks=None):
+        return self.observatory.create_tasks(Session(), key, prefix, 
+                                             ntasks or self.ntasks)
+
+    def hosts_of(self, taskids):
+        '''The hosts of the tasks, by task id.'''
+        session = Session()
+        hosts = dict(session.query(DataProcessingTask.id, DataProcessingTask.host
+                        ).filter(DataProcessingTask.id.in_(taskids)))
+        session.commit()
+        return hosts
+
+    def run_tasks(self, prefix, pull):
+        cluster = LocalCluster(2, 2, capabilities=['TEST'], pull=pull,
+                               host_options={'delay': 0.01})
+        cluster.start()
+        try:
+            taskids = self.create_tasks(prefix)
+            states = cluster.wait(taskids, timeout=60)
+        finally:
+            cluster.stop()
+        self.assertEqual(states, dict((taskid, FINISHED) for taskid in taskids))
+        # the tasks are spread between the hosts
+        names = ['%s:%d' % (host.host, host.port) for host in cluster.hosts]
+        hosts = self.hosts_of(taskids).values()
+        self.assertEqual(sorted(set(hosts)), names)
+
+    def test_push(self):
+        self.run_tasks('s', pull=False)
+
+    def test_pull(self):
+        self.run_tasks('p', pull=True)
+
+    def test_distribution(self):
+        # the first tasks take all the slots of both hosts
+        cluster = LocalCluster(2, 2, capabilities=['TEST'], 
+                               host_options={'delay': 0.01})
+        cluster.start()
+        try:
+            taskids = self.create_tasks('d', key='slow', ntasks=4)
+            states = cluster.wait(taskids, timeout=60)
+        finally:
+            cluster.stop()
+        self.assertEqual(states, dict((taskid, FINISHED) for taskid in taskids))
+        hosts = self.hosts_of(taskids).values()
+        self.assertEqual(sorted(hosts), ['host0:1', 'host0:1', 'host1:2', 'host1:2'])
+
+    def test_host_lost(self):
+        # the task of a host that stops sending heartbeats goes to another
+        cluster = LocalCluster(2, 1, capabilities=['TEST'], heartbeat=0.1,
+                               lease=0.5, host_options={'delay': 0.01})
+        cluster.start()
+        try:
+            taskids = self.create_tasks('l', key='slow', ntasks=2)
+            session = Session()
+            deadline = time.time() + 30
+            while time.time() < deadline:
+                states = dict(session.query(DataProcessingTask.id, DataProcessingTask.state
+                                ).filter(DataProcessingTask.id.in_(taskids)))
+                session.commit()
+                if states.values() == [PROCESSING, PROCESSING]:
+                    break
+                time.sleep(0.01)
+            lost = [taskid for taskid, host in self.hosts_of(taskids).items() 
+                        if host == 'host0:1']
+            cluster.hosts[0].halt.set()
+            states = cluster.wait(taskids, timeout=60)
+        finally:
+            cluster.stop()
+        self.assertEqual(len(lost), 1)
+        self.assertEqual(states, dict((taskid, FINISHED) for taskid in taskids))
+        self.assertEqual(self.hosts_of(taskids).values(), ['host1:2', 'host1:2'])
+
+    def test_slot_died(self):
+        # the tasks of the slots that die end in error at the next heartbeat
+        cluster = LocalCluster(1, 2, capabilities=['TEST'], heartbeat=0.2,
+                               host_options={'delay': 0.01})
+        cluster.start()
+        try:
+            crashed = self.create_tasks('c', key='crashing', ntasks=2)
+            taskids = self.create_tasks('t', ntasks=2)
+            states = cluster.wait(crashed + taskids, timeout=60)
+        finally:
+            cluster.stop()
+        self.assertEqual(states, dict([(taskid, ERROR) for taskid in crashed] + 
+                                      [(taskid, FINISHED) for taskid in taskids]))
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LocalClusterTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
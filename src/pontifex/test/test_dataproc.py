@@ -0,0 +1,71 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Bulk state transitions of the tasks.'''
+
+import unittest
+
+from sqlalchemy import event
+
+from pontifex.model import maker, DataProcessingTask, set_task_state
+from pontifex.model import COMPLETED, ENQUEUED, PROCESSING
+from pontifex.test.helpers import memory_database
+
+class SetTaskStateTestCase(unittest.TestCase):
+    '''Only the tasks still in their old state are changed.'''
+    def setUp(self):
+        self.engine = memory_database()
+        self.engine.execute(DataProcessingTask.__table__.insert(), 
+                [{'id': i, 'state': COMPLETED, 'waiting': False, 
+                  'obsresult_node_id': 1} for i in (1, 2, 3)])
+        self.session = maker(bind=self.engine)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_changed(self):
+        changed = set_task_state(self.session, ENQUEUED, old=COMPLETED, ids=[1, 2])
+        self.assertEqual(sorted(changed), [1, 2])
+        self.assertEqual(set_task_state(self.session, ENQUEUED, old=COMPLETED), [3])
+
+    def test_concurrent(self):
+        # another writer takes task 1 after it is selected
+        def take(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                cursor.connection.execute('UPDATE dp_task SET state = %d '
+                                          'WHERE id = 1' % PROCESSING)
+        event.listen(self.engine, 'after_cursor_execute', take)
+        try:
+            changed = set_task_state(self.session, ENQUEUED, old=COMPLETED)
+        finally:
+            event.remove(self.engine, 'after_cursor_execute', take)
+        self.assertEqual(sorted(changed), [2, 3])
+        states = self.session.execute('SELECT id, state FROM dp_task ORDER BY id')
+        self.assertEqual([tuple(row) for row in states], 
+                         [(1, PROCESSING), (2, ENQUEUED), (3, ENQUEUED)])
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SetTaskStateTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,91 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Plans of the queries run for each task.'''
+
+import unittest
+
+from pontifex.model import metadata, maker, Frame, ContextValue
+from pontifex.model import DataProcessingTask, DataProduct
+from pontifex.model.dataproc import data_product_context
+from pontifex.model.plans import check_plans
+from pontifex.test.helpers import memory_database, insert_rows
+
+class PlansTestCase(unittest.TestCase):
+    '''The hot queries use the indexes of a small database.'''
+    frames = 10000
+    tasks = 1000
+    products = 1000
+    contexts = 200
+    # the queries degraded without each index
+    degraded = {'ix_frame_obsresult': ['frames of a result'],
+                'ix_dp_task_ready': ['ready tasks'],
+                'ix_dp_task_parent_id': ['unfinished siblings'],
+                'ix_dp_product_lookup': ['calibrations', 'matching calibration'],
+                'ix_context_value_lookup': ['context values']}
+
+    def setUp(self):
+        self.engine = memory_database()
+        self.insert(Frame.__table__, self.frames, lambda i:
+               {'name': 'r%06d' % i, 'object': 'bias', 'exposure': 0.0,
+                'imgtype': 'BIAS', 'racoor': 0.0, 'deccoor': 0.0,
+                'obsresult_id': i // 10 + 1})
+        self.insert(DataProcessingTask.__table__, self.tasks, lambda i:
+               {'state': 4 if i % 100 else 1, 'waiting': False,
+                'obsresult_node_id': i + 1, 'pset_name': 'default',
+                'instrument_id': ('EMIR', 'MEGARA', 'OTHER')[i % 3]})
+        self.insert(DataProduct.__table__, self.products, lambda i:
+               {'datatype': 'emir.dataproducts.Master%d' % (i % 20),
+                'reference': 'p%06d.fits' % i, 'pset_name': 'default',
+                'instrument_id': ('EMIR', 'MEGARA')[i % 2]})
+        self.insert(ContextValue.__table__, self.contexts, lambda i:
+               {'description_id': i % 50 + 1, 'value': 'v%d' % i})
+        self.insert(data_product_context, self.products, lambda i:
+               {'data_product_id': i + 1, 'context_id': i % self.contexts + 1})
+        self.session = maker(bind=self.engine)
+
+    def tearDown(self):
+        self.session.close()
+
+    def insert(self, table, count, row):
+        insert_rows(self.engine, table, count, row)
+
+    def test_plans(self):
+        self.engine.execute('ANALYZE')
+        self.assertEqual(check_plans(self.session), [])
+
+    def test_degraded(self):
+        indexes = dict((index.name, index) for table in metadata.tables.values()
+                                            for index in table.indexes)
+        for name, queries in sorted(self.degraded.items()):
+            indexes[name].drop(self.engine)
+            self.engine.execute('ANALYZE')
+            degraded = [query for query, _ in check_plans(self.session)]
+            indexes[name].create(self.engine)
+            self.assertEqual(degraded, queries, name)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(PlansTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
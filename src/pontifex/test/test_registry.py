@@ -0,0 +1,75 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Leases of the hosts and their tasks.'''
+
+import time
+import unittest
+
+from pontifex.registry import HostRegistry
+
+class HostRegistryTestCase(unittest.TestCase):
+    '''A task is leased to one host at a time.'''
+    def setUp(self):
+        self.registry = HostRegistry(lease=30)
+
+    def add(self, hostid, port):
+        self.registry.add(hostid, None, ('localhost', port), ['TEST'], 2)
+
+    def test_evicted(self):
+        self.add('A', 1)
+        self.registry.assign('A', 7)
+        # A misses its heartbeats, 7 goes to B
+        self.registry['A'].expires = time.time() - 1
+        evicted, taskids = self.registry.expire()
+        self.assertEqual([host.hostid for host in evicted], ['A'])
+        self.assertEqual(taskids, [7])
+        self.add('B', 2)
+        self.registry.assign('B', 7)
+        # A registers again, still running 7
+        self.add('A', 1)
+        self.assertEqual(self.registry.renew('A', [7]), [7])
+        self.assertEqual(self.registry.adopt('A', [7]), [])
+        self.assertFalse(self.registry.finish('A', 7))
+        self.assertTrue(self.registry.finish('B', 7))
+
+    def test_adopted(self):
+        self.add('A', 1)
+        self.assertEqual(self.registry.renew('A', [8, 9]), [8, 9])
+        self.assertEqual(self.registry.adopt('A', [9]), [9])
+        self.assertEqual(self.registry.renew('A', [8, 9]), [8])
+        self.assertEqual(self.registry.nidle(), 1)
+        self.assertTrue(self.registry.finish('A', 9))
+        self.assertEqual(self.registry.nidle(), 2)
+
+    def test_first_lease(self):
+        self.add('A', 1)
+        self.registry['A'].since -= 60
+        self.assertEqual(self.registry.adopt('A', [9]), [])
+        self.assertEqual(self.registry.renew('B', [9]), None)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(HostRegistryTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
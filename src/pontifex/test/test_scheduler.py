@@ -0,0 +1,125 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Tasks dispatched by channel priority.'''
+
+import unittest
+
+from sqlalchemy import create_engine
+
+import pontifex.model as model
+from pontifex.model import maker, Channel, DataProcessingTask
+from pontifex.model import CREATED, COMPLETED, FINISHED, fill_task_depths
+from pontifex.scheduler import interleave, ChannelQueue
+from pontifex.scheduler import ready_tasks, pending_siblings, critical_path_order
+from pontifex.test.helpers import memory_database
+
+class InterleaveTestCase(unittest.TestCase):
+    '''Channels of lower priority are not starved.'''
+    def test_three_channels(self):
+        groups = [['a%d' % i for i in range(8)], ['b0', 'b1'], ['c0', 'c1']]
+        order = list(interleave(groups, 2))
+        self.assertEqual(order, ['a0', 'a1', 'b0', 'a2', 'a3', 'c0',
+                                 'a4', 'a5', 'b1', 'a6', 'a7', 'c1'])
+
+    def test_queue_three_channels(self):
+        queue = ChannelQueue(burst=2)
+        for i in range(8):
+            queue.put((10, 'a%d' % i))
+        for i in range(2):
+            queue.put((5, 'b%d' % i))
+            queue.put((0, 'c%d' % i))
+        order = [queue.get()[1] for _ in range(12)]
+        self.assertEqual(order, ['a0', 'a1', 'b0', 'a2', 'a3', 'c0',
+                                 'a4', 'a5', 'b1', 'a6', 'a7', 'c1'])
+
+class CriticalPathTestCase(unittest.TestCase):
+    '''Ready tasks are selected by the database in critical path order.'''
+    def setUp(self):
+        self.engine = memory_database()
+        self.session = maker(bind=self.engine)
+        high = Channel(name='high', priority=5)
+        root = self.task(CREATED)
+        a, b = self.task(CREATED, root), self.task(CREATED, root)
+        self.a1, self.a2 = self.task(COMPLETED, a), self.task(COMPLETED, a)
+        self.task(FINISHED, a)
+        self.b1 = self.task(COMPLETED, b)
+        self.c = self.task(COMPLETED, root)
+        self.h = self.task(COMPLETED)
+        self.h.channel = high
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def task(self, state, parent=None):
+        task = DataProcessingTask(state=state, waiting=state == CREATED, 
+                                  parent=parent, obsresult_node_id=1,
+                                  request={'pset': 'default', 'instrument': 'TEST'})
+        self.session.add(task)
+        return task
+
+    def order(self, tasks):
+        tasks = [task for task in tasks if task.channel is None]
+        pending = pending_siblings(self.session, tasks)
+        return [task.id for task in critical_path_order(tasks, pending)]
+
+    def test_depth(self):
+        self.assertEqual([self.a1.depth, self.c.depth, self.h.depth], [2, 1, 0])
+        self.session.query(DataProcessingTask).update({'depth': None})
+        self.assertEqual(fill_task_depths(self.session), 9)
+        self.session.expire_all()
+        self.assertEqual([self.a1.depth, self.c.depth, self.h.depth], [2, 1, 0])
+
+    def test_order(self):
+        tasks = ready_tasks(self.session, ['TEST'], 10)
+        self.assertEqual(self.order(tasks), 
+                         [self.b1.id, self.a1.id, self.a2.id, self.c.id])
+
+    def test_limit(self):
+        # the limit is applied to each channel priority
+        tasks = ready_tasks(self.session, ['TEST'], 1)
+        self.assertEqual(set(tasks), set([self.b1, self.h]))
+        tasks = ready_tasks(self.session, ['TEST'], 3)
+        self.assertEqual(self.order(tasks), [self.b1.id, self.a1.id, self.a2.id])
+        self.assertEqual(ready_tasks(self.session, ['OTHER'], 3), [])
+
+class UpgradeTestCase(unittest.TestCase):
+    '''Columns added to the model are added to older databases.'''
+    def test_channel_priority(self):
+        engine = create_engine('sqlite://')
+        engine.execute('CREATE TABLE channel (id INTEGER PRIMARY KEY, '
+                       'name VARCHAR(255) NOT NULL UNIQUE)')
+        engine.execute("INSERT INTO channel (name) VALUES ('default')")
+        model.metadata.create_all(engine)
+        model.upgrade_model(engine)
+        rows = engine.execute('SELECT name, priority FROM channel').fetchall()
+        self.assertEqual([tuple(row) for row in rows], [('default', 0)])
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(InterleaveTestCase))
+    suite.addTest(unittest.makeSuite(CriticalPathTestCase))
+    suite.addTest(unittest.makeSuite(UpgradeTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,117 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Interned context descriptions and values.'''
+
+import unittest
+
+from sqlalchemy import event
+
+from pontifex.model import maker, Instrument, ContextDescription, ContextValue
+from pontifex.model import DataProduct
+from pontifex.vocabulary import vocabulary
+from pontifex.test.helpers import memory_database
+
+class VocabularyTestCase(unittest.TestCase):
+    '''Values are merged from their ids and interned on commit.'''
+    def setUp(self):
+        self.engine = memory_database()
+        session = maker(bind=self.engine)
+        session.add(Instrument(name='TEST'))
+        desc = ContextDescription(instrument_id='TEST', name='filter')
+        session.add(desc)
+        session.flush()
+        self.descid = desc.id
+        session.add(ContextValue(description_id=desc.id, value=u'J'))
+        session.commit()
+        session.close()
+
+        vocabulary.descriptions.clear()
+        vocabulary.values.clear()
+        self.selects = []
+        event.listen(self.engine, 'before_cursor_execute', self.count)
+
+    def tearDown(self):
+        event.remove(self.engine, 'before_cursor_execute', self.count)
+
+    def count(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            self.selects.append(statement)
+
+    def test_known(self):
+        session = maker(bind=self.engine)
+        vocabulary.load(session)
+        session.commit()
+        del self.selects[:]
+
+        value = vocabulary.value(session, 'TEST', 'filter', 'J')
+        self.assertEqual(value.value, u'J')
+        self.assertTrue(value in session)
+        product = DataProduct(instrument_id='TEST', datatype='test.Bias',
+                              reference='bias.fits', pset_name='default')
+        product.context.append(value)
+        session.add(product)
+        session.commit()
+        self.assertEqual(self.selects, [])
+
+        stored = session.query(DataProduct).one()
+        self.assertEqual([v.value for v in stored.context], [u'J'])
+
+    def test_created(self):
+        session = maker(bind=self.engine)
+        value = vocabulary.value(session, 'TEST', 'filter', 'K')
+        # created once in the session
+        self.assertTrue(vocabulary.value(session, 'TEST', 'filter', 'K') is value)
+        self.assertFalse((self.descid, u'K') in vocabulary.values)
+        session.commit()
+        self.assertEqual(vocabulary.values[(self.descid, u'K')], value.id)
+        session.close()
+
+        del self.selects[:]
+        session = maker(bind=self.engine)
+        again = vocabulary.value(session, 'TEST', 'filter', 'K')
+        self.assertEqual(again.id, value.id)
+        self.assertEqual(self.selects, [])
+
+    def test_rollback(self):
+        session = maker(bind=self.engine)
+        value = vocabulary.value(session, 'TEST', 'filter', 'H')
+        session.flush()
+        session.rollback()
+        self.assertFalse('new_context_values' in session.info)
+        self.assertFalse((self.descid, u'H') in vocabulary.values)
+
+        again = vocabulary.value(session, 'TEST', 'filter', 'H')
+        self.assertFalse(again is value)
+        session.commit()
+        self.assertEqual(session.query(ContextValue).filter_by(value=u'H').count(), 1)
+
+    def test_no_description(self):
+        session = maker(bind=self.engine)
+        self.assertTrue(vocabulary.value(session, 'TEST', 'grism', 'G') is None)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(VocabularyTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
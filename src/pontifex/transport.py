@@ -0,0 +1,458 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Binary RPC transport and pools of connections.
+
+Calls and results are pickled and sent as length prefixed
+frames over persistent TCP connections, available alongside
+the XML-RPC API. Its urls have the form bin://host:port.
+
+The proxies returned by make_proxy keep a bounded pool of
+open connections to their peer, of either transport,
+and can be shared between threads.
+
+The loopback transport, with urls loop://host:port, calls the
+functions of a LoopbackServer in the same process, pickling
+the calls and results as the binary transport does.
+
+As with the pickled recipes sent through XML-RPC, the peers
+must trust each other: unpickling can run arbitrary code.
+'''
+
+import time
+import socket
+import struct
+import logging
+import httplib
+import threading
+import xmlrpclib
+import SocketServer
+from urlparse import urlsplit
+from collections import deque
+import cPickle as pickle
+
+_logger = logging.getLogger("pontifex.transport")
+
+_HEADER = struct.Struct('!I')
+_SMALL = 1 << 16
+
+class Fault(Exception):
+    '''An error raised by the remote function.'''
+    pass
+
+def send_message(sock, obj):
+    '''Send a pickled object in a frame.'''
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    header = _HEADER.pack(len(data))
+    if len(data) < _SMALL:
+        sock.sendall(header + data)
+    else:
+        # avoid copying big payloads
+        sock.sendall(header)
+        sock.sendall(data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def recv_message(sock):
+    '''Receive a frame and unpickle its content.'''
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+class _Unanswered(EOFError):
+    '''The peer closed the connection before replying to a call.'''
+    pass
+
+class _Handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                method, args = recv_message(sock)
+            except (EOFError, socket.error):
+                return
+            try:
+                fun = self.server.funcs[method]
+            except KeyError:
+                reply = (False, 'method "%s" is not supported' % method)
+            else:
+                try:
+                    reply = (True, fun(*args))
+                except Exception as error:
+                    _logger.warning('error in %s: %s', method, error)
+                    reply = (False, '%s: %s' % (error.__class__.__name__, error))
+            send_message(sock, reply)
+
+class BinaryServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''Serve registered functions through the binary transport.
+
+    Each connection is served by a thread, during all its life.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        SocketServer.TCPServer.__init__(self, address, _Handler)
+        self.funcs = {}
+
+    def register_function(self, function, name=None):
+        if name is None:
+            name = function.__name__
+        self.funcs[name] = function
+
+class BinaryProxy(object):
+    '''Call remote functions through the binary transport.
+
+    The connection is kept open between calls. Calls from
+    several threads are serialized.
+    '''
+    binary = True
+
+    def __init__(self, address):
+        super(BinaryProxy, self).__init__()
+        self._address = address
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self._sock = socket.create_connection(self._address)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _exchange(self, method, args):
+        try:
+            send_message(self._sock, (method, args))
+            first = self._sock.recv(1)
+        except socket.error as error:
+            raise _Unanswered(str(error))
+        if not first:
+            raise _Unanswered('connection closed')
+        header = first + _recv_exactly(self._sock, _HEADER.size - 1)
+        size, = _HEADER.unpack(header)
+        return pickle.loads(_recv_exactly(self._sock, size))
+
+    def _call(self, method, args):
+        with self._lock:
+            reused = self._sock is not None
+            if not reused:
+                self._connect()
+            try:
+                ok, value = self._exchange(method, args)
+            except _Unanswered:
+                self._close()
+                if not reused:
+                    raise
+                # the peer closed the connection while idle,
+                # without running the call
+                self._connect()
+                try:
+                    ok, value = self._exchange(method, args)
+                except (EOFError, socket.error):
+                    self._close()
+                    raise
+            except (EOFError, socket.error):
+                # the call may have run, it is not sent again
+                self._close()
+                raise
+        if not ok:
+            raise Fault(value)
+        return value
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def method(*args):
+            return self._call(name, args)
+        return method
+
+# servers of the loopback transport, by address
+_loopback = {}
+_loopback_lock = threading.Lock()
+
+class LoopbackServer(object):
+    '''Serve registered functions to the proxies in this process.
+
+    The functions are called in the thread of the caller.
+    '''
+    def __init__(self, address):
+        super(LoopbackServer, self).__init__()
+        self.server_address = address
+        self.funcs = {}
+        self._stopped = threading.Event()
+        with _loopback_lock:
+            if address in _loopback:
+                raise socket.error('address %s:%d already in use' % address)
+            _loopback[address] = self
+
+    def register_function(self, function, name=None):
+        if name is None:
+            name = function.__name__
+        self.funcs[name] = function
+
+    def serve_forever(self):
+        self._stopped.wait()
+
+    def shutdown(self):
+        self._stopped.set()
+
+    def server_close(self):
+        with _loopback_lock:
+            _loopback.pop(self.server_address, None)
+
+class LoopbackProxy(object):
+    '''Call the functions of a LoopbackServer.'''
+    binary = True
+
+    def __init__(self, address):
+        super(LoopbackProxy, self).__init__()
+        self._address = address
+
+    def _call(self, method, args):
+        with _loopback_lock:
+            server = _loopback.get(self._address)
+        if server is None:
+            raise socket.error('connection refused by %s:%d' % self._address)
+        # the peers don't share the objects passed
+        args = pickle.loads(pickle.dumps(args, pickle.HIGHEST_PROTOCOL))
+        try:
+            fun = server.funcs[method]
+        except KeyError:
+            raise Fault('method "%s" is not supported' % method)
+        try:
+            value = fun(*args)
+        except Exception as error:
+            raise Fault('%s: %s' % (error.__class__.__name__, error))
+        return pickle.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def method(*args):
+            return self._call(name, args)
+        return method
+
+def _connect(url):
+    '''Proxy with one connection to url.'''
+    parts = urlsplit(url)
+    if parts.scheme == 'bin':
+        return BinaryProxy((parts.hostname, parts.port))
+    if parts.scheme == 'loop':
+        return LoopbackProxy((parts.hostname, parts.port))
+    # the Transport of xmlrpclib keeps its connection open
+    return xmlrpclib.ServerProxy(url)
+
+def _close(proxy):
+    if isinstance(proxy, (BinaryProxy, LoopbackProxy)):
+        proxy.close()
+    else:
+        proxy('close')()
+
+# errors after which a connection is not reused
+_BROKEN = (EOFError, socket.error, httplib.HTTPException)
+
+class PooledProxy(object):
+    '''Call remote functions through a pool of connections to a peer.
+
+    Each call checks out an idle connection, or opens a new one
+    if there are less than size, or waits for one to be
+    checked in. Connections are kept open between calls.
+    '''
+    def __init__(self, url, size=4):
+        super(PooledProxy, self).__init__()
+        self.url = url
+        self.size = size
+        self.binary = urlsplit(url).scheme in ('bin', 'loop')
+        self._idle = []
+        self._opened = 0
+        self._cond = threading.Condition()
+
+    def _checkout(self):
+        with self._cond:
+            while not self._idle and self._opened >= self.size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+        try:
+            return _connect(self.url)
+        except:
+            self._discard()
+            raise
+
+    def _checkin(self, proxy):
+        with self._cond:
+            self._idle.append(proxy)
+            self._cond.notify()
+
+    def _discard(self):
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+    def _call(self, method, args):
+        proxy = self._checkout()
+        try:
+            result = getattr(proxy, method)(*args)
+        except _BROKEN:
+            _close(proxy)
+            self._discard()
+            raise
+        except:
+            self._checkin(proxy)
+            raise
+        self._checkin(proxy)
+        return result
+
+    def close(self):
+        '''Close the idle connections.'''
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for proxy in idle:
+            _close(proxy)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def method(*args):
+            return self._call(name, args)
+        return method
+
+def make_proxy(url, size=4):
+    '''Proxy for the url, bin://host:port, loop://host:port or an XML-RPC url.
+
+    The proxy keeps up to size connections open to url.
+    '''
+    return PooledProxy(url, size)
+
+class Mailbox(object):
+    '''Tasks waiting to be fetched by a host.
+
+    It can be used as the proxy of a host, the tasks
+    passed to it are returned by fetch, or passed to the
+    functions waiting for them with fetch_later.
+    '''
+    def __init__(self):
+        super(Mailbox, self).__init__()
+        self.tasks = deque()
+        self.waiters = deque()
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def _take(self, size):
+        return [self.tasks.popleft() for _ in range(min(size, len(self.tasks)))]
+
+    def pass_info(self, taskid, bspec, bpob):
+        self.pass_info_many([(taskid, bspec, bpob)])
+
+    def pass_info_many(self, tasks):
+        served = []
+        with self.cond:
+            self.tasks.extend(tasks)
+            while self.tasks and self.waiters:
+                size, reply = self.waiters.popleft()
+                served.append((reply, self._take(size)))
+            self.cond.notify_all()
+        for reply, tasks in served:
+            reply(tasks)
+
+    def __len__(self):
+        with self.cond:
+            return len(self.tasks)
+
+    def fetch(self, size, timeout):
+        '''Return up to size tasks, waiting up to timeout seconds for one.'''
+        deadline = time.time() + timeout
+        with self.cond:
+            while not self.tasks and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self._take(size)
+
+    def fetch_later(self, size, reply):
+        '''Call reply with up to size tasks, when there are some.
+
+        Returns a function that calls reply without tasks,
+        if it has not been called yet.
+        '''
+        waiter = (size, reply)
+        with self.cond:
+            if self.tasks or self.closed:
+                waiter = None
+                tasks = self._take(size)
+            else:
+                self.waiters.append(waiter)
+        if waiter is None:
+            reply(tasks)
+
+        def expire():
+            with self.cond:
+                if waiter not in self.waiters:
+                    return
+                self.waiters.remove(waiter)
+            reply([])
+        return expire
+
+    def close(self):
+        '''Wake up the waiting fetches.'''
+        with self.cond:
+            self.closed = True
+            waiters, self.waiters = self.waiters, deque()
+            self.cond.notify_all()
+        for _, reply in waiters:
+            reply([])
+
+def pack(proxy, obj):
+    '''Prepare an object to be passed to proxy.
+
+    XML-RPC can't pass arbitrary objects, so they are
+    pickled in a Binary. The binary transport pickles them itself.
+    '''
+    if isinstance(proxy, (BinaryProxy, LoopbackProxy, PooledProxy)) and proxy.binary:
+        return obj
+    return xmlrpclib.Binary(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+def unpack(value):
+    '''Recover an object passed with pack.'''
+    if isinstance(value, xmlrpclib.Binary):
+        return pickle.loads(value.data)
+    return value
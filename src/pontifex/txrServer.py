@@ -18,7 +18,15 @@
 #
 
 from SocketServer import ThreadingMixIn
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+class KeepAliveRequestHandler(SimpleXMLRPCRequestHandler):
+    '''Keep the connection open between requests of a client.'''
+    protocol_version = 'HTTP/1.1'
 
 class txrServer(ThreadingMixIn, SimpleXMLRPCServer):
-    pass
+    # a thread serves each connection, as long as it is open
+    daemon_threads = True
+
+    def __init__(self, addr, requestHandler=KeepAliveRequestHandler, **kwds):
+        SimpleXMLRPCServer.__init__(self, addr, requestHandler, **kwds)
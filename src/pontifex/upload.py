@@ -0,0 +1,210 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Upload of files from the hosts to the content store of the server.
+
+Hosts that don't share the filesystem of the server send the
+products of their tasks in chunks, each one with its CRC-32.
+The server appends them to a partial file, so an interrupted
+upload is resumed from the last chunk received. When the upload
+ends, the SHA-1 digest of the whole file is checked and the
+file is moved to the store.
+'''
+
+import os
+import re
+import zlib
+import errno
+import logging
+import threading
+import xmlrpclib
+from Queue import Queue
+
+from pontifex.store import file_digest
+
+_logger = logging.getLogger("pontifex.upload")
+
+CHUNK = 1 << 20
+
+# times a chunk is sent before giving up
+RETRIES = 3
+
+# times an upload is started before giving up
+ATTEMPTS = 3
+
+_DIGEST = re.compile('^[0-9a-f]{40}$')
+# the ids of the hosts are the hex of a UUID
+_HOSTID = re.compile('^[0-9a-f]{32}$')
+
+def _checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def product_name(filename):
+    '''Name of a product file, relative to the work directory of its task.
+
+    The digests of the uploaded files are sent by these names.
+    '''
+    return os.path.normpath(filename)
+
+class UploadStore(object):
+    '''Receive uploaded files in a content store.'''
+    def __init__(self, store):
+        super(UploadStore, self).__init__()
+        self.store = store
+        self.partialdir = os.path.join(store.basedir, 'partial')
+        try:
+            os.mkdir(self.partialdir)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        self.lock = threading.Lock()
+
+    def _partial(self, hostid, digest):
+        # the names of the files come from the hosts
+        if not _DIGEST.match(digest):
+            raise ValueError('invalid digest %r' % digest)
+        if not _HOSTID.match(hostid):
+            raise ValueError('invalid host id %r' % hostid)
+        # each host has its own partial files, two hosts
+        # may upload the same content at the same time
+        return os.path.join(self.partialdir, '%s-%s' % (digest, hostid))
+
+    def begin(self, hostid, digest):
+        '''Start or resume an upload, return the offset to send from.
+
+        Returns -1 if the file is already stored.
+        '''
+        partial = self._partial(hostid, digest)
+        if digest in self.store:
+            return -1
+        if os.path.exists(partial):
+            return os.path.getsize(partial)
+        open(partial, 'wb').close()
+        return 0
+
+    def chunk(self, hostid, digest, offset, data, checksum):
+        '''Write a chunk at offset, return the offset of the next chunk.
+
+        If the chunk is not at the end of the partial file, or
+        it is corrupted, it is discarded and the offset to send
+        from is returned.
+        '''
+        partial = self._partial(hostid, digest)
+        if _checksum(data) != checksum:
+            _logger.warning('corrupted chunk of %s at %d', digest, offset)
+            return os.path.getsize(partial)
+        with self.lock:
+            size = os.path.getsize(partial)
+            if offset != size:
+                _logger.debug('chunk of %s at %d, expected %d', digest, offset, size)
+                return size
+            with open(partial, 'ab') as fd:
+                fd.write(data)
+        return size + len(data)
+
+    def end(self, hostid, digest):
+        '''Store the uploaded file, return False if it is corrupted.'''
+        partial = self._partial(hostid, digest)
+        if not os.path.exists(partial):
+            return digest in self.store
+        try:
+            if file_digest(partial) != digest:
+                _logger.warning('upload of %s is corrupted', digest)
+                return False
+            # the store adds it with a temporary name and renames it
+            self.store.add(partial, digest)
+            return True
+        finally:
+            os.unlink(partial)
+
+def upload(proxy, hostid, filename, digest=None, chunk=CHUNK):
+    '''Upload a file through proxy, return its digest.'''
+    if digest is None:
+        digest = file_digest(filename)
+    for _ in range(ATTEMPTS):
+        offset = proxy.upload_begin(hostid, digest)
+        if offset < 0:
+            _logger.debug('%s is already stored', filename)
+            return digest
+        # chunks sent at each offset without progress
+        rejected = {}
+        with open(filename, 'rb') as fd:
+            while True:
+                fd.seek(offset)
+                data = fd.read(chunk)
+                if not data:
+                    break
+                sent = offset
+                offset = proxy.upload_chunk(hostid, digest, offset,
+                                            xmlrpclib.Binary(data), _checksum(data))
+                if offset <= sent:
+                    rejected[sent] = rejected.get(sent, 0) + 1
+                    if rejected[sent] >= RETRIES:
+                        raise IOError('chunk of %s at %d rejected %d times' % 
+                                      (filename, sent, RETRIES))
+        if proxy.upload_end(hostid, digest):
+            return digest
+        _logger.warning('upload of %s failed, retrying', filename)
+    raise IOError('cannot upload %s' % filename)
+
+class Uploader(object):
+    '''Upload files in threads.
+
+    Each job is a list of (name, path) of files and a function 
+    called, when they have been uploaded, with a dictionary of the
+    names and their digests, or None if an upload failed.
+    '''
+    def __init__(self, proxy, hostid, workers=2):
+        super(Uploader, self).__init__()
+        self.proxy = proxy
+        self.hostid = hostid
+        self.queue = Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name='uploader-%d' % i)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, files, callback):
+        self.queue.put((files, callback))
+
+    def _run(self):
+        while True:
+            token = self.queue.get()
+            if token is None:
+                return
+            files, callback = token
+            digests = {}
+            try:
+                for name, filename in files:
+                    digests[name] = upload(self.proxy, self.hostid, filename)
+            except Exception as error:
+                _logger.warning('cannot upload %s: %s', 
+                                [filename for _, filename in files], error)
+                digests = None
+            callback(digests)
+
+    def close(self):
+        '''Finish the pending uploads and stop.'''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
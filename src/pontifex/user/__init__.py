@@ -20,18 +20,10 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 
 
-import threading
 import logging
-from xmlrpclib import ServerProxy
-import signal
 import sys
-import ConfigParser
 
-from sqlalchemy import create_engine
-
-from pontifex.txrServer import txrServer
-import pontifex.model
-from pontifex.host import PontifexHost
+from pontifex.user.host import run_host
 
 
 # create logger for host
@@ -42,37 +34,4 @@ def main_host():
     if len(sys.argv) != 2:
         sys.exit(1)
 
-    cfgfile = sys.argv[1]
-
-    config = ConfigParser.ConfigParser()
-    config.read(cfgfile)
-
-    masterurl = config.get('master', 'url')
-    host = config.get('slave', 'host')
-    port = config.getint('slave', 'port')
-
-    im = PontifexHost(masterurl, host, port)
-
-    tserver = txrServer((host, port), allow_none=True, logRequests=False)
-    tserver.register_function(im.pass_info)
-
-    # signal handler
-    def handler(signum, frame):
-        im.quit()
-        tserver.shutdown()
-        im.doned = True
-        sys.exit(0)
-
-    # Set the signal handler on SIGTERM and SIGINT
-    signal.signal(signal.SIGTERM, handler)
-    signal.signal(signal.SIGINT, handler)
-
-    xmls = threading.Thread(target=tserver.serve_forever)
-    xmls.start()
-
-    worker = threading.Thread(target=im.worker)
-    worker.start()
-
-    while not im.doned:
-        signal.pause()
-
+    run_host(sys.argv[1])
@@ -36,8 +36,8 @@ def main():
         oid = args.id, 
         pset = args.pset
         for id_ in oid:
-            print id_, pset
-            rserver.run(id_, pset)
+            print id_, pset, args.channel
+            rserver.run(id_, pset, args.channel)
 
     def pset_create(args):
         print 'Create pset with name %s for instrument %s' % (args.name, args.instrument)
@@ -85,6 +85,10 @@ def main():
     parser_run.add_argument('-s', dest='pset', default='default',
                               help='Name of the processing set')
 
+    parser_run.add_argument('-c', dest='channel', default='default',
+                              help='Name of the channel, tasks in channels with '
+                              'higher priority are processed first')
+
     parser_run.set_defaults(command=run)
     
     # pset target
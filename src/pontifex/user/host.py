@@ -29,37 +29,90 @@ import sys
 import ConfigParser
 
 from pontifex.txrServer import txrServer
+from pontifex.transport import BinaryServer
 from pontifex.host import PontifexHost
 
 
 # create logger for host
 _logger = logging.getLogger("pontifex.host")
 
-def main():
-
-    logging.config.fileConfig("logging.ini")
-
-    if len(sys.argv) != 2:
-        sys.exit(1)
-
-    cfgfile = sys.argv[1]
+def read_config(cfgfile):
+    '''Read the configuration of a host.
 
+    Returns the seconds between heartbeats and the 
+    keyword arguments of PontifexHost.
+    '''
     config = ConfigParser.ConfigParser()
     config.read(cfgfile)
 
-    masterurl = config.get('master', 'url')
-    host = config.get('slave', 'host')
-    port = config.getint('slave', 'port')
-
-    im = PontifexHost(masterurl, host, port)
+    options = {}
+    options['master'] = config.get('master', 'url')
+    options['host'] = config.get('slave', 'host')
+    options['port'] = config.getint('slave', 'port')
+    # number of recipes run at the same time, by default the number of cores
+    if config.has_option('slave', 'slots'):
+        options['slots'] = config.getint('slave', 'slots')
+    # the tasks are received with the binary transport in this port
+    if config.has_option('slave', 'binport'):
+        options['binport'] = config.getint('slave', 'binport')
+    # results sent to the server in one call, and seconds waited to fill a batch
+    if config.has_option('slave', 'batch'):
+        options['batch'] = config.getint('slave', 'batch')
+    if config.has_option('slave', 'delay'):
+        options['delay'] = config.getfloat('slave', 'delay')
+    # seconds between heartbeats, shorter than the lease in the server
+    heartbeat = 10
+    if config.has_option('slave', 'heartbeat'):
+        heartbeat = config.getfloat('slave', 'heartbeat')
+
+    # fetch the tasks from the server instead of waiting for them
+    if config.has_option('slave', 'pull'):
+        options['pull'] = config.getboolean('slave', 'pull')
+
+    # upload the products, if the filesystem of the server is not shared
+    if config.has_option('slave', 'upload'):
+        options['upload'] = config.getboolean('slave', 'upload')
+
+    # download the inputs, compressed with zlib at level compress, 
+    # 0 for none, into a cache in this host
+    if config.has_option('slave', 'download'):
+        options['download'] = config.getboolean('slave', 'download')
+    if config.has_option('slave', 'compress'):
+        options['compress'] = config.getint('slave', 'compress')
+    if config.has_option('slave', 'cache'):
+        options['cachedir'] = config.get('slave', 'cache')
+
+    # comma separated list of the instruments whose tasks are run
+    if config.has_option('slave', 'capabilities'):
+        capabilities = config.get('slave', 'capabilities').split(',')
+        options['capabilities'] = [c.strip() for c in capabilities if c.strip()]
+
+    return heartbeat, options
+
+def run_host(cfgfile):
+    '''Run a host with the configuration in cfgfile.'''
+    heartbeat, options = read_config(cfgfile)
+    host, port = options['host'], options['port']
+    binport = options.get('binport')
+
+    im = PontifexHost(**options)
 
     tserver = txrServer((host, port), allow_none=True, logRequests=False)
     tserver.register_function(im.pass_info)
+    tserver.register_function(im.pass_info_many)
+    servers = [tserver]
+
+    if binport is not None:
+        bserver = BinaryServer((host, binport))
+        bserver.register_function(im.pass_info)
+        bserver.register_function(im.pass_info_many)
+        servers.append(bserver)
 
     # signal handler
     def handler(signum, frame):
         im.quit()
-        tserver.shutdown()
+        for server in servers:
+            server.shutdown()
         im.doned = True
         sys.exit(0)
 
@@ -67,15 +120,33 @@ def main():
     signal.signal(signal.SIGTERM, handler)
     signal.signal(signal.SIGINT, handler)
 
-    xmls = threading.Thread(target=tserver.serve_forever)
-    xmls.start()
+    for server in servers:
+        xmls = threading.Thread(target=server.serve_forever)
+        xmls.start()
 
     worker = threading.Thread(target=im.worker)
     worker.start()
 
+    beat = threading.Thread(target=im.heartbeat, args=(heartbeat, ), 
+                            name='heartbeat')
+    beat.start()
+
+    if im.pull:
+        puller = threading.Thread(target=im.puller, name='puller')
+        puller.start()
+
     while not im.doned:
         signal.pause()
 
+def main():
+
+    logging.config.fileConfig("logging.ini")
+
+    if len(sys.argv) != 2:
+        sys.exit(1)
+
+    run_host(sys.argv[1])
+
 if __name__ == '__main__':
     main()
 
@@ -22,12 +22,15 @@
 
 import threading
 import logging
+import logging.config
 import signal
 import sys
+import argparse
 
 from sqlalchemy import create_engine
 
-from pontifex.txrServer import txrServer
+from pontifex.eventserver import EventServer
+from pontifex.transport import BinaryServer
 import pontifex.model
 from pontifex.server import PontifexServer
 
@@ -36,6 +39,40 @@ _logger = logging.getLogger("pontifex.server")
 
 def main():
 
+    parser = argparse.ArgumentParser(description='Pontifex server',
+                                     prog='pontifex-server')
+    parser.add_argument('-d', '--dispatchers', type=int, default=4,
+                        help='Number of threads preparing and dispatching tasks')
+    parser.add_argument('-r', '--reserve', action='append', default=[],
+                        metavar='CHANNEL=N',
+                        help='Keep N idle hosts for the tasks of CHANNEL')
+    parser.add_argument('-b', '--burst', type=int, default=4,
+                        help='Consecutive tasks of a channel dispatched before '
+                        'serving one of a lower priority channel')
+    parser.add_argument('-s', '--staging', default=None,
+                        help='Comma separated list of staging strategies '
+                        'to try, between reflink, hardlink, symlink and copy')
+    parser.add_argument('-n', '--batch', type=int, default=4,
+                        help='Maximum number of enqueued tasks taken by a '
+                        'dispatcher at once')
+    parser.add_argument('-l', '--lease', type=float, default=30,
+                        help='Seconds without heartbeats before a host is '
+                        'evicted and its tasks sent to other hosts')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='Number of threads running the calls of '
+                        'hosts and clients')
+    parser.add_argument('-t', '--sweep', type=float, default=5,
+                        help='Seconds between sweeps of the database for tasks '
+                        'made ready by other processes')
+    parser.add_argument('-p', '--binport', type=int, default=7082,
+                        help='Port of the binary transport, 0 to disable it')
+    args = parser.parse_args()
+
+    reservations = {}
+    for value in args.reserve:
+        channel, nhosts = value.split('=')
+        reservations[channel] = int(nhosts)
+
     logging.config.fileConfig("logging.ini")
 
     #df_server = ServerProxy('http://127.0.0.1:7080')
@@ -46,21 +83,45 @@ def main():
 
     pontifex.model.init_model(engine)
     pontifex.model.metadata.create_all(engine)
-
-    im = PontifexServer()
-
-    tserver = txrServer(('localhost', 7081), allow_none=True, logRequests=False)
-    tserver.register_function(im.register)
-    tserver.register_function(im.unregister)
-    tserver.register_function(im.receiver)
-    tserver.register_function(im.version)
-    tserver.register_function(im.run)
-    tserver.register_function(im.pset_create)
+    pontifex.model.upgrade_model(engine)
+
+    staging = None
+    if args.staging is not None:
+        staging = args.staging.split(',')
+
+    im = PontifexServer(reservations=reservations, burst=args.burst, 
+                        staging=staging, batch=args.batch, lease=args.lease)
+
+    # all the XML-RPC connections are served by one thread
+    tserver = EventServer(('localhost', 7081), workers=args.workers, allow_none=True)
+    tserver.register_deferred(im.fetch_task_later, 'fetch_task')
+    servers = [tserver]
+    if args.binport:
+        bserver = BinaryServer(('localhost', args.binport))
+        bserver.register_function(im.fetch_task)
+        servers.append(bserver)
+
+    for server in servers:
+        server.register_function(im.register)
+        server.register_function(im.unregister)
+        server.register_function(im.receiver)
+        server.register_function(im.receiver_many)
+        server.register_function(im.heartbeat)
+        server.register_function(im.notify_ready)
+        server.register_function(im.upload_begin)
+        server.register_function(im.upload_chunk)
+        server.register_function(im.upload_end)
+        server.register_function(im.download)
+        server.register_function(im.transfers)
+        server.register_function(im.version)
+        server.register_function(im.run)
+        server.register_function(im.pset_create)
 
     # signal handler
     def handler(signum, frame):
         im.quit()
-        tserver.shutdown()
+        for server in servers:
+            server.shutdown()
         im.doned = True
         sys.exit(0)
 
@@ -68,19 +129,26 @@ def main():
     signal.signal(signal.SIGTERM, handler)
     signal.signal(signal.SIGINT, handler)
 
-    xmls = threading.Thread(target=tserver.serve_forever)
-    xmls.start()
+    for server in servers:
+        xmls = threading.Thread(target=server.serve_forever)
+        xmls.start()
 
-    POLL = 5
-    _logger.info('polling database for new ProcessingTasks every %d seconds', POLL)
-    timer = threading.Thread(target=im.watchdog, args=(POLL, ), name='timer')
+    # tasks made ready in the server are notified to the watchdog,
+    # other processes call notify_ready or wait for the next sweep
+    _logger.info('sweeping database for ready ProcessingTasks every %g seconds', args.sweep)
+    timer = threading.Thread(target=im.watchdog, args=(args.sweep, ), name='timer')
     timer.start()
 
     inserter = threading.Thread(target=im.inserter, name='inserter')
     inserter.start()
 
-    consumer = threading.Thread(target=im.consumer, name='consumer')
-    consumer.start()
+    reaper = threading.Thread(target=im.reaper, name='reaper')
+    reaper.start()
+
+    _logger.info('starting %d dispatchers', args.dispatchers)
+    for i in range(args.dispatchers):
+        consumer = threading.Thread(target=im.consumer, name='consumer-%d' % i)
+        consumer.start()
 
     while not im.doned:
         signal.pause()
@@ -0,0 +1,134 @@
+#
+# Copyright 2012 Universidad Complutense de Madrid
+#
+# This file is part of Pontifex
+#
+# Pontifex is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pontifex is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pontifex.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+'''Interned context descriptions and values.
+
+The descriptions and values of the context of the products are
+few and rarely change, so their ids are kept in memory. The values
+are merged in the sessions from their ids, without queries.
+The values created in a session are interned when it is committed.
+Those not known are looked up once in the database, in case they
+have been inserted by other process.
+'''
+
+import logging
+import threading
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from pontifex.model import maker, ContextDescription, ContextValue
+
+_logger = logging.getLogger("pontifex.vocabulary")
+
+class ContextVocabulary(object):
+    '''Ids of the context descriptions and values.'''
+    def __init__(self):
+        super(ContextVocabulary, self).__init__()
+        # (instrument, name) -> description id
+        self.descriptions = {}
+        # (description id, value) -> value id
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def load(self, session):
+        '''Intern all the descriptions and values in the database.'''
+        descriptions = session.query(ContextDescription.instrument_id,
+                                     ContextDescription.name,
+                                     ContextDescription.id).all()
+        values = session.query(ContextValue.description_id,
+                               ContextValue.value, ContextValue.id).all()
+        with self.lock:
+            for instrument, name, descid in descriptions:
+                self.descriptions[(instrument, name)] = descid
+            for descid, value, valueid in values:
+                self.values[(descid, value)] = valueid
+        _logger.info('loaded %d context descriptions and %d values',
+                     len(descriptions), len(values))
+
+    def _description(self, session, instrument, name):
+        with self.lock:
+            descid = self.descriptions.get((instrument, name))
+        if descid is None:
+            desc = session.query(ContextDescription).filter_by(
+                        instrument_id=instrument, name=name).first()
+            if desc is None:
+                return None
+            descid = desc.id
+            with self.lock:
+                self.descriptions[(instrument, name)] = descid
+        return descid
+
+    def value(self, session, instrument, name, value):
+        '''The ContextValue of a description, in session.
+
+        It is created if it doesn't exist. Returns None if
+        the description doesn't exist.
+        '''
+        descid = self._description(session, instrument, name)
+        if descid is None:
+            return None
+        # values are stored as strings
+        key = (descid, unicode(value))
+        created = session.info.setdefault('new_context_values', {})
+        if key in created:
+            return created[key]
+
+        with self.lock:
+            valueid = self.values.get(key)
+        if valueid is not None:
+            interned = ContextValue(id=valueid, description_id=descid,
+                                    value=key[1])
+            make_transient_to_detached(interned)
+            return session.merge(interned, load=False)
+
+        stored = session.query(ContextValue).filter_by(description_id=descid,
+                                                       value=key[1]).first()
+        if stored is not None:
+            with self.lock:
+                self.values[key] = stored.id
+            return stored
+
+        _logger.debug('creating context value %s=%s', name, value)
+        stored = ContextValue(description_id=descid, value=key[1])
+        session.add(stored)
+        created[key] = stored
+        return stored
+
+    def intern(self, values):
+        '''Intern a dictionary of (description id, value) -> value id.'''
+        with self.lock:
+            self.values.update(values)
+
+vocabulary = ContextVocabulary()
+
+# The values created in a session are interned when it is committed
+
+@event.listens_for(maker, 'after_commit')
+def _intern_values(session):
+    created = session.info.pop('new_context_values', None)
+    if created:
+        vocabulary.intern(dict((key, inspect(value).identity[0])
+                                for key, value in created.items()))
+
+@event.listens_for(maker, 'after_rollback')
+def _discard_values(session):
+    session.info.pop('new_context_values', None)